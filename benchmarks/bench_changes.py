@@ -0,0 +1,68 @@
+"""
+Benchmark of analyzing changes from `git diff` on synthetic diff.
+Compares one-pass changes.ChangeSet against splitting every line per helper
+and filtering all services once per package (as build stage did before).
+Run from repository root: python -m benchmarks.bench_changes [lines] [packages]
+"""
+import itertools
+import random
+import sys
+import time
+
+from deployer import build, changes
+
+
+def synthetic_diff(lines=100_000, packages=300, seed=7):
+    rnd = random.Random(seed)
+    names = [f"TpOss{kind}{i}" for i, kind in zip(range(packages), itertools.cycle(["Channel", "Adapter", "Common"]))]
+    files = ["flow.xml", "node.ndf", "node.idf", "java.frag"]
+    diff = []
+    for _ in range(lines):
+        package = rnd.choice(names)
+        depth = [rnd.choice(["order", "resource", "service", "common"]) for _ in range(rnd.randint(1, 3))]
+        svc = f"svc{rnd.randint(0, 200)}"
+        diff.append("/".join(["packages", package, "ns", "tp", "oss", *depth, rnd.choice(["pub", "priv"]), svc,
+                              rnd.choice(files)]))
+    return diff
+
+
+def legacy(diff):
+    packages = set(itertools.filterfalse(
+        build.is_package_to_exclude,
+        set(filter(build.is_package, itertools.chain(*[line.split('/') for line in diff])))))
+    services = {'/'.join(c.split('/')[:-1]) for c in diff if c.endswith(build.settings.SOURCE_CODE_EXT)}
+    grouped = {p: [s for s in services if p in s.split('/')] for p in packages}
+    names = [build.extract_is_style_service_name(s) for s in services]
+    return packages, services, grouped, names
+
+
+def one_pass(diff):
+    change_set = changes.ChangeSet.from_lines(diff)
+    packages = change_set.packages()
+    services = change_set.services()
+    grouped = {p: change_set.services_of(p) for p in packages}
+    names = [build.extract_is_style_service_name(s) for s in services]
+    return packages, services, grouped, names
+
+
+def measure(fn, diff, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(diff)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    packages = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    diff = synthetic_diff(lines, packages)
+    legacy_time, legacy_result = measure(legacy, diff)
+    one_pass_time, one_pass_result = measure(one_pass, diff)
+    assert legacy_result[0] == one_pass_result[0] and legacy_result[1] == one_pass_result[1]
+    assert all(sorted(legacy_result[2][p]) == sorted(one_pass_result[2][p]) for p in legacy_result[0])
+    print(f"lines: {lines}, packages: {len(legacy_result[0])}, services: {len(legacy_result[1])}")
+    print(f"legacy:   {legacy_time:.3f} s")
+    print(f"one pass: {one_pass_time:.3f} s ({legacy_time / one_pass_time:.1f}x)")
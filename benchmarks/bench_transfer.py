@@ -0,0 +1,84 @@
+"""
+Benchmark of sending build directory to packages repository: scp -r per package against one tar stream.
+Synthetic tree looks like IS packages - thousands of small node.ndf/flow.xml files.
+With a host it sends to a temporary directory there (key authentication required):
+    python -m benchmarks.bench_transfer --host 10.0.0.5 --user admin --key ~/.ssh/id_rsa [--port 22]
+Without a host, 'remote' side runs locally (sh -c), so only the stream pipeline is measured,
+compared with copying packages one by one (cp -r per package).
+"""
+import argparse
+import pathlib
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from deployer import sender
+
+
+def synthetic_tree(root, packages=20, services=150, seed=7):
+    rnd = random.Random(seed)
+    size = 0
+    for p in range(packages):
+        for s in range(services):
+            service = pathlib.Path(root, f"TpOssPackage{p}", "ns", "tp", "oss", f"folder{s % 10}", f"svc{s}")
+            service.mkdir(parents=True)
+            for name in ("node.ndf", "flow.xml"):
+                content = rnd.randbytes(rnd.randint(500, 6000)).hex()
+                (service / name).write_text(content)
+                size += len(content)
+    return size
+
+
+class LocalTarCommand(sender.TarCommand):
+    def remote_args(self, script) -> list:
+        return ["sh", "-c", script]
+
+
+def measure(name, fn, size):
+    started = time.monotonic()
+    ok = fn()
+    seconds = time.monotonic() - started
+    print("{:<22} {:>8.2f} s {:>9.1f} MiB/s {}".format(name, seconds, size / seconds / 1024 ** 2,
+                                                       "" if ok else "FAILED"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host")
+    parser.add_argument("--port", default="22")
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--key", default="~/.ssh/id_rsa")
+    parser.add_argument("--packages", type=int, default=20)
+    parser.add_argument("--services", type=int, default=150)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as target:
+        size = synthetic_tree(source, args.packages, args.services)
+        print(f"{args.packages} packages, {args.packages * args.services * 2} files, {size} bytes")
+        if args.host:
+            key = pathlib.Path(args.key).expanduser()
+            remote_dir = f"/tmp/bench_transfer_{int(time.time())}"
+            scp = sender.SCPCommand(args.host, args.port, args.user, key)
+            tar = sender.TarCommand(args.host, args.port, args.user, key)
+            tar_gzip = sender.TarCommand(args.host, args.port, args.user, key, compress=True)
+            subprocess.run(tar.remote_args(f"mkdir -p {remote_dir}"), check=True)
+            measure("scp -r per package", lambda: scp.send_dirs(source, remote_dir), size)
+            measure("tar stream", lambda: tar.send_dirs(source, remote_dir), size)
+            measure("tar stream + gzip", lambda: tar_gzip.send_dirs(source, remote_dir), size)
+            subprocess.run(tar.remote_args(f"rm -rf {remote_dir}"))
+        else:
+            def copy_per_package():
+                for package in sorted(pathlib.Path(source).iterdir()):
+                    subprocess.run(["cp", "-r", str(package), target], check=True)
+                return True
+
+            measure("cp -r per package", copy_per_package, size)
+            shutil.rmtree(target)
+            measure("tar stream", lambda: LocalTarCommand("localhost", "22", "", "").send_dirs(source, target), size)
+            measure("tar stream + gzip", lambda: LocalTarCommand("localhost", "22", "", "", compress=True)
+                    .send_dirs(source, target), size)
+
+
+if __name__ == '__main__':
+    main()
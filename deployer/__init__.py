@@ -1,3 +1,7 @@
-from . import main, build, config, errors, sender, settings, git, remoter
+from . import (main, build, config, errors, sender, settings, git, remoter, cache, staging, changes, dependencies,
+               manifest, fleet, connections, fanout, transfers, readiness, rollout,
+               journal, backup, preflight)
 
-__all__ = ["main", "build", "config", "errors", "sender", "settings", "git", "remoter"]
+__all__ = ["main", "build", "config", "errors", "sender", "settings", "git", "remoter", "cache", "staging",
+           "changes", "dependencies", "manifest", "fleet", "connections", "fanout", "transfers", "readiness", "rollout",
+           "journal", "backup", "preflight"]
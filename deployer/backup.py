@@ -0,0 +1,116 @@
+"""
+Snapshots of packages of IS instance at host, taken before is_instance changes them and restored by rollback
+without any transfer. Snapshot is a copy of IS_DIR/instances/<instance>/packages in IS_DIR/backups/<instance>/<name>,
+made by `cp -a --reflink=auto` (copy-on-write clone where filesystem supports it, 'reflink' mode)
+or by `cp -al` (hardlinks, 'link' mode - the fastest, but safe only while files of instance are replaced
+and never rewritten in place, otherwise the snapshot changes with them).
+Rollback renames snapshot in place of packages directory, so it takes the same time for any size of instance.
+Only `keep` newest snapshots are kept at each host.
+Using example:
+result = backup.snapshot(host, environ, backup.snapshot_name(ref))
+"""
+import pathlib
+import shlex
+import time
+
+from . import fleet, remoter, settings
+from .settings import log
+
+
+def get_dirs(environ) -> tuple:
+    """
+    :return: (packages directory of instance, directory of its snapshots) at host.
+    :raise KeyError: if IS_DIR or INSTANCE_NAME is not configured.
+    """
+    is_dir = pathlib.Path(environ[settings.IS_DIR_ENV_VAR])
+    instance_name = environ[settings.INSTANCE_NAME_ENV_VAR]
+    return is_dir / "instances" / instance_name / "packages", is_dir / settings.BACKUP_DIR / instance_name
+
+
+def snapshot_name(ref='') -> str:
+    """Name of snapshot - time first, so names sort from the oldest one."""
+    name = time.strftime("%Y%m%d-%H%M%S")
+    ref = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(ref))
+    return f"{name}-{ref}" if ref else name
+
+
+def snapshot_script(packages_dir, backups_dir, name, mode=None, keep=None) -> str:
+    """
+    Shell script which copies packages_dir to backups_dir/name and removes snapshots beyond keep.
+    :param mode: 'reflink' or 'link', default settings.BACKUP_MODE,
+    :param keep: snapshots kept, default settings.BACKUP_KEEP, 0 - keep all.
+    """
+    mode = mode or settings.BACKUP_MODE
+    keep = settings.BACKUP_KEEP if keep is None else keep
+    packages_dir, backups_dir = shlex.quote(str(packages_dir)), shlex.quote(str(backups_dir))
+    tmp = shlex.quote(f".{name}.tmp")
+    lines = [
+        "set -e",
+        f"[ -d {packages_dir} ] || {{ echo 'No packages directory {packages_dir}' >&2; exit 1; }}",
+        f"mkdir -p {backups_dir}",
+        f"cd {backups_dir}",
+        f"rm -rf {tmp}",
+        "cp {} {} {}".format('-al' if mode == 'link' else '-a --reflink=auto', packages_dir, tmp),
+        f"mv -T {tmp} {shlex.quote(name)}",  # only complete snapshot gets its name
+    ]
+    if keep:
+        lines += [
+            f"ls -1 | sort -r | tail -n +{keep + 1} | while IFS= read -r old; do",
+            '  rm -rf "$old"',
+            "done",
+        ]
+    return '\n'.join(lines)
+
+
+def restore_script(packages_dir, backups_dir, name=None) -> str:
+    """
+    Shell script which puts snapshot name (default the newest one) in place of packages_dir.
+    The snapshot is used up, the replaced packages are removed.
+    """
+    packages_dir, backups_dir = shlex.quote(str(packages_dir)), shlex.quote(str(backups_dir))
+    return '\n'.join([
+        "set -e",
+        f"cd {backups_dir}",
+        "name={}".format(shlex.quote(name) if name else "$(ls -1 | sort | tail -n 1)"),
+        '[ -n "$name" ] && [ -d "$name" ] || { echo "No snapshot to restore" >&2; exit 1; }',
+        'echo "Restoring snapshot $name"',
+        "rm -rf .replaced",
+        f"if [ -e {packages_dir} ]; then mv -T {packages_dir} .replaced; fi",
+        f'mv -T "$name" {packages_dir}',
+        "rm -rf .replaced",
+    ])
+
+
+def snapshot(host, environ, name, mode=None, keep=None) -> fleet.HostResult:
+    """Take snapshot of packages of instance at host, see `snapshot_script`."""
+    try:
+        packages_dir, backups_dir = get_dirs(environ)
+    except KeyError:
+        log.error("Lack of configuration. Used variables: {} {}".format(
+            settings.IS_DIR_ENV_VAR, settings.INSTANCE_NAME_ENV_VAR))
+        return fleet.HostResult(host, False, 'backup', message="lack of configuration")
+    log.info("Snapshot {} of packages at {}".format(name, host))
+    result = fleet.run_steps(host, [("backup", snapshot_script(packages_dir, backups_dir, name, mode, keep))],
+                             environ)
+    if result.ok:
+        result.message = name
+    return result
+
+
+def rollback(host, environ, name=None, with_restart=False) -> fleet.HostResult:
+    """
+    Restore snapshot of packages at host, with restart - shutdown before and start after it in the same session.
+    :param name: snapshot to restore, default the newest one,
+    :return: fleet.HostResult, step 'start' if restarted (readiness is not checked).
+    """
+    try:
+        packages_dir, backups_dir = get_dirs(environ)
+    except KeyError:
+        log.error("Lack of configuration. Used variables: {} {}".format(
+            settings.IS_DIR_ENV_VAR, settings.INSTANCE_NAME_ENV_VAR))
+        return fleet.HostResult(host, False, 'rollback', message="lack of configuration")
+    restore = ("rollback", restore_script(packages_dir, backups_dir, name))
+    # the same shutdown and start as deploy, snapshot restored instead of is_instance
+    steps = [restore if step == 'is_instance' else (step, snippet)
+             for step, snippet in remoter.deploy_steps(environ, with_restart=with_restart)]
+    return fleet.run_steps(host, steps, environ)
@@ -1,37 +1,58 @@
 """Building - preparing changes to deploy"""
 
+import concurrent.futures
+import dataclasses
 import functools
+import hashlib
 import shutil
 import pathlib
 import os
-import itertools
 import typing
 import json
+import tempfile
+import time
+import zipfile
 from datetime import datetime
 
-from . import settings, config
+from . import settings, config, cache, staging
+from . import changes as changes_module
 from .settings import log
-from .git import GitOperation
+from .git import GitOperation, Change, ChangeType
 
+REMOVED_SERVICES_FILENAME = "removed_services.json"
+UPLOAD_STATE_FILENAME = "upload_state.json"  # chunks of files already sent to hosts, see sender.ResumableCommand
+WAVES_FILENAME = "deploy_waves.json"  # order of activating packages, see dependencies.topological_waves
 
-def build_packages_for_is_instance(build_dir, packages, services):
+
+def build_packages_for_is_instance(build_dir, packages, services, link=False):
+    """
+    Create packages in build_dir with only changed services.
+    :param link: flag for staging files by reflinks/hardlinks instead of copying them, see staging module.
+    """
+    stats = staging.StagingStats() if link else None
+    services_by_package = changes_module.group_services_by_package(services, packages)
     for package in packages:
-        services_to_copy = list(filter(lambda x: package in x.split('/'), services))
+        services_to_copy = services_by_package[package]
         if not services_to_copy:
             log.info("Any services were changed, so ->%s<- won't be included" % package)
         else:
-            create_empty_package(package, build_dir)
+            create_empty_package(package, build_dir, stats)
             common_names_svc = map(extract_is_style_service_name, services_to_copy)
             log.info("In package {}; Copying services: {}".format(package, ', '.join(common_names_svc)))
-            copy_services(build_dir, package, services_to_copy)
+            copy_services(build_dir, package, services_to_copy, stats)
+    if stats:
+        log.info(stats.report())
 
 
-def build_package_for_inbound(name: str, ref: str, skip_check_archive_exist=False) -> bool:
+def build_package_for_inbound(name: str, ref: str, skip_check_archive_exist=False, reproducible=False,
+                              policy=None) -> bool:
     """
     Building one ZIP from one package
     :param skip_check_archive_exist: if you should do things quickly,
     :param name: name of package,
-    :param ref: name of merge_iid.
+    :param ref: name of merge_iid,
+    :param reproducible: build the same bytes for the same content and write {name}.zip.sha256 next to archive,
+    :param policy: CompressionPolicy for files by their extension, None means default of `shutil.make_archive`.
     :return: True if built, False otherwise.
     """
     error = False
@@ -40,7 +61,22 @@ def build_package_for_inbound(name: str, ref: str, skip_check_archive_exist=Fals
         build_dir = config.get_build_dir(ref)
         source_dir = config.get_source_dir()
         os.makedirs(build_dir, exist_ok=True)
-        if 'zip' in [n for n, _ in shutil.get_archive_formats()]:
+        archive = pathlib.Path(build_dir) / f"{name}.zip"
+        variant = 'zip-reproducible' if reproducible else 'zip'
+        if reproducible or policy:
+            variant += '-' + (policy or CompressionPolicy()).variant()
+        key = cache.package_key(name, variant) if cache.is_enabled() else None
+        if key and cache.fetch(key, archive):
+            log.info("Archive for {} taken from build cache".format(name))
+            return True
+        for path in (archive, get_checksum_path(archive)):
+            if os.path.lexists(path):
+                os.unlink(path)  # can be hardlink to cache, so never write into it
+        if reproducible or policy:
+            make_zip_archive(archive, source_dir / name, policy, reproducible)
+            if reproducible:
+                write_checksum(archive)
+        elif 'zip' in [n for n, _ in shutil.get_archive_formats()]:
             shutil.make_archive(str(pathlib.Path(build_dir) / name),
                                 'zip', root_dir=str(source_dir / name))
             if not skip_check_archive_exist:
@@ -54,12 +90,223 @@ def build_package_for_inbound(name: str, ref: str, skip_check_archive_exist=Fals
             else:
                 log.error("There is no 'zip' format to create archive.")
                 error = True
+        if key and not error:
+            cache.store(key, archive)
     except Exception as e:
         log.error(e)
         error = True
     return not error
 
 
+@dataclasses.dataclass(frozen=True)
+class CompressionPolicy:
+    """
+    How files are compressed in archive, chosen by extension of file.
+    Already compressed formats (jars, images etc.) are stored, the rest is deflated with chosen level.
+    """
+    level: int = settings.ARCHIVE_COMPRESS_LEVEL
+    stored_extensions: tuple = settings.ARCHIVE_STORED_EXT
+
+    def for_file(self, name: str) -> tuple:
+        """
+        :param name: name or path of file,
+        :return: (compress_type, compresslevel) for zipfile.
+        """
+        extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+        if self.level == 0 or extension in self.stored_extensions:
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+    def variant(self) -> str:
+        """Short description of policy, so archives built with other policy are not mixed in cache."""
+        extensions = hashlib.sha256(','.join(sorted(self.stored_extensions)).encode()).hexdigest()[:8]
+        return "l{}-{}".format(self.level, extensions)
+
+
+def set_compress_level(info: zipfile.ZipInfo, level: int) -> None:
+    """Level of compressor for entry written by `zipfile.ZipFile.open(info, 'w')`."""
+    if hasattr(zipfile.ZipInfo, 'compress_level'):
+        info.compress_level = level  # public since Python 3.13
+    else:
+        info._compresslevel = level  # the same attribute before 3.13, writestr sets it this way
+
+
+def make_zip_archive(archive, root_dir, policy=None, reproducible=False) -> None:
+    """
+    Create ZIP from root_dir compressing files according to policy.
+    In reproducible mode bytes of archive depends only on content of root_dir. Entries are always sorted,
+    but timestamps are set to SOURCE_DATE_EPOCH (or 1980-01-01) and permissions are normalized to 644/755.
+    :param archive: path of ZIP to create,
+    :param root_dir: directory to pack, paths in archive are relative to it,
+    :param policy: CompressionPolicy, default from settings,
+    :param reproducible: flag for normalize timestamps and permissions.
+    :raise FileNotFoundError: if root_dir does not exist.
+    """
+    root_dir = pathlib.Path(root_dir)
+    if not root_dir.is_dir():
+        raise FileNotFoundError(f"There is no directory {root_dir} to archive.")
+    policy = policy or CompressionPolicy()
+    epoch = config.get_env_var_or_default("SOURCE_DATE_EPOCH", default=None)
+    fixed_date_time = (1980, 1, 1, 0, 0, 0)
+    if epoch:
+        fixed_date_time = max(fixed_date_time, time.gmtime(int(epoch))[:6])
+    entries = []
+    for root, dirs, files in os.walk(root_dir):
+        relative = pathlib.Path(root).relative_to(root_dir)
+        for d in dirs:
+            entries.append(((relative / d).as_posix() + '/', pathlib.Path(root) / d))
+        for f in files:
+            entries.append(((relative / f).as_posix(), pathlib.Path(root) / f))
+    entries.sort()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, compresslevel=policy.level) as zf:
+        for arcname, path in entries:
+            stat = os.stat(path)
+            if reproducible:
+                date_time = fixed_date_time
+                mode = 0o755 if stat.st_mode & 0o111 or arcname.endswith('/') else 0o644
+            else:
+                date_time = max((1980, 1, 1, 0, 0, 0), time.localtime(stat.st_mtime)[:6])
+                mode = stat.st_mode & 0o777
+            info = zipfile.ZipInfo(arcname, date_time=date_time)
+            info.create_system = 3  # unix, so external_attr below are honoured
+            if arcname.endswith('/'):
+                info.external_attr = ((0o40000 | mode) << 16) | 0x10
+                zf.writestr(info, b'')
+            else:
+                info.external_attr = (0o100000 | mode) << 16
+                info.compress_type, compresslevel = policy.for_file(arcname)
+                if compresslevel is not None:
+                    set_compress_level(info, compresslevel)
+                info.file_size = stat.st_size  # to decide about zip64 before writing
+                # streamed by blocks, so workers of pool never hold whole files in memory
+                with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def benchmark_compression(packages: typing.Iterable, levels=(0, 1, 6, 9), stored_extensions=None) -> list:
+    """
+    Build archive of every package with every deflate level to temporary directory and measure it.
+    Helps to choose between CPU time on runner and bytes sent to IS nodes.
+    :param packages: names of packages from sources directory,
+    :param levels: deflate levels to check, 0 means store everything,
+    :param stored_extensions: extensions which are always stored, default from settings.
+    :return: list of dicts with keys package, level, size, source size and seconds.
+    """
+    stored_extensions = settings.ARCHIVE_STORED_EXT if stored_extensions is None else tuple(stored_extensions)
+    source_dir = config.get_source_dir()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="deployer_benchmark_") as tmp:
+        for package in packages:
+            source_size = get_package_size(package)
+            for level in levels:
+                archive = pathlib.Path(tmp) / f"{package}-{level}.zip"
+                started = time.perf_counter()
+                make_zip_archive(archive, source_dir / package, CompressionPolicy(level, stored_extensions))
+                seconds = time.perf_counter() - started
+                results.append({"package": package, "level": level, "size": os.path.getsize(archive),
+                                "source size": source_size, "seconds": seconds})
+                os.unlink(archive)
+    return results
+
+
+def get_checksum_path(path) -> pathlib.Path:
+    """Path of file with sha256 of artifact - {artifact}.sha256."""
+    return pathlib.Path(f"{path}.sha256")
+
+
+def write_checksum(path) -> str:
+    """
+    Write sha256 of file next to it, in format of `sha256sum` tool.
+    :return: hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    hexdigest = digest.hexdigest()
+    with open(get_checksum_path(path), 'w', encoding='utf-8') as f:
+        f.write(f"{hexdigest}  {pathlib.Path(path).name}\n")
+    return hexdigest
+
+
+def read_checksum(path):
+    """
+    Read sha256 written by `write_checksum`.
+    :return: hex digest or None if there is no checksum file.
+    """
+    try:
+        with open(get_checksum_path(path), 'r', encoding='utf-8') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def get_package_size(name: str) -> int:
+    """
+    Sum of sizes of all files in package from sources directory.
+    Used to schedule the biggest archives first.
+    :param name: name of package,
+    :return: size in bytes, 0 if package cannot be read.
+    """
+    size = 0
+    for root, _, files in os.walk(config.get_source_dir() / name):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+def build_packages_for_inbound(packages: typing.Iterable, ref: str, workers=None, reproducible=False,
+                               policy=None) -> bool:
+    """
+    Building ZIP-s for many packages in pool of processes - one archive per process at once.
+    The largest packages are scheduled first, so the longest archive does not start as the last one.
+    All failures are collected and reported together, building does not stop at the first one.
+    :param packages: names of packages,
+    :param ref: name of merge_iid,
+    :param workers: number of processes, default from settings (None means all CPUs),
+    :param reproducible: see `build_package_for_inbound`,
+    :param policy: see `build_package_for_inbound`.
+    :return: True if all packages were built, False otherwise.
+    """
+    packages = sorted(packages, key=get_package_size, reverse=True)
+    if not packages:
+        return True
+    workers = workers or settings.BUILD_WORKERS or os.cpu_count() or 1
+    workers = min(workers, len(packages))
+    config.get_build_dir(ref)  # create before workers start
+    log.info("Building {} archives with {} worker(s)".format(len(packages), workers))
+    failed = []
+    if workers == 1:
+        for package in packages:
+            if build_package_for_inbound(package, ref, reproducible=reproducible, policy=policy):
+                log.info("Built {} successfully".format(package))
+            else:
+                failed.append(package)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(build_package_for_inbound, package, ref,
+                                       reproducible=reproducible, policy=policy): package
+                       for package in packages}
+            for future in concurrent.futures.as_completed(futures):
+                package = futures[future]
+                try:
+                    built = future.result()
+                except Exception as e:
+                    log.error(e)
+                    built = False
+                if built:
+                    log.info("Built {} successfully".format(package))
+                else:
+                    failed.append(package)
+    if failed:
+        log.error("Built failed for {} package(s): {}".format(len(failed), ', '.join(sorted(failed))))
+        return False
+    return True
+
+
 @functools.cache
 def is_default_package(name) -> bool:
     """
@@ -123,6 +370,58 @@ def get_changes_from_git_diff(mock=False):
         return GitOperation.diff_to_target_branch(os.environ[settings.CI_MERGE_REQUEST_TARGET_BRANCH_NAME])
 
 
+def get_change_records_from_git_diff(mock=False) -> typing.Iterator:
+    """
+    Returns typed changes (git.Change) between merge_request source branch and target branch,
+    streamed as git produces them. Mocked records are the mocked paths as modified.
+    """
+    if mock:
+        return iter([Change(ChangeType.MODIFIED, path) for path in get_changes_from_git_diff(mock=True)])
+    return GitOperation.iter_diff_to_target_branch(os.environ[settings.CI_MERGE_REQUEST_TARGET_BRANCH_NAME])
+
+
+def write_removed_services(build_dir, removed: dict) -> None:
+    """
+    Save services removed from packages to build_dir/removed_services.json, so deploy stage can delete them.
+    :param removed: package -> list of service directories, like from `changes.ChangeSet.removed_services`.
+    """
+    relative = {package: [service.split(package, 1)[1].lstrip('/') for service in services]
+                for package, services in removed.items()}
+    with open(pathlib.Path(build_dir) / REMOVED_SERVICES_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump(relative, f, indent=1)
+
+
+def read_removed_services(build_dir) -> dict:
+    """
+    :return: package -> list of service directories relative to package (like ns/tp/...), empty if nothing removed.
+    """
+    try:
+        with open(pathlib.Path(build_dir) / REMOVED_SERVICES_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_waves(build_dir, waves: list) -> None:
+    """
+    Save waves of packages to build_dir/deploy_waves.json, so deploy stage activates them in dependency order.
+    Packages which are not in build_dir (i.e. without changed services) are left out.
+    """
+    present = [[package for package in wave if (pathlib.Path(build_dir) / package).exists()
+                or (pathlib.Path(build_dir) / f"{package}.zip").exists()] for wave in waves]
+    with open(pathlib.Path(build_dir) / WAVES_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump([wave for wave in present if wave], f, indent=1)
+
+
+def read_waves(build_dir) -> list:
+    """:return: list of lists of packages, empty if build has no waves (all packages are activated at once)."""
+    try:
+        with open(pathlib.Path(build_dir) / WAVES_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
 def get_all_package() -> list:
     """
     Collecting all packages from repository directory, which is default '.' and can be set in settings.
@@ -168,29 +467,19 @@ def extract_is_style_service_name(diff_line: str, first_parts=None) -> str:
 def get_packages_from_changes(changes) -> set:
     """
     Collect whole packages (TpOss*, etc.) from changes line produced by `git diff` command.
-    :param changes:
+    :param changes: list from `git diff` operation or changes.ChangeSet already built from it.
     :return: set - unique list of packages name
     """
-    return set(
-        itertools.filterfalse(
-            is_package_to_exclude,
-            set(filter(is_package, itertools.chain(*[p for p in (line.split('/') for line in changes)])))
-        ))
+    return changes_module.ChangeSet.of(changes).packages()
 
 
 def get_services_from_changes(changes) -> set:
     """
     Collect only services dir - the folders which has specific files changed.
-    :param changes: list from `git diff` operation.
+    :param changes: list from `git diff` operation or changes.ChangeSet already built from it.
     :return: list of path to folders.
     """
-    services = set()
-    for change in changes:
-        if not change.endswith(settings.SOURCE_CODE_EXT):
-            continue
-        svc = '/'.join(s for s in change.split('/')[:-1])  # exclude last (file) part.
-        services.add(svc)
-    return services
+    return changes_module.ChangeSet.of(changes).services()
 
 
 def clean_directory_after_deploy():
@@ -202,27 +491,32 @@ def clean_directory_after_deploy():
             shutil.rmtree(entry.path)
 
 
-def create_empty_package(name, where) -> bool:
+def create_empty_package(name, where, stats=None) -> bool:
     """
     Build package from exists already, but with ns/ folder empty.
     Then there will be added only changed services.
     :param name: name of package
     :param where: in which folder create that empty package
+    :param stats: staging.StagingStats - if given, files are linked instead of copied and counted in.
     :return: True if good and new package was added to build_* dir. False otherwise.
     """
     try:
-        shutil.copytree(f'packages/{name}', f'{where}/{name}', ignore=shutil.ignore_patterns("ns"))
+        if stats is not None:
+            staging.copytree(f'packages/{name}', f'{where}/{name}', stats, ignore=shutil.ignore_patterns("ns"))
+        else:
+            shutil.copytree(f'packages/{name}', f'{where}/{name}', ignore=shutil.ignore_patterns("ns"))
     except Exception as e:
         log.error(e)
         return False
     return True
 
 
-def copy_services(build_dir: str, package: str, service_dir_list: typing.Iterable):
+def copy_services(build_dir: str, package: str, service_dir_list: typing.Iterable, stats=None):
     """
     :param package: package from which services are,
     :param service_dir_list: list of absolute paths to where files flow.xml etc. are,
-    :param build_dir: is buiding directory where new package are created and to that package services are copied.
+    :param build_dir: is buiding directory where new package are created and to that package services are copied,
+    :param stats: staging.StagingStats - if given, files are linked instead of copied and counted in.
     :return: True if copy all service well, False otherwise.
     """
     source_dir = config.get_source_dir() / package  # $REPO_DIR/packages/$package or $CI_PROJECT_DIR/packages/$package
@@ -231,7 +525,10 @@ def copy_services(build_dir: str, package: str, service_dir_list: typing.Iterabl
         try:
             src = pathlib.Path(source_dir) / pathlib.Path(service_dir)
             dst = pathlib.Path(build_dir) / package / service_dir
-            shutil.copytree(src, dst, dirs_exist_ok=True)
+            if stats is not None:
+                staging.copytree(src, dst, stats, dirs_exist_ok=True)
+            else:
+                shutil.copytree(src, dst, dirs_exist_ok=True)
         except FileNotFoundError:
             log.error(f"Probably there was path changes for service, so service path {service_dir} was skipped.")
             pass
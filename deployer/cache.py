@@ -0,0 +1,163 @@
+"""
+Cache of built artifacts shared between pipelines.
+Artifacts are addressed by hash of package content (git tree hash of packages/<name>),
+so the same package is zipped only once, and next builds get hardlink to archive from cache.
+Cache is enabled when variable BUILD_CACHE_DIR is set. It is kept bounded by size and age - see settings.
+"""
+import hashlib
+import os
+import pathlib
+import time
+
+from . import settings, config, staging
+from .git import GitOperation
+from .settings import log
+
+SIDECAR_SUFFIXES = ('.sha256',)
+
+
+def get_cache_dir():
+    """
+    Get directory of cache from environment, create it if not exists.
+    :return: pathlib.Path or None when cache is not configured.
+    """
+    cache_dir = config.get_env_var_or_default(settings.BUILD_CACHE_DIR_ENV_VAR, default=None)
+    if not cache_dir:
+        return None
+    path = pathlib.Path(cache_dir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def is_enabled() -> bool:
+    return bool(config.get_env_var_or_default(settings.BUILD_CACHE_DIR_ENV_VAR, default=None))
+
+
+def content_hash(directory) -> str:
+    """
+    Hash of all files in directory - relative paths and contents, in sorted order.
+    Used when package is not committed, so git cannot give hash of its tree.
+    """
+    digest = hashlib.sha256()
+    directory = pathlib.Path(directory)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            path = pathlib.Path(root) / file
+            digest.update(path.relative_to(directory).as_posix().encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def package_key(name: str, variant='zip') -> str:
+    """
+    Key in cache for package - hash of its content and variant of artifact.
+    :param name: name of package,
+    :param variant: describe how artifact was built - different options give different archives.
+    :return: key as string.
+    """
+    source_dir = config.get_source_dir()
+    tree = GitOperation.tree_hash(source_dir.parent, pathlib.Path(settings.SRC_DIR) / name)
+    if not tree:
+        tree = content_hash(source_dir / name)
+    return f"{tree}-{variant}"
+
+
+def _sidecars(artifact, destination):
+    """Pairs of (source, destination) for files which accompany artifact, like {artifact}.sha256."""
+    for suffix in SIDECAR_SUFFIXES:
+        src = pathlib.Path(f"{artifact}{suffix}")
+        if src.exists():
+            yield src, pathlib.Path(f"{destination}{suffix}")
+
+
+def fetch(key: str, destination) -> bool:
+    """
+    Place cached artifact as destination.
+    :param key: key from `package_key`,
+    :param destination: path of archive in build directory.
+    :return: True if it was in cache, False otherwise.
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return False
+    cached = cache_dir / f"{key}.zip"
+    try:
+        for src, dst in ((cached, destination), *_sidecars(cached, destination)):
+            staging.link_or_copy(src, dst, try_reflink=False)
+        os.utime(cached)  # mark as recently used
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        log.error(e)
+        return False
+    return True
+
+
+def store(key: str, artifact) -> bool:
+    """
+    Put built artifact to the cache. Other pipeline can store the same key at the same time,
+    so it is linked under temporary name and then renamed.
+    :return: True if stored, False otherwise.
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return False
+    tmp = cache_dir / f".{key}.{os.getpid()}.tmp"
+    cached = cache_dir / f"{key}.zip"
+    try:
+        for src, dst in _sidecars(artifact, cached):
+            staging.link_or_copy(src, tmp, try_reflink=False)
+            os.replace(tmp, dst)
+        staging.link_or_copy(artifact, tmp, try_reflink=False)
+        os.replace(tmp, cached)
+    except OSError as e:
+        log.error(e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def evict(max_size=None, max_age=None) -> int:
+    """
+    Remove artifacts older than max_age, then the least recently used until cache is smaller than max_size.
+    :param max_size: in bytes, default from settings,
+    :param max_age: in seconds, default from settings.
+    :return: number of bytes freed.
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return 0
+    max_size = settings.BUILD_CACHE_MAX_SIZE if max_size is None else max_size
+    max_age = settings.BUILD_CACHE_MAX_AGE if max_age is None else max_age
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith('.zip'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()  # the oldest first
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total <= max_size:
+            break
+        try:
+            os.unlink(path)
+            for suffix in SIDECAR_SUFFIXES:
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+        except OSError as e:
+            log.error(e)
+            continue
+        total -= size
+        freed += size
+    if freed:
+        log.info("Evicted {} bytes from build cache".format(freed))
+    return freed
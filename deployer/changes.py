@@ -0,0 +1,138 @@
+"""
+Analyzer of changes from `git diff`.
+Every changed path is split only once and put into index: package -> service directory -> changed files,
+so packages, services and services of one package are read from index without parsing diff again.
+Helpers in build module (get_packages_from_changes, get_services_from_changes) are views over it.
+"""
+import typing
+
+from . import settings, build
+from .git import Change, ChangeType
+
+
+class ChangeSet:
+    """
+    Index of changed paths built in one pass over lines of diff.
+    Using example:
+    change_set = ChangeSet.from_lines(build.get_changes_from_git_diff())
+    for package in change_set.packages():
+        services = change_set.services_of(package)
+    """
+    def __init__(self):
+        self.index = {}  # package -> {service directory -> [changed files]}
+        self.services_out_of_packages = {}  # service directory -> [changed files], for paths without package
+        self.deleted = {}  # package -> {service directory -> [deleted files]}, old paths of renames too
+        self.lines = 0
+
+    @classmethod
+    def from_lines(cls, lines: typing.Iterable):
+        change_set = cls()
+        for line in lines:
+            change_set.add(line)
+        return change_set
+
+    @classmethod
+    def from_changes(cls, changes: typing.Iterable):
+        """Build from git.Change records, i.e. streamed by `GitOperation.iter_diff_to_target_branch`."""
+        change_set = cls()
+        for change in changes:
+            change_set.add_change(change)
+        return change_set
+
+    @classmethod
+    def of(cls, changes):
+        """Return changes if it is ChangeSet already, build it from lines otherwise."""
+        if isinstance(changes, cls):
+            return changes
+        return cls.from_lines(changes)
+
+    def add(self, line: str) -> None:
+        """
+        Put one changed path to index.
+        Service directory is a folder of file with source code extension (see settings.SOURCE_CODE_EXT).
+        """
+        if not line:
+            return
+        self.lines += 1
+        parts = line.split('/')
+        packages = list(dict.fromkeys(part for part in parts if build.is_package(part)))
+        for package in packages:
+            self.index.setdefault(package, {})
+        if not line.endswith(settings.SOURCE_CODE_EXT):
+            return
+        service = line.rsplit('/', 1)[0] if len(parts) > 1 else ''
+        if not packages:
+            self.services_out_of_packages.setdefault(service, []).append(line)
+        for package in packages:
+            self.index[package].setdefault(service, []).append(line)
+
+    def add_change(self, change: Change) -> None:
+        """
+        Put one typed record to index. Deleted paths and old paths of renamed ones are not services to copy,
+        they are collected separately - see `removed_services`.
+        """
+        if change.type == ChangeType.DELETED:
+            self._add_deleted(change.path)
+            return
+        if change.type == ChangeType.RENAMED and change.old_path:
+            self._add_deleted(change.old_path)
+        self.add(change.path)
+
+    def _add_deleted(self, line: str) -> None:
+        self.lines += 1
+        parts = line.split('/')
+        packages = list(dict.fromkeys(part for part in parts if build.is_package(part)))
+        if not line.endswith(settings.SOURCE_CODE_EXT):
+            return
+        service = line.rsplit('/', 1)[0] if len(parts) > 1 else ''
+        for package in packages:
+            self.deleted.setdefault(package, {}).setdefault(service, []).append(line)
+
+    def removed_services(self, exists=None) -> dict:
+        """
+        Service directories from which source files were deleted and which are not in sources anymore.
+        :param exists: callable(service directory) -> bool, checking if directory is still in sources,
+        default: service has no other changed files in this diff.
+        :return: dict package -> sorted list of service directories.
+        """
+        removed = {}
+        for package, services in self.deleted.items():
+            if build.is_package_to_exclude(package):
+                continue
+            for service in services:
+                still_there = exists(service) if exists else service in self.index.get(package, {})
+                if not still_there:
+                    removed.setdefault(package, []).append(service)
+        return {package: sorted(services) for package, services in removed.items()}
+
+    def packages(self) -> set:
+        """Changed packages without these excluded in settings."""
+        return {package for package in self.index if not build.is_package_to_exclude(package)}
+
+    def services(self) -> set:
+        """All service directories with changed source files."""
+        services = set(self.services_out_of_packages)
+        for package_services in self.index.values():
+            services.update(package_services)
+        return services
+
+    def services_of(self, package: str) -> list:
+        """Service directories with changed source files in package."""
+        return list(self.index.get(package, {}))
+
+    def files_of(self, package: str, service: str) -> list:
+        return list(self.index.get(package, {}).get(service, []))
+
+
+def group_services_by_package(services: typing.Iterable, packages: typing.Iterable) -> dict:
+    """
+    Assign service directories to packages in one pass over services.
+    Service belongs to package if package name is one of parts of its path.
+    :return: dict package -> list of service directories, for every package from packages.
+    """
+    grouped = {package: [] for package in packages}
+    for service in services:
+        for part in set(service.split('/')):
+            if part in grouped:
+                grouped[part].append(service)
+    return grouped
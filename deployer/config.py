@@ -12,13 +12,14 @@ from . import errors, settings
 from .settings import log
 
 
-def get_env_var_or_default(name, default=None):
+def get_env_var_or_default(name, default=None, environ=None):
     """
     Get variable from shell environment or if not exists return default value.
     This if for variables whom are not required, and should not raise exception KeyError.
+    :param environ: mapping to search in instead of os.environ, i.e. from `get_host_environment`.
     """
     try:
-        return os.environ[name]
+        return (os.environ if environ is None else environ)[name]
     except KeyError:
         return default
 
@@ -41,14 +42,15 @@ def get_config_dir(env: str) -> pathlib.Path:
     return config_path
 
 
-def load_config(env: str, node: str) -> None:
+def read_config(env: str, node: str) -> dict:
     """
-    Load key=values from config to shell environment, so it will be accessible to others.
+    Read key=values from config without touching shell environment.
     Treat line started with '#' as comment line.
     :param env: configuration will be search in config_dir for that environment.
     :param node: name of file (node + ".cfg") to search config or "init.cfg" for general.
-    :return: None, throws exception `errors.LoadingConfigurationError` if something goes wrong.
+    :return: dict of variables, throws exception `errors.LoadingConfigurationError` if something goes wrong.
     """
+    variables = {}
     try:
         config = get_config_dir(env) / pathlib.Path(node + '.cfg')
         with open(config, 'r') as cfg:
@@ -56,12 +58,39 @@ def load_config(env: str, node: str) -> None:
             lines = filter(lambda x: not x.startswith('#'), lines)
             for line in lines:
                 key, value = line.split('=')
-                k, v = key.strip(), value.strip()
-                log.info(f"{k} = {v}")
-                os.environ[k] = v
+                variables[key.strip()] = value.strip()
     except (ValueError, OSError, FileNotFoundError, KeyError) as e:
         log.exception(e)
         raise errors.LoadingConfigurationError(env, node)
+    return variables
+
+
+def load_config(env: str, node: str) -> None:
+    """
+    Load key=values from config to shell environment, so it will be accessible to others.
+    Treat line started with '#' as comment line.
+    :param env: configuration will be search in config_dir for that environment.
+    :param node: name of file (node + ".cfg") to search config or "init.cfg" for general.
+    :return: None, throws exception `errors.LoadingConfigurationError` if something goes wrong.
+    """
+    for k, v in read_config(env, node).items():
+        log.info(f"{k} = {v}")
+        os.environ[k] = v
+
+
+def get_host_environment(env: str, node=None) -> dict:
+    """
+    Environment for one host - shell environment with configuration of environment and node on top of it.
+    Nothing is loaded to os.environ, so hosts handled at the same time do not overwrite each other.
+    :param env: environment name,
+    :param node: name of node config (without '.cfg') or None for hosts configured only by NODES.
+    :return: dict of variables, throws exception `errors.LoadingConfigurationError` if something goes wrong.
+    """
+    environ = dict(os.environ)
+    environ.update(read_config(env, 'init'))
+    if node:
+        environ.update(read_config(env, node))
+    return environ
 
 
 def load_configuration(env: str) -> bool:
@@ -0,0 +1,136 @@
+"""
+Multiplexed SSH connections - one master session per host for the whole job (OpenSSH ControlMaster).
+Every `ssh`/`scp` started later for that host goes through master's socket, so it does not pay
+TCP and key exchange handshake again. Masters are closed at exit of the process.
+Using example:
+connections.enable()
+ssh = remoter.SSHCommand.construct(host)  # options with ControlPath are added by construct
+"""
+import atexit
+import dataclasses
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import settings
+from .settings import log
+
+
+@dataclasses.dataclass
+class Master:
+    destination: str  # user@host
+    port: str
+    private_key_filename: str
+    control_path: str
+    handshake: float  # seconds of opening master
+    reused: int = 0
+
+
+class ConnectionManager:
+    """Keep one master connection per (user, host, port) and give options to use it."""
+    def __init__(self, persist=None):
+        self.persist = settings.SSH_CONTROL_PERSIST if persist is None else persist
+        self.enabled = False
+        self.control_dir = None
+        self.masters = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.host_locks = {}
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        # short path, unix sockets are limited to ~100 characters
+        self.control_dir = tempfile.mkdtemp(prefix="dpl-")
+        self.enabled = True
+        atexit.register(self.close_all)
+
+    def _open(self, username, host, port, private_key_filename):
+        name = hashlib.sha1(f"{username}@{host}:{port}".encode('utf-8')).hexdigest()[:16]
+        control_path = os.path.join(self.control_dir, name)
+        args = ["ssh", "-M", "-N", "-f",
+                "-o", "ControlMaster=yes",
+                "-o", f"ControlPersist={self.persist}",
+                "-o", f"ControlPath={control_path}",
+                "-o", "BatchMode=yes",
+                "-p", str(port), "-i", str(private_key_filename), f"{username}@{host}"]
+        started = time.monotonic()
+        try:
+            process = subprocess.run(args, capture_output=True, encoding='utf-8',
+                                     timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error(f"Cannot open master connection to {host}: {e}")
+            return None
+        if process.returncode != 0:
+            log.error(f"Cannot open master connection to {host}: {process.stderr.strip()}")
+            return None
+        master = Master(f"{username}@{host}", str(port), str(private_key_filename), control_path,
+                        time.monotonic() - started)
+        log.info("Master connection to {} opened in {:.2f} s".format(host, master.handshake))
+        return master
+
+    def options(self, host, port, username, private_key_filename) -> list:
+        """
+        Options for ssh/scp to go through master connection of host, master is opened at the first call.
+        :return: list of arguments, empty if multiplexing is disabled or master cannot be opened.
+        """
+        if not self.enabled:
+            return []
+        key = (username, host, str(port))
+        with self.lock:
+            host_lock = self.host_locks.setdefault(key, threading.Lock())
+        with host_lock:
+            master = self.masters.get(key)
+            if master:
+                master.reused += 1
+            elif key in self.failed:
+                return []
+            else:
+                master = self._open(username, host, port, private_key_filename)
+                if not master:
+                    self.failed.add(key)
+                    return []
+                self.masters[key] = master
+        return ["-o", f"ControlPath={master.control_path}"]
+
+    def report(self) -> str:
+        reused = sum(master.reused for master in self.masters.values())
+        handshakes = [master.handshake for master in self.masters.values()]
+        average = sum(handshakes) / len(handshakes) if handshakes else 0
+        return ("SSH multiplexing: {} master connection(s), {} command(s) reused them, "
+                "about {:.1f} s of handshakes saved".format(len(self.masters), reused, reused * average))
+
+    def close_all(self) -> None:
+        """Close all master connections and remove their sockets."""
+        if not self.enabled:
+            return
+        if self.masters:
+            log.info(self.report())
+        for master in self.masters.values():
+            try:
+                subprocess.run(["ssh", "-O", "exit", "-o", f"ControlPath={master.control_path}",
+                                "-p", master.port, master.destination],
+                               capture_output=True, timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+            except (OSError, subprocess.SubprocessError) as e:
+                log.error(e)
+        self.masters.clear()
+        self.failed.clear()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.enabled = False
+
+
+manager = ConnectionManager()
+
+
+def enable() -> None:
+    """Use multiplexed connections for all next ssh/scp commands of this process."""
+    manager.enable()
+
+
+def options(host, port, username, private_key_filename) -> list:
+    """Options for ssh/scp for host - see `ConnectionManager.options`."""
+    return manager.options(host, port, username, private_key_filename)
@@ -0,0 +1,105 @@
+"""
+Dependencies between packages read from their manifest.v3 (<record name="requires">).
+Packages are put into waves - every package of wave depends only on packages from earlier waves,
+so packages inside one wave can be built, transferred and activated concurrently.
+"""
+import pathlib
+import typing
+import xml.etree.ElementTree as ElementTree
+
+from . import config, errors
+from .settings import log
+
+MANIFEST_FILENAME = "manifest.v3"
+
+
+def read_requires(package: str, source_dir=None) -> set:
+    """
+    Names of packages required by package, like:
+    <record name="requires" javaclass="com.wm.util.Values"><value name="TpOssCommon">*.*</value></record>
+    :param package: name of package,
+    :param source_dir: where packages are, default from configuration.
+    :return: set of names, empty if there is no manifest or no requires.
+    """
+    source_dir = pathlib.Path(source_dir) if source_dir else config.get_source_dir()
+    manifest = source_dir / package / MANIFEST_FILENAME
+    try:
+        root = ElementTree.parse(manifest).getroot()
+    except FileNotFoundError:
+        return set()
+    except ElementTree.ParseError as e:
+        log.error(f"Cannot parse {manifest}: {e}")
+        return set()
+    requires = set()
+    for record in root.iter('record'):
+        if record.get('name') == 'requires':
+            requires.update(value.get('name') for value in record.findall('value') if value.get('name'))
+    return requires
+
+
+def build_graph(packages: typing.Iterable, source_dir=None) -> dict:
+    """
+    Graph of dependencies between given packages. Requirements out of packages (i.e. already installed
+    on IS, like WmPublic) are skipped.
+    :return: dict package -> set of packages it requires.
+    """
+    packages = set(packages)
+    return {package: (read_requires(package, source_dir) & packages) - {package} for package in packages}
+
+
+def topological_waves(graph: dict) -> list:
+    """
+    Split packages into waves - wave N contains packages which all dependencies are in waves < N.
+    :param graph: dict package -> set of packages it requires,
+    :return: list of sorted lists of packages.
+    :raise errors.DependencyCycleError: if packages depends on each other.
+    """
+    remaining = {package: set(requires) for package, requires in graph.items()}
+    waves = []
+    while remaining:
+        wave = sorted(package for package, requires in remaining.items() if not requires)
+        if not wave:
+            raise errors.DependencyCycleError("Cycle in dependencies of packages: {}"
+                                              .format(', '.join(sorted(remaining))))
+        waves.append(wave)
+        for package in wave:
+            del remaining[package]
+        for requires in remaining.values():
+            requires.difference_update(wave)
+    return waves
+
+
+def critical_path(graph: dict, weights=None) -> tuple:
+    """
+    The longest chain of dependent packages - it determines minimal time of deploy even with unlimited parallelism.
+    :param graph: dict package -> set of packages it requires,
+    :param weights: dict package -> cost (i.e. size or time), default 1 for each package,
+    :return: (length, list of packages from the first to deploy to the last).
+    """
+    weights = weights or {}
+    longest = {}  # package -> (length of the longest chain ending on it, previous package)
+    for wave in topological_waves(graph):
+        for package in wave:
+            previous = max(graph[package], key=lambda p: longest[p][0], default=None)
+            length = (longest[previous][0] if previous else 0) + weights.get(package, 1)
+            longest[package] = (length, previous)
+    if not longest:
+        return 0, []
+    package = max(sorted(longest), key=lambda p: longest[p][0])
+    length = longest[package][0]
+    path = []
+    while package:
+        path.append(package)
+        package = longest[package][1]
+    return length, path[::-1]
+
+
+def format_plan(graph: dict) -> str:
+    """Human readable plan - waves and critical path."""
+    waves = topological_waves(graph)
+    length, path = critical_path(graph)
+    lines = [f"Packages: {len(graph)}, waves: {len(waves)}"]
+    for number, wave in enumerate(waves, start=1):
+        lines.append(f"wave {number} ({len(wave)}): {', '.join(wave)}")
+    lines.append(f"critical path ({length}): {' -> '.join(path)}")
+    return '\n'.join(lines)
@@ -19,3 +19,7 @@ class LackRequiredConfiguration(BaseDeployerError):
 
 class RemoteCommandError(BaseDeployerError):
     pass
+
+
+class DependencyCycleError(BaseDeployerError):
+    pass
@@ -0,0 +1,137 @@
+"""
+Fan-out distribution of build to hosts. Runner sends packages only to one seed node per zone (ZONE of node config),
+then nodes which already have them copy to their peers node-to-node in a tree of bounded degree.
+Egress of runner is about one copy per zone instead of one per host.
+If a seed or a copy between nodes fails, host gets packages directly from runner.
+"""
+import collections
+import concurrent.futures
+import os
+import shlex
+import subprocess
+import time
+import typing
+
+from . import config, fleet, remoter, sender, settings
+from .settings import log
+
+
+def group_by_zone(hosts: typing.Iterable, environments: dict) -> dict:
+    """:return: dict zone (None for hosts without zone) -> sorted hosts."""
+    zones = collections.defaultdict(list)
+    for host in sorted(hosts):
+        zones[environments[host].get(settings.ZONE_ENV_VAR)].append(host)
+    return dict(zones)
+
+
+def plan_tree(hosts: list, degree: int) -> dict:
+    """
+    Tree of copies - the first host is the seed, every host copies to at most `degree` next ones.
+    :return: dict host -> parent host (None for seed), in order of hosts, parents before their children.
+    """
+    degree = max(1, degree)
+    return {host: hosts[(index - 1) // degree] if index else None for index, host in enumerate(hosts)}
+
+
+def get_artifacts(ref, inbound=False) -> list:
+    """Names of what is distributed from build directory - ZIP-s for inbound, package directories otherwise."""
+    build_dir = config.get_build_dir(ref)
+    if inbound:
+        return sorted(e.name for e in os.scandir(build_dir) if e.is_file() and e.name.endswith('.zip'))
+    return sorted(e.name for e in os.scandir(build_dir) if e.is_dir())
+
+
+def get_target_dir(environ, inbound=False) -> str:
+    """Where artifacts are placed at host - inbound directory or packages repository."""
+    if inbound:
+        return environ[settings.INBOUND_DIR_ENV_VAR]
+    return os.path.join(environ[settings.IS_DIR_ENV_VAR], "packages")
+
+
+def relay(parent, child, names, parent_environ, child_environ, inbound=False) -> bool:
+    """
+    Copy artifacts from parent to child - tar at parent is piped to ssh from parent to child (by bash with pipefail,
+    so failure of any side fails the copy), extracted there like `sender.TarCommand` does (atomically).
+    :param names: artifacts (see `get_artifacts`),
+    :param parent_environ: configuration of parent host, PEER_PRIVKEY is a key at parent for connecting to child,
+    :param child_environ: configuration of child host,
+    :return: True if copied, False otherwise.
+    """
+    try:
+        source_dir = get_target_dir(parent_environ, inbound)
+        target_dir = get_target_dir(child_environ, inbound)
+        child_port = config.get_env_var_or_default(settings.SSH_PORT_ENV_VAR, default='22', environ=child_environ)
+        child_user = child_environ[settings.IS_NODE_USERNAME_ENV_VAR]
+    except KeyError as e:
+        log.error(f"Lack of configuration for copying from {parent} to {child}: {e}")
+        return False
+    peer_key = parent_environ.get(settings.PEER_PRIVKEY_ENV_VAR)
+    child_ssh = ["ssh", "-o", "BatchMode=yes", "-p", str(child_port)]
+    if peer_key:
+        child_ssh += ["-i", peer_key]
+    child_ssh += [f"{child_user}@{child}", sender.TarCommand.extract_script(target_dir)]
+    pipeline = "tar -C {} -chf - -- {} | {}".format(shlex.quote(source_dir), ' '.join(map(shlex.quote, names)),
+                                                    ' '.join(map(shlex.quote, child_ssh)))
+    # without pipefail failed tar (i.e. missing artifact at parent) ends with status of ssh - partial copy as success
+    command = "bash -o pipefail -c " + shlex.quote(pipeline)
+    ssh = remoter.SSHCommand.construct(parent, parent_environ)
+    if not ssh:
+        log.error("Cannot construct SSH client.")
+        return False
+    try:
+        process = subprocess.run(ssh.args(command), capture_output=True, encoding='utf-8',
+                                 timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        log.error(f"Copying from {parent} to {child} failed: {e}")
+        return False
+    if process.returncode != 0:
+        log.error(f"Copying from {parent} to {child} failed: {process.stderr.strip()}")
+        return False
+    return True
+
+
+def distribute(hosts: typing.Iterable, environments: dict, upload: typing.Callable, copy: typing.Callable,
+               degree=None, parallel=1) -> dict:
+    """
+    Deliver packages to every host - from runner to seed of each zone, then between nodes.
+    :param hosts: hosts to deliver to,
+    :param environments: dict host -> its configuration (ZONE is read from it),
+    :param upload: callable(host) -> bool sending from runner,
+    :param copy: callable(parent, child) -> bool copying between nodes,
+    :param degree: how many peers each node copies to, default from settings,
+    :param parallel: how many transfers of one zone at the same time (zones go concurrently),
+    :return: dict host -> fleet.HostResult with step 'send' and source in message.
+    """
+    degree = degree or settings.FANOUT_DEGREE
+    zones = group_by_zone(hosts, environments)
+
+    def deliver(host, parent, results):
+        started = time.monotonic()
+        if parent is not None and results[parent].ok:
+            if copy(parent, host):
+                return fleet.HostResult(host, True, 'send', time.monotonic() - started, f"from {parent}")
+            log.error(f"Copying from {parent} to {host} failed - sending directly from runner")
+        ok = upload(host)
+        return fleet.HostResult(host, ok, 'send', time.monotonic() - started, "from runner")
+
+    def deliver_zone(zone_hosts):
+        results = {}
+        tree = plan_tree(zone_hosts, degree)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            # hosts of the same depth go together, each needs only its parent done
+            level = [zone_hosts[0]]
+            while level:
+                futures = {host: executor.submit(deliver, host, tree[host], results) for host in level}
+                for host, future in futures.items():
+                    results[host] = future.result()
+                level = [host for host, parent in tree.items() if parent in futures]
+        return results
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(zones))) as executor:
+        for zone_results in executor.map(deliver_zone, zones.values()):
+            results.update(zone_results)
+    from_runner = sum(1 for result in results.values() if result.message == "from runner")
+    log.info("Fan-out: {} host(s) in {} zone(s), {} copies sent from runner".format(
+        len(results), len(zones), from_runner))
+    return results
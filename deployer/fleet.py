@@ -0,0 +1,147 @@
+"""
+Operations on many hosts of environment at once.
+Inventory is collected from node configs (*.cfg with SSH_ADDRESS) and NODES variable,
+every host gets its own copy of configuration, so hosts handled concurrently do not share os.environ.
+"""
+import concurrent.futures
+import dataclasses
+import time
+import typing
+
+from . import config, errors, remoter, settings
+from .settings import log
+
+
+@dataclasses.dataclass
+class HostResult:
+    host: str
+    ok: bool
+    step: str = ''  # the last step done, or the step which failed
+    duration: float = 0.0  # in seconds
+    message: str = ''
+
+
+def get_inventory(env: str, zone=None) -> dict:
+    """
+    Collect hosts of environment.
+    Hosts from node configs must have SSH_ADDRESS set, hosts from NODES use only configuration of environment.
+    :param env: environment name,
+    :param zone: if set, only hosts from node configs with the same ZONE are taken (NODES are skipped).
+    :return: dict host -> name of node config or None for hosts only from NODES.
+    :raise errors.LoadingConfigurationError: if some config cannot be read or two nodes have the same address.
+    """
+    inventory = {}
+    for filename in config.find_node_configs(env):
+        node_name = filename[:-len('.cfg')]
+        node_config = config.read_config(env, node_name)
+        try:
+            address = node_config[settings.SSH_ADDRESS_ENV_VAR]
+        except KeyError:
+            raise errors.LoadingConfigurationError(f"There is no {settings.SSH_ADDRESS_ENV_VAR} in {filename}")
+        if address in inventory:
+            raise errors.LoadingConfigurationError(f"The same address {address} for two nodes.")
+        if zone and node_config.get(settings.ZONE_ENV_VAR) != zone:
+            continue
+        inventory[address] = node_name
+    if not zone:
+        nodes = config.read_config(env, 'init').get(settings.NODES_ENV_VAR) \
+            or config.get_env_var_or_default(settings.NODES_ENV_VAR, default='')
+        for host in filter(None, map(str.strip, nodes.split(','))):
+            inventory.setdefault(host, None)
+    return inventory
+
+
+def get_host_environments(env: str, inventory: dict) -> dict:
+    """:return: dict host -> its own environment (see `config.get_host_environment`)."""
+    return {host: config.get_host_environment(env, node) for host, node in inventory.items()}
+
+
+def run_on_hosts(hosts: typing.Iterable, operation: typing.Callable, parallel=1, fail_fast=True) -> dict:
+    """
+    Run operation(host) -> HostResult for every host, at most `parallel` at once.
+    :param hosts: hosts in order of start,
+    :param operation: callable which gets host and returns HostResult, exceptions are turned into failed results,
+    :param parallel: how many hosts at the same time,
+    :param fail_fast: flag for not starting next hosts after the first failure (running ones are finished).
+    :return: dict host -> HostResult in order of hosts.
+    """
+    hosts = list(hosts)
+    results = {}
+
+    def guarded(host):
+        started = time.monotonic()
+        try:
+            result = operation(host)
+        except Exception as e:
+            log.exception(e)
+            result = HostResult(host, False, message=str(e))
+        if not result.duration:
+            result.duration = time.monotonic() - started
+        return result
+
+    waiting = list(reversed(hosts))
+    running = set()
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        while running or (waiting and not (failed and fail_fast)):
+            # hosts are submitted only when there is a free slot, so after failure nothing new is started
+            while waiting and len(running) < max(1, parallel) and not (failed and fail_fast):
+                running.add(executor.submit(guarded, waiting.pop()))
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[result.host] = result
+                if not result.ok:
+                    failed = True
+                    log.error("Host {} failed at step '{}': {}".format(result.host, result.step, result.message))
+    for host in hosts:
+        if host not in results:
+            results[host] = HostResult(host, False, 'skipped', message="not started after failure of other host")
+    return {host: results[host] for host in hosts}
+
+
+def run_steps(host, steps, environ=None) -> HostResult:
+    """
+    Run steps in one remote session at host, see `remoter.run_session`.
+    :param steps: list of (name, shell snippet),
+    :return: HostResult of the last step done or of the step which failed (with the end of its output).
+    """
+    results = remoter.run_session(host, steps, environ)
+    duration = sum(result.seconds for result in results)
+    for result in results:
+        if not result.ok:
+            return HostResult(host, False, result.step, duration,
+                              result.output.strip()[-200:] or f"exit code {result.code}")
+    if len(results) < len(steps):
+        return HostResult(host, False, steps[len(results)][0], duration, "session ended before step")
+    return HostResult(host, True, results[-1].step if results else '', duration)
+
+
+def run_command(host, command, environ=None, timeout=None) -> HostResult:
+    """
+    Run shell command at host, its output is logged line by line with host as prefix (see `remoter.run_session`).
+    :param timeout: seconds for command, default settings.EXEC_TIMEOUT, then it is killed,
+    :return: HostResult with exit code in message.
+    """
+    results = remoter.run_session(host, [("exec", command)], environ, timeout or settings.EXEC_TIMEOUT)
+    if not results:
+        return HostResult(host, False, 'exec', message="no exit code (timeout or connection failed)")
+    return HostResult(host, results[0].ok, 'exec', message=f"exit code {results[0].code}")
+
+
+def summarize_messages(results: dict) -> str:
+    """Hosts grouped by message of their results, i.e. by exit codes."""
+    groups = {}
+    for result in results.values():
+        groups.setdefault(result.message, []).append(result.host)
+    return '\n'.join("{} - {} host(s): {}".format(message or "no message", len(hosts), ', '.join(hosts))
+                     for message, hosts in sorted(groups.items()))
+
+
+def format_results(results: dict) -> str:
+    """Table with result for every host."""
+    lines = ["{:<20} {:<6} {:<16} {:>9}  {}".format("host", "result", "step", "seconds", "message")]
+    for result in results.values():
+        lines.append("{:<20} {:<6} {:<16} {:>9.1f}  {}".format(result.host, "OK" if result.ok else "FAILED",
+                                                               result.step, result.duration, result.message))
+    return '\n'.join(lines)
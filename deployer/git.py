@@ -1,11 +1,61 @@
 """Set of git operations"""
 import dataclasses
+import enum
 import subprocess
+import tempfile
+import typing
 
 from . import errors, settings
 from .settings import log
 
 
+class ChangeType(enum.Enum):
+    ADDED = 'A'
+    MODIFIED = 'M'
+    DELETED = 'D'
+    RENAMED = 'R'
+    COPIED = 'C'
+
+
+@dataclasses.dataclass(frozen=True)
+class Change:
+    """One record of `git diff --name-status`, old_path is set for renamed and copied paths."""
+    type: ChangeType
+    path: str
+    old_path: typing.Optional[str] = None
+
+
+def parse_name_status(chunks: typing.Iterable) -> typing.Iterator:
+    """
+    Parse output of `git diff -z --name-status` given in chunks of any size.
+    Fields are separated by NUL: status, path - or status, old path, new path for renames and copies.
+    :param chunks: iterable of str with output,
+    :return: iterator of Change, yielded as soon as record is complete.
+    """
+    rest = ''
+    status = None
+    paths = []
+    for chunk in chunks:
+        fields = (rest + chunk).split('\0')
+        rest = fields.pop()  # not finished field
+        for field in fields:
+            if status is None:
+                status = field
+                continue
+            paths.append(field)
+            letter = status[:1]
+            if letter in ('R', 'C') and len(paths) < 2:
+                continue
+            if letter in ('R', 'C'):
+                yield Change(ChangeType(letter), paths[1], paths[0])
+            elif letter in ('A', 'D'):
+                yield Change(ChangeType(letter), paths[0])
+            else:  # M, T (type changed), U (unmerged) - content should be taken again
+                yield Change(ChangeType.MODIFIED, paths[0])
+            status = None
+            paths = []
+
+
 class GitOperation:
     # def __init__(self):
     #     """Set up credentials for runner."""
@@ -17,22 +67,56 @@ class GitOperation:
         """
         Compare changes between merging branches - new (detached commit) and target.
         :param target_branch_name: where source will be merged,
-        :return: list of paths whose changed.
+        :return: list of paths whose changed (new paths for renamed).
+        """
+        return [change.path for change in GitOperation.iter_diff_to_target_branch(target_branch_name)]
+
+    @staticmethod
+    def iter_diff_to_target_branch(target_branch_name, chunk_size=64 * 1024) -> typing.Iterator:
+        """
+        Stream changes between merging branches - new (detached commit) and target,
+        records are yielded while git is still producing the diff.
+        :param target_branch_name: where source will be merged,
+        :param chunk_size: how many bytes of output read at once,
+        :return: iterator of Change - added, modified, deleted and renamed paths.
+        :raise errors.GitOperationError: if git cannot be run or ends with error (after records already yielded).
         """
-        changes = []
-        command_args = 'git diff --name-only remotes/origin/{}'.format(target_branch_name).split(' ')
+        command_args = ['git', 'diff', '-z', '--name-status', '-M', f'remotes/origin/{target_branch_name}']
         try:
-            pc = subprocess.run(command_args, capture_output=True, encoding='utf-8')
-            if pc.returncode != 0:
-                log.info(pc.stdout)
-                log.error(pc.stderr)
-            output_lines = pc.stdout.split('\n')
-            # how filter works: https://docs.python.org/3/library/functions.html#filter
-            changes = list(filter(None, output_lines))
-        except Exception as e:
+            # stderr goes to file, so git never blocks on it while stdout is read
+            with tempfile.TemporaryFile() as stderr, \
+                    subprocess.Popen(command_args, stdout=subprocess.PIPE, stderr=stderr, encoding='utf-8') as process:
+                yield from parse_name_status(iter(lambda: process.stdout.read(chunk_size), ''))
+                process.wait()
+                stderr.seek(0)
+                error = stderr.read().decode('utf-8', 'replace').strip()
+        except OSError as e:
             log.exception(e)
             raise errors.GitOperationError(e) from None
-        return changes
+        if process.returncode != 0:
+            raise errors.GitOperationError(f"git diff to {target_branch_name} failed ({process.returncode}): {error}")
+
+    @staticmethod
+    def tree_hash(repo_dir, path):
+        """
+        Hash of git tree object of path at HEAD - the same content gives the same hash.
+        :param repo_dir: directory of repository (or inside of it),
+        :param path: path relative to repo_dir, i.e. packages/TpOssSomething,
+        :return: hash of tree or None if path has local changes or is not tracked.
+        """
+        try:
+            status = subprocess.run(['git', '-C', str(repo_dir), 'status', '--porcelain', '--', str(path)],
+                                    capture_output=True, encoding='utf-8', timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+            if status.returncode != 0 or status.stdout.strip():
+                return None
+            rev = subprocess.run(['git', '-C', str(repo_dir), 'rev-parse', f'HEAD:./{path}'],
+                                 capture_output=True, encoding='utf-8', timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+            if rev.returncode != 0:
+                return None
+            return rev.stdout.strip() or None
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error(e)
+            return None
 
 
 # import http.client as client
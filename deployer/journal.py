@@ -0,0 +1,124 @@
+"""
+Journal of deploy - append-only file deploy_journal.jsonl in build directory, one JSON record per line:
+{"time", "job", "build", "host", "step", "status", "duration", "bytes", "done", "message"}.
+Records are appended under exclusive file lock, so parallel deploys and other jobs deploying the same build
+never lose each other's records (instead of rewriting cicd_version.json for each host).
+Journal keeps index of hosts already deployed, updated by reading only records appended since the last read.
+Build directory is reused by next builds of the same merge request, so only records of the same build
+(see `manifest.build_id`) make host done - hosts are deployed again after rebuild.
+Using example:
+journal = Journal(build_dir, build=manifest.build_id(manifest.read_manifest(build_dir)))
+if not journal.is_done(host):
+    ...
+    journal.append(host, 'is_instance', 'ok', duration, done=True)
+"""
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows - only threads of one process are synchronized
+    fcntl = None
+
+from . import config
+from .settings import log
+
+JOURNAL_FILENAME = "deploy_journal.jsonl"
+
+
+@contextlib.contextmanager
+def locked(f, exclusive=True):
+    """Hold file lock of open file f."""
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        yield f
+    finally:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class Journal:
+    def __init__(self, build_dir, legacy_hosts=(), build=''):
+        """
+        :param build_dir: directory of build, journal is kept there,
+        :param legacy_hosts: hosts deployed before journal existed (i.e. from cicd_version.json), taken as done,
+        :param build: identity of build, records of other builds in the same directory do not make host done.
+        """
+        self.path = pathlib.Path(build_dir) / JOURNAL_FILENAME
+        self.job = config.get_env_var_or_default("CI_JOB_ID", default=str(os.getpid()))
+        self.build = build
+        self.lock = threading.Lock()
+        self.offset = 0  # bytes of file already read into index
+        self.last = {}  # host -> the last record
+        self.done = set(legacy_hosts)
+
+    def _index(self, record) -> None:
+        host = record.get("host")
+        if not host or record.get("build", '') != self.build:
+            return
+        self.last[host] = record
+        if record.get("done") and record.get("status") == "ok":
+            self.done.add(host)
+        elif record.get("status") in ("started", "failed"):
+            self.done.discard(host)  # deployed again, not finished yet
+
+    def refresh(self) -> None:
+        """Read records appended since the last read (also by other processes)."""
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f, locked(f, exclusive=False):
+                    f.seek(self.offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            # only whole lines, the last one may be still written by process without lock (i.e. on Windows)
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                try:
+                    self._index(json.loads(line))
+                except ValueError:
+                    log.error(f"Broken record in {self.path}: {line[:100]!r}")
+            self.offset += end
+
+    def append(self, host, step, status, duration=0.0, size=0, done=False, message='') -> dict:
+        """
+        Append record of host.
+        :param step: step of deploy, i.e. 'send', 'is_instance', 'check start',
+        :param status: 'ok', 'failed' or 'started',
+        :param duration: seconds of step,
+        :param size: bytes sent,
+        :param done: flag for the last step of host - host with done ok record is not deployed again,
+        :return: the record.
+        """
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "job": self.job, "build": self.build, "host": host,
+                  "step": step, "status": status, "duration": round(duration, 3), "bytes": size, "done": done,
+                  "message": message}
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with open(self.path, 'ab') as f, locked(f):
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.refresh()
+        return record
+
+    def is_done(self, host) -> bool:
+        """Check if host was deployed already, by this or any other process."""
+        self.refresh()
+        return host in self.done
+
+    def done_hosts(self) -> set:
+        self.refresh()
+        return set(self.done)
+
+    def records(self) -> list:
+        """All records of journal in order of appending."""
+        try:
+            with open(self.path, 'rb') as f, locked(f, exclusive=False):
+                return [json.loads(line) for line in f if line.endswith(b'\n')]
+        except FileNotFoundError:
+            return []
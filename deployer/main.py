@@ -2,16 +2,24 @@
 General module to make actions.
 'test' - do nothing, should do some tests by means IntegrationServer and catch developers mistakes;
 'deploy' - prepare backup and packages in packages/ directory of IS in environment and run 'is_instance update' script;
-'backup' - not implemented yet, revert changes by use created backup;
+'backup' - snapshot packages of instances at all hosts (see `backup`), without any transfer;
+'rollback' - put the newest snapshot (or the one set by --snapshot) back in place of packages at all hosts;
 'build' - only prepare packages in 'packages/' directory on IS-es or in inbound if flag is set.
-'stop' - not implemented, stop all instance from environment;
+'plan' - show waves of packages which can be deployed concurrently (by dependencies from manifest.v3);
+'stop', 'start' - shutdown or startup of instances at all hosts at the same time (start waits for readiness);
+'clean' - remove packages from packages repository of IS at all hosts at the same time;
+'exec' - run shell command set by --command at all hosts at the same time;
 """
 import os
 import pathlib
 import sys
 import argparse
+import dataclasses
+import time
 
-from . import (config, errors, sender, settings, build, remoter)
+from . import (config, errors, sender, settings, build, remoter, cache, dependencies, manifest, fleet, fanout,
+               connections, transfers, readiness, rollout, journal, backup, preflight)
+from . import changes as changes_module
 from .settings import log
 
 
@@ -26,13 +34,80 @@ def build_arguments(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('action',
                         help="possible options for action are: 'test', 'inbound', 'build', 'deploy', 'backup'"
-                             ", 'stop'")
+                             ", 'rollback', 'stop', 'start', 'clean', 'exec', 'benchmark', 'plan'")
     parser.add_argument('--package', nargs='+', action='extend', help="A list of packages to build archives for.")
     parser.add_argument('--no-changes-only', action='store_false',
                         help="Use this flag if you want to deploy all* packages\n*Without excluded packages {}"
                         .format(settings.PACKAGES_TO_EXCLUDE))
     parser.add_argument('--inbound', action='store_true', help="Use it if you want to load package from inbound.")
     parser.add_argument("--with-restart", action='store_true', help="Use if you want to restart server in deploy")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes building inbound archives, default number of CPUs.")
+    parser.add_argument("--reproducible", action='store_true', default=settings.REPRODUCIBLE_ARCHIVES,
+                        help="Build byte-identical archives for the same content and write sha256 next to them.")
+    parser.add_argument("--staging", choices=['copy', 'link'], default=settings.STAGING_MODE,
+                        help="'link' builds packages for is_instance from reflinks/hardlinks instead of copies.")
+    parser.add_argument("--parallel", type=int, default=None,
+                        help="How many hosts are deployed at the same time (default {}, for stop, start, clean,"
+                             " backup and rollback {}).".format(settings.DEPLOY_PARALLEL, settings.FLEET_PARALLEL))
+    parser.add_argument("--continue-on-error", action='store_true',
+                        help="Deploy the rest of hosts when one of them failed (default: stop starting new ones).")
+    parser.add_argument("--backup", action='store_true', default=settings.BACKUP_BEFORE_DEPLOY,
+                        help="Snapshot packages of instance at every host before is_instance (see action 'rollback').")
+    parser.add_argument("--snapshot", default=None,
+                        help="Name of snapshot restored by 'rollback', default the newest one at each host.")
+    parser.add_argument("--command", default=None, help="Shell command run at every host by action 'exec'.")
+    parser.add_argument("--timeout", type=float, default=settings.EXEC_TIMEOUT,
+                        help="Seconds for command of 'exec' at one host, then it is killed.")
+    parser.add_argument("--skip-preflight", dest='preflight', action='store_false', default=settings.PREFLIGHT,
+                        help="Deploy without checking all hosts first (connection, ssh key, IS directory, free space).")
+    parser.add_argument("--redeploy", action='store_true',
+                        help="Deploy to inbound also hosts which deploy journal of this build records as done.")
+    parser.add_argument("--multiplex", action='store_true', default=settings.SSH_MULTIPLEX,
+                        help="Open one SSH master connection per host and reuse it for all commands and transfers.")
+    parser.add_argument("--transfer", choices=['scp', 'tar', 'delta', 'resumable', 'store'],
+                        default=settings.TRANSFER_METHOD,
+                        help="'tar' sends packages to repository as one stream over ssh instead of scp -r per package,"
+                             " 'delta' sends only files which differ from files already at host,"
+                             " 'resumable' sends large files in chunks, retry continues from the last sent chunk,"
+                             " 'store' keeps versions of packages in package store of host and links them to"
+                             " repository, versions host already has are not sent.")
+    parser.add_argument("--delete-stale", action='store_true', default=settings.TRANSFER_DELETE_STALE,
+                        help="With --transfer delta remove files of sent packages which are not in build"
+                             " (use with --no-changes-only).")
+    parser.add_argument("--compress-transfer", action='store_true', default=settings.TRANSFER_COMPRESS,
+                        help="Gzip tar stream of packages (with --transfer tar).")
+    parser.add_argument("--max-transfers", type=int, default=None,
+                        help="How many transfers from runner at the same time, default {}.".format(
+                            settings.TRANSFER_MAX_CONCURRENT))
+    parser.add_argument("--zone-bandwidth", nargs='+', default=[], metavar="ZONE=MiB/s",
+                        help="Bandwidth cap of transfers to hosts of zone, i.e. dc2=20.")
+    parser.add_argument("--session", action='store_true', default=settings.REMOTE_SESSION,
+                        help="Run shutdown, is_instance and startup at host by one script in one ssh session.")
+    parser.add_argument("--http-check", action='store_true', default=settings.READINESS_HTTP,
+                        help="After restart wait for ping service of IS over HTTP, not only for open port.")
+    parser.add_argument("--rollout", action='store_true',
+                        help="Deploy whole environment in waves - canary host(s), then zone by zone"
+                             " with health checks.")
+    parser.add_argument("--canary", type=int, default=settings.ROLLOUT_CANARY,
+                        help="Hosts deployed in the first wave of rollout, 0 - no canary.")
+    parser.add_argument("--wave-parallel", type=int, default=None,
+                        help="Hosts of one wave deployed at the same time, default --parallel.")
+    parser.add_argument("--max-failures", type=int, default=0,
+                        help="Failed hosts of wave which still let rollout continue.")
+    parser.add_argument("--bake-time", type=float, default=settings.ROLLOUT_BAKE_TIME,
+                        help="Seconds to wait after wave before checking its hosts again.")
+    parser.add_argument("--zone-order", nargs='+', default=None, help="Zones deployed first in rollout.")
+    parser.add_argument("--fanout", action='store_true',
+                        help="Send packages only to one seed host per zone, the rest copy them node-to-node.")
+    parser.add_argument("--fanout-degree", type=int, default=settings.FANOUT_DEGREE,
+                        help="How many peers every host copies packages to in fan-out.")
+    parser.add_argument("--deflate-level", type=int, choices=range(10), default=settings.ARCHIVE_COMPRESS_LEVEL,
+                        metavar="0-9", help="Deflate level for not compressed files in inbound archives.")
+    parser.add_argument("--store-ext", nargs='+', default=list(settings.ARCHIVE_STORED_EXT),
+                        help="Extensions of files stored in inbound archives without compression.")
+    parser.add_argument("--levels", nargs='+', type=int, choices=range(10), default=[0, 1, 6, 9], metavar="0-9",
+                        help="Deflate levels compared by 'benchmark' action.")
 
     # this below arg should be fetched from environment variable set by runner
     # parser.add_argument('tag_name', 'store_value', help='Tag name or commit from Git repository')
@@ -40,11 +115,28 @@ def build_arguments(args=None):
     return parser.parse_args(args)
 
 
-def action_build(inbound=False, changes_only=True) -> bool:
+def parse_zone_bandwidth(values) -> dict:
+    """:return: dict zone -> MiB/s from list like ['dc1=50', 'dc2=20']."""
+    bandwidth = {}
+    for value in values:
+        zone, _, mib = value.partition('=')
+        try:
+            bandwidth[zone] = float(mib)
+        except ValueError:
+            raise ValueError(f"Wrong bandwidth of zone '{value}', expected ZONE=MiB/s")
+    return bandwidth
+
+
+def action_build(inbound=False, changes_only=True, workers=None, reproducible=False, policy=None,
+                 link=False) -> bool:
     """
     Build packages or link to directory build_$settings.PIPELINE_REFERENCE for deploy.
     :param inbound: flag whether packages should be packed in zip archive,
-    :param changes_only: flag for determine if only packages with changes should be taken into account.
+    :param changes_only: flag for determine if only packages with changes should be taken into account,
+    :param workers: number of processes building archives for inbound,
+    :param reproducible: flag whether archives for inbound should be byte-identical for the same content,
+    :param policy: build.CompressionPolicy for archives for inbound,
+    :param link: flag for staging packages for is_instance by reflinks/hardlinks instead of copies.
     :return: True if good, False otherwise.
     """
     ref = os.environ[settings.PIPELINE_REFERENCE]
@@ -64,14 +156,20 @@ def action_build(inbound=False, changes_only=True) -> bool:
         else:
             log.info("Get all packages from repository without this excluded from settings")
             packages = build.get_all_package()
-        for package in packages:
-            if build.build_package_for_inbound(package, ref):
-                log.info("Built {} successfully".format(package))
-            else:
-                log.error("Built {} failed".format(package))
+        waves = get_waves(packages)
+        if waves is None:
+            return False
+        for number, wave in enumerate(waves, start=1):
+            log.info("Building wave {}/{}: {}".format(number, len(waves), ', '.join(wave)))
+            if not build.build_packages_for_inbound(wave, ref, workers, reproducible, policy):
+                cache.evict()
                 return False
+        cache.evict()
     elif not changes_only:
         packages = build.get_all_package()
+        waves = get_waves(packages)
+        if waves is None:
+            return False
         sources_dir = config.get_source_dir()
         for package in packages:
             source_dir = sources_dir / pathlib.Path(package)
@@ -79,21 +177,94 @@ def action_build(inbound=False, changes_only=True) -> bool:
             os.symlink(source_dir, destination_dir, target_is_directory=True)
     else:
         log.info("Set up build for is_instance script deploying.")
-        changes = build.get_changes_from_git_diff(settings.mock)
-        if not changes:
+        change_set = changes_module.ChangeSet.from_changes(build.get_change_records_from_git_diff(settings.mock))
+        if not change_set.lines:
             log.info("There were not changes")
             return False
-        services = build.get_services_from_changes(changes)
-        packages = build.get_packages_from_changes(changes)
+        services = change_set.services()
+        packages = change_set.packages()
+        repo_dir = config.get_source_dir().parent
+        removed = change_set.removed_services(exists=lambda service: (repo_dir / service).is_dir())
+        waves = get_waves(packages)
+        if waves is None:
+            return False
         try:
-            build.build_packages_for_is_instance(build_dir, packages, services)
+            for wave in waves:
+                build.build_packages_for_is_instance(build_dir, wave, services, link)
+            if removed:
+                log.info("Services removed from packages: {}".format(removed))
+                build.write_removed_services(build_dir, removed)
         except Exception as e:
             log.error(e)
             return False
+    try:
+        build.write_waves(build_dir, waves)
+        manifest.write_manifest(build_dir)
+    except OSError as e:
+        log.error(e)
+        return False
+    return True
+
+
+def get_waves(packages):
+    """
+    Waves of packages by their dependencies (see `dependencies`) - packages are built and activated wave by wave.
+    :return: list of lists of packages, None if packages depend on each other.
+    """
+    try:
+        waves = dependencies.topological_waves(dependencies.build_graph(packages))
+    except errors.DependencyCycleError as e:
+        log.error(e)
+        return None
+    log.info("Packages in {} wave(s) by dependencies".format(len(waves)))
+    return waves
+
+
+def action_benchmark(packages=None, levels=(0, 1, 6, 9), stored_extensions=None) -> bool:
+    """
+    Report size of archive against time of building it, for each package and deflate level.
+    :param packages: packages to check, default all packages from repository,
+    :param levels: deflate levels to compare,
+    :param stored_extensions: extensions which are not compressed.
+    :return: True if good, False otherwise.
+    """
+    packages = packages or build.get_all_package()
+    try:
+        results = build.benchmark_compression(packages, levels, stored_extensions)
+    except OSError as e:
+        log.error(e)
+        return False
+    print("{:<40} {:>5} {:>14} {:>14} {:>7} {:>9}".format("package", "level", "source bytes", "archive bytes",
+                                                          "ratio", "seconds"))
+    for row in results:
+        ratio = row['size'] / row['source size'] if row['source size'] else 0
+        print("{:<40} {:>5} {:>14} {:>14} {:>7.3f} {:>9.3f}".format(row['package'], row['level'], row['source size'],
+                                                                    row['size'], ratio, row['seconds']))
+    return True
+
+
+def action_plan(changes_only=True) -> bool:
+    """
+    Print waves of packages computed from dependencies in their manifest.v3 and the critical path.
+    :param changes_only: flag for determine if only packages with changes should be taken into account.
+    :return: True if good, False otherwise.
+    """
+    if changes_only:
+        packages = build.get_packages_from_changes(build.get_changes_from_git_diff(mock=settings.mock))
+    else:
+        packages = build.get_all_package()
+    try:
+        print(dependencies.format_plan(dependencies.build_graph(packages)))
+    except errors.DependencyCycleError as e:
+        log.error(e)
+        return False
     return True
 
 
-def action_deploy(inbound=False, with_restart=False) -> bool:
+def action_deploy(inbound=False, with_restart=False, parallel=1, fail_fast=True, transfer=None,
+                  compress_transfer=None, delete_stale=False, fanout_degree=None, max_transfers=None,
+                  zone_bandwidth=None, session=False, http_check=None, rollout_options=None, redeploy=False,
+                  with_backup=False, preflight_check=True) -> bool:
     """
     Sending packages built in build stage and run script is_instance.
     If you have configuration for specific node it MUST have SSH_ADDRESS_ENV_VAR set, cause there have to be correlation
@@ -101,123 +272,400 @@ def action_deploy(inbound=False, with_restart=False) -> bool:
     Hosts which has different configuration NOT MUST be written down in NODES for environment config,
     but there will be WARNING log.
     :param inbound: determine if packages are ZIP-s and will be sent to inbound directory,
-    :param with_restart: determine if there will be restart after execute is_instance.sh script.
+    :param with_restart: determine if there will be restart after execute is_instance.sh script,
+    :param parallel: how many hosts are deployed at the same time,
+    :param fail_fast: flag for not starting next hosts after the first failed one,
+    :param transfer: 'scp', 'tar', 'delta', 'resumable' or 'store' - how packages are sent to repository,
+        default from settings,
+    :param compress_transfer: flag for gzip of tar stream, default from settings,
+    :param delete_stale: flag for removing files not in build from sent packages (with 'delta' transfer),
+    :param fanout_degree: if set, packages are distributed by fan-out (see `fanout.distribute`) with that degree,
+    :param max_transfers: how many transfers from runner at the same time, default settings.TRANSFER_MAX_CONCURRENT
+        (independent of parallel - hosts waiting for transfer are still deployed in parallel),
+    :param zone_bandwidth: dict zone -> MiB/s capping transfers to hosts of zone, default from settings,
+    :param session: flag for running shutdown, is_instance and startup by one remote script in one ssh session,
+    :param http_check: flag for checking ping service of IS after restart instead of only port, default from settings,
+    :param rollout_options: rollout.RolloutOptions for deploying in waves (canary, then zones), None - all at once,
+    :param redeploy: flag for deploying to inbound also hosts which are done according to deploy journal
+        of this build (see `journal`),
+    :param with_backup: flag for snapshot of packages of instance before is_instance (see `backup`),
+    :param preflight_check: flag for checking all hosts before anything is sent, see `preflight`.
     :return: True if it goes well, False otherwise.
     """
     ref = os.environ[settings.PIPELINE_REFERENCE]
+    loaded = load_fleet()
+    if not loaded:
+        return False
+    inventory, environments = loaded
+    build_dir = config.get_build_dir(ref)
+    build_manifest = manifest.read_manifest(build_dir)
+    if build_manifest:
+        problems = manifest.verify_manifest(build_dir, build_manifest)
+        if problems:
+            log.error("Build directory differs from its manifest: {}".format('; '.join(problems[:20])))
+            return False
+        log.info("Deploying {} files, {} bytes".format(len(build_manifest['files']), build_manifest['size']))
+    zone_bandwidth = settings.ZONE_BANDWIDTH if zone_bandwidth is None else zone_bandwidth
+    http_check = settings.READINESS_HTTP if http_check is None else http_check
+    options = DeployOptions(inbound, with_restart, transfer, compress_transfer, delete_stale, session, http_check,
+                            redeploy, backup.snapshot_name(ref) if with_backup else '')
+    deploy_journal = open_journal(build_dir, build_manifest)
+    if preflight_check:
+        skip_done = inbound and not redeploy
+        targets = [host for host in inventory if not (skip_done and deploy_journal.is_done(host))]
+        checks = preflight.check_hosts(targets, environments,
+                                       sender.get_transfer_size(build_dir, '.zip' if inbound else None), inbound)
+        if not all(result.ok for result in checks.values()):
+            log.error("Preflight failed, nothing was deployed:\n" + fleet.format_results(checks))
+            return False
+    scheduler = transfers.TransferScheduler(max_transfers,
+                                            {zone: mib * 1024 ** 2 for zone, mib in zone_bandwidth.items()})
+    with scheduler:
+        if rollout_options:
+            results = deploy_rollout(ref, inventory, environments, options, rollout_options, parallel, fail_fast,
+                                     fanout_degree, scheduler, deploy_journal)
+        else:
+            results = deploy_hosts(ref, inventory, environments, options, parallel, fail_fast, fanout_degree,
+                                   scheduler, deploy_journal)
+    if inbound:
+        # stamp is written once from journal, so hosts of parallel deploys are not overwritten
+        signer = build.Signer()
+        for host in sorted(deploy_journal.done_hosts()):
+            signer.add_host_to_stamp(host)
+        signer.write_stamp(build_dir)
+    log.info("Deploy results:\n" + fleet.format_results(results))
+    return all(result.ok for result in results.values())
+
+
+def open_journal(build_dir, build_manifest=None) -> journal.Journal:
+    """Deploy journal of the current build in build_dir (see `journal`), build identity from its manifest."""
+    build_manifest = build_manifest or manifest.read_manifest(build_dir)
+    return journal.Journal(build_dir, build.Signer.get_hosts(build_dir), manifest.build_id(build_manifest))
+
+
+def load_fleet():
+    """
+    Hosts of environment (only of ZONE if it is set) with their configuration.
+    :return: (inventory, environments) - see `fleet.get_inventory` and `fleet.get_host_environments`,
+    None if there is no host or configuration cannot be loaded.
+    """
     env = os.environ[settings.CI_ENVIRONMENT_NAME]
     try:
         deploy_zone = config.get_env_var_or_default(settings.ZONE_ENV_VAR, default=None)
         if deploy_zone:
-            del os.environ[settings.ZONE_ENV_VAR]
-        hosts = set()
-        configured_hosts = {}
-        filenames_node_cfg = config.find_node_configs(env)
-        for nf in filenames_node_cfg:
-            node_name = nf.rstrip('.cfg')
-            config.load_node_configuration(env, node_name)
-            addr = os.environ[settings.SSH_ADDRESS_ENV_VAR]
-            if deploy_zone:
-                log.info("Zone was set - selecting hosts")
-                zone = config.get_env_var_or_default(settings.ZONE_ENV_VAR,
-                                                     default='kokianowy_rbaon_astoarnuta')
-                if zone == deploy_zone:
-                    hosts.add(addr)
-            if addr in configured_hosts:
-                log.error("The same address for two nodes.")
-                return False
-            configured_hosts[addr] = node_name
-        if not deploy_zone:
-            hosts = set()
-            nodes = config.get_env_var_or_default(settings.NODES_ENV_VAR, default=None)
-            if nodes:
-                hosts |= set(filter(None, nodes.split(',')))
-            hosts |= configured_hosts.keys()
-            if not hosts:
-                log.error("Any host was configured")
-                return False
+            log.info("Zone was set - selecting hosts")
+        inventory = fleet.get_inventory(env, deploy_zone)
+        if not inventory:
+            log.error("Any host was configured")
+            return None
+        return inventory, fleet.get_host_environments(env, inventory)
     except KeyError as e:
         log.error(e)
-        return False
     except errors.LoadingConfigurationError as e:
         log.error(e)
+    return None
+
+
+def action_backup(parallel=1) -> bool:
+    """
+    Snapshot packages of instance at all hosts at the same time, see `backup.snapshot`.
+    :param parallel: how many hosts at once.
+    :return: True if all hosts have snapshot, False otherwise.
+    """
+    loaded = load_fleet()
+    if not loaded:
         return False
-    signer = build.Signer()
-    for host in hosts:
-        build_dir = config.get_build_dir(ref)
-        hosts_already_get = build.Signer.get_hosts(build_dir)
-        if host in hosts_already_get:
-            log.info(f"For this host {host} packages already sent.")
-            continue
-        log.info("Load global configuration of {}".format(env))
-        config.load_configuration(env)
-        try:
-            log.info("Load configuration of {}".format(host))
-            config.load_node_configuration(env, configured_hosts[host])
-        except KeyError:
-            # supress this cause this means that host are loaded from spliting by comma
-            pass
-        if inbound:
-            log.info("Sending packages to inbound at host {}".format(host))
-            if not sender.send_to_inbound(ref, host):
-                log.error(f"Sending packages for host {host} to inbound for environment {env} failed")
-                return False
-            signer.add_host_to_stamp(host)
-            signer.write_stamp(build_dir)
-            log.info("Host {} get packages".format(host))
+    inventory, environments = loaded
+    name = backup.snapshot_name(os.environ[settings.PIPELINE_REFERENCE])
+    results = fleet.run_on_hosts(sorted(inventory), lambda host: backup.snapshot(host, environments[host], name),
+                                 parallel, fail_fast=False)
+    log.info("Backup results:\n" + fleet.format_results(results))
+    return all(result.ok for result in results.values())
+
+
+def action_rollback(parallel=1, with_restart=False, http_check=None, snapshot=None) -> bool:
+    """
+    Restore snapshot of packages of instance at all hosts at the same time, see `backup.rollback`.
+    :param parallel: how many hosts at once,
+    :param with_restart: flag for shutdown before and start after restoring, then readiness of all hosts is checked,
+    :param http_check: flag for checking ping service of IS after restart, default from settings,
+    :param snapshot: name of snapshot, default the newest one at each host.
+    :return: True if all hosts are rolled back (and ready), False otherwise.
+    """
+    loaded = load_fleet()
+    if not loaded:
+        return False
+    inventory, environments = loaded
+    http_check = settings.READINESS_HTTP if http_check is None else http_check
+    results = fleet.run_on_hosts(sorted(inventory),
+                                 lambda host: backup.rollback(host, environments[host], snapshot, with_restart),
+                                 parallel, fail_fast=False)
+    if with_restart:
+        check_readiness(results, environments, http_check)
+    log.info("Rollback results:\n" + fleet.format_results(results))
+    return all(result.ok for result in results.values())
+
+
+def action_fleet(operation, parallel=None, http_check=None) -> bool:
+    """
+    Run operation at all hosts at the same time (see `remoter.operation_steps`), so it takes about
+    as long as at the slowest host.
+    :param operation: 'stop', 'start' or 'clean',
+    :param parallel: how many hosts at once, default settings.FLEET_PARALLEL,
+    :param http_check: flag for checking ping service of IS after start, default from settings.
+    :return: True if operation succeeded at all hosts (and they are ready after start), False otherwise.
+    """
+    loaded = load_fleet()
+    if not loaded:
+        return False
+    inventory, environments = loaded
+    parallel = parallel or settings.FLEET_PARALLEL
+    http_check = settings.READINESS_HTTP if http_check is None else http_check
+
+    def run(host):
+        steps = remoter.operation_steps(operation, environments[host])
+        if steps is None:
+            return fleet.HostResult(host, False, operation, message="lack of configuration")
+        return fleet.run_steps(host, steps, environments[host])
+
+    log.info("Operation {} at {} host(s), {} at once".format(operation, len(inventory), parallel))
+    started = time.monotonic()
+    results = fleet.run_on_hosts(sorted(inventory), run, parallel, fail_fast=False)
+    if operation == 'start':
+        check_readiness(results, environments, http_check)
+    log.info("Results of {} ({:.1f} s, {:.1f} s at hosts together):\n{}".format(
+        operation, time.monotonic() - started, sum(result.duration for result in results.values()),
+        fleet.format_results(results)))
+    return all(result.ok for result in results.values())
+
+
+def action_exec(command, parallel=None, timeout=None) -> bool:
+    """
+    Run shell command at all hosts at the same time, output of every host is logged with its address as prefix.
+    At the end hosts are summarized by exit codes.
+    :param parallel: how many hosts at once, default settings.FLEET_PARALLEL,
+    :param timeout: seconds for command at one host, default settings.EXEC_TIMEOUT.
+    :return: True if command ended with 0 at all hosts, False otherwise.
+    """
+    if not command:
+        log.error("Command for exec not set - use --command.")
+        return False
+    loaded = load_fleet()
+    if not loaded:
+        return False
+    inventory, environments = loaded
+    results = fleet.run_on_hosts(sorted(inventory),
+                                 lambda host: fleet.run_command(host, command, environments[host], timeout),
+                                 parallel or settings.FLEET_PARALLEL, fail_fast=False)
+    log.info("Exec results:\n{}\n{}".format(fleet.format_results(results), fleet.summarize_messages(results)))
+    return all(result.ok for result in results.values())
+
+
+@dataclasses.dataclass
+class DeployOptions:
+    """How packages are deployed to every host - see `action_deploy`."""
+    inbound: bool = False
+    with_restart: bool = False
+    transfer: str = None
+    compress_transfer: bool = None
+    delete_stale: bool = False
+    session: bool = False
+    http_check: bool = False
+    redeploy: bool = False
+    backup: str = ''  # name of snapshot taken before is_instance, empty - no snapshot
+
+
+def deploy_rollout(ref, inventory, environments, options, rollout_options, parallel=1, fail_fast=True,
+                   fanout_degree=None, scheduler=None, deploy_journal=None) -> dict:
+    """Deploy inventory in waves (see `rollout`) - canary, then zone by zone with health gate after each wave."""
+    waves = rollout.plan_waves(inventory, environments, rollout_options.canary, rollout_options.zone_order)
+    build_dir = config.get_build_dir(ref)
+    deploy_journal = deploy_journal or open_journal(build_dir)
+    # failures within budget must not stop the rest of wave
+    fail_fast = fail_fast and not rollout_options.max_failures
+
+    def deploy_wave(wave):
+        return deploy_hosts(ref, {host: inventory[host] for host in wave.hosts}, environments, options,
+                            rollout_options.wave_parallel or parallel, fail_fast, fanout_degree, scheduler,
+                            deploy_journal)
+
+    def gate(wave, results):
+        recheck = wave.hosts if options.with_restart else []
+        auth = {host: remoter.get_http_auth(environments[host]) for host in recheck}
+        return rollout.health_gate(results, rollout_options.max_failures, recheck, options.http_check,
+                                   rollout_options.bake_time, auth)
+
+    return rollout.run_rollout(waves, deploy_wave, gate)
+
+
+def deploy_hosts(ref, inventory, environments, options, parallel=1, fail_fast=True, fanout_degree=None,
+                 scheduler=None, deploy_journal=None) -> dict:
+    """
+    Deliver packages and deploy them to every host of inventory - see `action_deploy`.
+    Every step of host is appended to deploy journal, hosts done in inbound deploy of the same build are skipped
+    (unless redeploy), as hosts of cicd_version.json were.
+    :param deploy_journal: journal.Journal of build, default the one in build directory.
+    """
+    build_dir = config.get_build_dir(ref)
+    deploy_journal = deploy_journal or open_journal(build_dir)
+    skip_done = options.inbound and not options.redeploy
+    delivered = {}
+    if fanout_degree:
+        already_sent = deploy_journal.done_hosts() if skip_done else set()
+        names = fanout.get_artifacts(ref, options.inbound)
+
+        def upload(host):
+            return send_packages(ref, host, environments[host], options, scheduler)
+
+        def copy(parent, child):
+            return fanout.relay(parent, child, names, environments[parent], environments[child], options.inbound)
+
+        delivered = fanout.distribute([host for host in inventory if host not in already_sent], environments,
+                                      upload, copy, fanout_degree, parallel)
+
+    def deploy(host):
+        if skip_done and deploy_journal.is_done(host):
+            log.info(f"For this host {host} packages already deployed.")
+            return fleet.HostResult(host, True, 'skipped', message="already deployed")
+        deploy_journal.append(host, 'deploy', 'started')
+        started = time.monotonic()
+        if host in delivered and not delivered[host].ok:
+            result = delivered[host]
         else:
-            log.info("Sending packages to repository dir at host {}".format(host))
-            if not sender.send_to_packages_repo(ref, host):
-                log.error(f"Sending packages for host {host} to repository dir for environment {env} failed")
-                return False
-            if with_restart:
-                log.info("Shutdown server.")
-                if not remoter.shutdown_server(host):
-                    log.error("Shutdown server command timeout. Check it.")
-                    return False
-            log.info("Run is_instance script")
-            if not remoter.run_is_instance(host):
-                return False
-            if with_restart:
-                log.info("Start server.")
-                if not remoter.start_server(host):
-                    log.error("Start server command failed.")
-                    return False
-                log.info("Check start status.")
-                if not remoter.check_start_status(host):
-                    return False
-    return True
+            result = deploy_host(host, ref, environments[host], options, host not in delivered, scheduler)
+        progress = scheduler.progress.get(host) if scheduler else None
+        # with restart host is done only when it is ready
+        deploy_journal.append(host, result.step, 'ok' if result.ok else 'failed',
+                              result.duration or time.monotonic() - started, progress.sent if progress else 0,
+                              result.ok and not options.with_restart, result.message)
+        return result
+
+    log.info("Deploying to {} host(s), {} at once".format(len(inventory), parallel))
+    results = fleet.run_on_hosts(sorted(inventory), deploy, parallel, fail_fast)
+    if options.with_restart:
+        check_readiness(results, environments, options.http_check)
+        for host, result in results.items():
+            if result.step == 'check start':
+                deploy_journal.append(host, result.step, 'ok' if result.ok else 'failed', result.duration,
+                                      done=result.ok, message=result.message)
+    return results
+
+
+def check_readiness(results, environments, http=False) -> None:
+    """
+    Wait for all hosts started by deploy at the same time (see `readiness`) and update their results.
+    :param results: dict host -> fleet.HostResult, hosts with successful step 'start' are checked,
+    :param environments: dict host -> configuration (credentials for HTTP check).
+    """
+    started = [host for host, result in results.items() if result.ok and result.step == 'start']
+    log.info("Check start status of {}.".format(', '.join(started)))
+    auth = {host: remoter.get_http_auth(environments[host]) for host in started}
+    for host, probe in readiness.wait_for_hosts(started, http=http, auth=auth).items():
+        result = results[host]
+        result.step, result.ok = 'check start', probe.ok
+        result.duration += probe.seconds
+        result.message = "ready after {:.0f} s".format(probe.seconds) if probe.ok else probe.error
+
+
+def send_packages(ref, host, environ, options, scheduler=None) -> bool:
+    """Send packages of build to inbound or packages repository of host, depending on options."""
+    if options.inbound:
+        return sender.send_to_inbound(ref, host, environ, scheduler)
+    return sender.send_to_packages_repo(ref, host, environ, options.transfer, options.compress_transfer,
+                                        options.delete_stale, scheduler)
+
+
+def deploy_host(host, ref, environ, options=None, send=True, scheduler=None):
+    """
+    Deploy build to one host - all steps with configuration of that host only.
+    :param environ: configuration of host, see `config.get_host_environment`,
+    :param options: DeployOptions,
+    :param send: flag for sending packages, False if host already got them (i.e. by fan-out),
+    :param scheduler: transfers.TransferScheduler for sending packages,
+    :return: fleet.HostResult.
+    """
+    options = options or DeployOptions()
+    build_dir = config.get_build_dir(ref)
+    env = environ.get(settings.CI_ENVIRONMENT_NAME, '')
+    if options.inbound:
+        log.info("Sending packages to inbound at host {}".format(host))
+        if send and not send_packages(ref, host, environ, options, scheduler):
+            log.error(f"Sending packages for host {host} to inbound for environment {env} failed")
+            return fleet.HostResult(host, False, 'send')
+        log.info("Host {} get packages".format(host))
+        return fleet.HostResult(host, True, 'send')
+    log.info("Sending packages to repository dir at host {}".format(host))
+    if send and not send_packages(ref, host, environ, options, scheduler):
+        log.error(f"Sending packages for host {host} to repository dir for environment {env} failed")
+        return fleet.HostResult(host, False, 'send')
+    removed = build.read_removed_services(build_dir)
+    waves = get_activation_waves(build_dir)
+    if options.session:
+        result = run_deploy_session(host, environ, removed, options.with_restart, options.backup, waves)
+        if not result.ok:
+            return result
+    else:
+        if options.with_restart:
+            log.info("Shutdown server {}.".format(host))
+            if not remoter.shutdown_server(host, environ):
+                log.error("Shutdown server command timeout. Check it.")
+                return fleet.HostResult(host, False, 'shutdown')
+        if options.backup:
+            result = backup.snapshot(host, environ, options.backup)
+            if not result.ok:
+                return result
+        for number, wave in enumerate(waves, start=1):
+            log.info("Run is_instance script at {} for wave {}/{}".format(host, number, len(waves)))
+            if not remoter.run_is_instance(host, wave, environ=environ):
+                return fleet.HostResult(host, False, 'is_instance', message=f"wave {number}/{len(waves)}")
+        if removed:
+            log.info("Remove deleted services from instance at {}".format(host))
+            if not remoter.remove_services(host, removed, environ):
+                return fleet.HostResult(host, False, 'remove services')
+        if options.with_restart:
+            log.info("Start server {}.".format(host))
+            if not remoter.start_server(host, environ):
+                log.error("Start server command failed.")
+                return fleet.HostResult(host, False, 'start')
+    if options.with_restart:
+        return fleet.HostResult(host, True, 'start')  # readiness is checked for all hosts together
+    return fleet.HostResult(host, True, 'is_instance')
+
+
+def get_activation_waves(build_dir) -> list:
+    """
+    Package lists for is_instance runs at host, one after another - waves saved by build (see `build.write_waves`).
+    :return: ['all'] if build has less than two waves (nothing to order), like deploy without waves.
+    """
+    waves = build.read_waves(build_dir)
+    return waves if len(waves) > 1 else ['all']
+
+
+def run_deploy_session(host, environ, removed=None, with_restart=False, snapshot='', waves=None):
+    """
+    Shutdown, is_instance, removing services and startup in one remote session, see `remoter.run_session`.
+    :param snapshot: name of snapshot of packages taken before is_instance (see `backup`), empty - no snapshot,
+    :param waves: package lists activated by is_instance one after another, default all packages at once,
+    :return: fleet.HostResult of the last step done or of the step which failed.
+    """
+    steps = remoter.deploy_steps(environ, removed=removed, with_restart=with_restart, waves=waves)
+    if steps is None:
+        return fleet.HostResult(host, False, 'session', message="lack of configuration")
+    if snapshot:
+        position = [name for name, _ in steps].index('is_instance')
+        steps.insert(position, ("backup", backup.snapshot_script(*backup.get_dirs(environ), snapshot)))
+    log.info("Run {} in one session at {}".format(', '.join(name for name, _ in steps), host))
+    return fleet.run_steps(host, steps, environ)
 
 
 def clean_repo_after_instance_script_done():
     """
     Delete non-core, deployed packages from $IS_DIR/packages.
-    To be prepared for another deployment.
+    To be prepared for another deployment. All hosts of environment are cleaned at the same time, see `action_fleet`.
     """
     env = os.environ[settings.CI_ENVIRONMENT_NAME]
-    loader = config.CfgLoader(env)
     config.load_configuration(env)
-    hosts_from_nodes = config.get_env_var_or_default(settings.NODES_ENV_VAR, default=None)
-    hosts = set()
-    if hosts_from_nodes:
-        hosts = set(hosts_from_nodes.split(','))
-    for node_loaded_config_in_background in loader:
-        with loader:
-            ip_address = os.environ[settings.SSH_ADDRESS_ENV_VAR]
-            if ip_address in hosts:
-                hosts.remove(ip_address)
-            log.info("Clear packages repository for %s" % (ip_address,))
-            invoker = remoter.SSHCommand.construct(ip_address)
-            integration_server_dir = os.environ[settings.IS_DIR_ENV_VAR]
-            invoker.invoke(f"rm -rf {integration_server_dir}/packages/*")
-        if loader.error:
-            exit(-1)
-    for host in hosts:
-        config.load_configuration(env)
-        invoker = remoter.SSHCommand.construct(host)
-        integration_server_dir = os.environ[settings.IS_DIR_ENV_VAR]
-        invoker.invoke(f"rm -rf {integration_server_dir}/packages/*")
-    exit(0)
+    exit(0 if action_fleet('clean') else -1)
 
 
 def main():
@@ -234,16 +682,48 @@ def main():
         log.error(e)
         log.info("Error occured. Ending...")
         exit(-1)
+    if args.multiplex:
+        connections.enable()  # closed at exit
     # run actions
     try:
         if not ref:
             raise ValueError("Reference to MERGE_REQUEST_IID not set,"
                              "so pipeline is not configured properly.")
         if args.action == "build":
-            if not action_build(args.inbound, args.no_changes_only):
+            policy = build.CompressionPolicy(args.deflate_level, tuple(args.store_ext))
+            if not action_build(args.inbound, args.no_changes_only, args.workers, args.reproducible, policy,
+                                args.staging == 'link'):
+                exit(-1)
+        elif args.action == "plan":
+            if not action_plan(args.no_changes_only):
+                exit(-1)
+        elif args.action == "benchmark":
+            if not action_benchmark(args.package, args.levels, args.store_ext):
                 exit(-1)
         elif args.action == "deploy":
-            if not action_deploy(args.inbound, args.with_restart):
+            rollout_options = None
+            if args.rollout:
+                rollout_options = rollout.RolloutOptions(args.canary, args.wave_parallel, args.max_failures,
+                                                         args.bake_time, args.zone_order)
+            if not action_deploy(args.inbound, args.with_restart, args.parallel or settings.DEPLOY_PARALLEL,
+                                 not args.continue_on_error,
+                                 args.transfer, args.compress_transfer, args.delete_stale,
+                                 args.fanout_degree if args.fanout else None, args.max_transfers,
+                                 parse_zone_bandwidth(args.zone_bandwidth) or None, args.session, args.http_check,
+                                 rollout_options, args.redeploy, args.backup, args.preflight):
+                exit(-1)
+        elif args.action == "backup":
+            if not action_backup(args.parallel or settings.FLEET_PARALLEL):
+                exit(-1)
+        elif args.action == "rollback":
+            if not action_rollback(args.parallel or settings.FLEET_PARALLEL, args.with_restart, args.http_check,
+                                   args.snapshot):
+                exit(-1)
+        elif args.action == "exec":
+            if not action_exec(args.command, args.parallel or settings.FLEET_PARALLEL, args.timeout):
+                exit(-1)
+        elif args.action in ("stop", "start", "clean"):
+            if not action_fleet(args.action, args.parallel or settings.FLEET_PARALLEL, args.http_check):
                 exit(-1)
         elif args.action == "test":
             exit(0)
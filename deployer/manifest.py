@@ -0,0 +1,168 @@
+"""
+Manifest of build_{ref} directory - every file with its relative path, size, mtime and sha256.
+It is computed once in build stage and written to build_{ref}/build_manifest.json,
+then deploy stage uses it to verify build cheaply (by stat, hashing only files which changed),
+to skip files which are not changed and for reporting.
+"""
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import time
+
+from . import settings, config, build, journal
+from .settings import log
+
+MANIFEST_FILENAME = "build_manifest.json"
+# files with information about build, not a content to deploy
+METADATA_FILES = (MANIFEST_FILENAME, "cicd_version.json", build.REMOVED_SERVICES_FILENAME,
+                  build.UPLOAD_STATE_FILENAME, build.WAVES_FILENAME, journal.JOURNAL_FILENAME)
+
+
+def hash_file(path) -> str:
+    """
+    sha256 of file read by blocks, big files are memory-mapped, so they are never read into memory at once.
+    :return: hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= settings.MANIFEST_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, settings.MANIFEST_HASH_BLOCK):
+                    digest.update(mapped[offset:offset + settings.MANIFEST_HASH_BLOCK])
+        else:
+            for block in iter(lambda: f.read(settings.MANIFEST_HASH_BLOCK), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def iter_build_files(build_dir):
+    """
+    Relative paths (posix style) and absolute paths of all files to deploy from build_dir.
+    Symlinks are followed, because packages can be linked to build directory.
+    """
+    build_dir = pathlib.Path(build_dir)
+    for root, dirs, files in os.walk(build_dir, followlinks=True):
+        dirs.sort()
+        for name in sorted(files):
+            path = pathlib.Path(root) / name
+            relative = path.relative_to(build_dir).as_posix()
+            if relative in METADATA_FILES:
+                continue
+            yield relative, path
+
+
+def _entry(path) -> dict:
+    stat = os.stat(path)
+    checksum = build.read_checksum(path)  # archives built reproducible have sha256 already
+    sidecar = build.get_checksum_path(path)
+    if not checksum or os.stat(sidecar).st_mtime_ns < stat.st_mtime_ns:
+        checksum = hash_file(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": checksum}
+
+
+def create_manifest(build_dir) -> dict:
+    """
+    Describe every file in build_dir.
+    :return: dict with keys: created, files (relative path -> size, mtime, sha256), size (sum of sizes).
+    """
+    files = {relative: _entry(path) for relative, path in iter_build_files(build_dir)}
+    return {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "size": sum(entry["size"] for entry in files.values()),
+        "files": files,
+    }
+
+
+def write_manifest(build_dir) -> dict:
+    """Create manifest of build_dir and save it there as build_manifest.json."""
+    manifest = create_manifest(build_dir)
+    tmp = pathlib.Path(build_dir) / f".{MANIFEST_FILENAME}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, pathlib.Path(build_dir) / MANIFEST_FILENAME)
+    log.info("Manifest of build: {} files, {} bytes".format(len(manifest["files"]), manifest["size"]))
+    return manifest
+
+
+def read_manifest(build_dir):
+    """:return: manifest saved by `write_manifest` or None if there is no manifest."""
+    try:
+        with open(pathlib.Path(build_dir) / MANIFEST_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build_id(manifest) -> str:
+    """
+    Identity of one build of build directory - created time and content, so next build of the same merge request
+    in the same directory gets another identity.
+    :return: hex digest, commit sha ($CI_COMMIT_SHA) or empty string if there is no manifest.
+    """
+    if not manifest:
+        return config.get_env_var_or_default(settings.CI_COMMIT_SHA, default='')
+    digest = hashlib.sha256(manifest["created"].encode('utf-8'))
+    for path, entry in sorted(manifest["files"].items()):
+        digest.update(f"{path}\0{entry['sha256']}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def verify_manifest(build_dir, manifest=None) -> list:
+    """
+    Check that build_dir still contains what manifest says. Files with the same size and mtime are trusted,
+    the rest is hashed again.
+    :param manifest: manifest to check against, default read from build_dir.
+    :return: list of problems as strings, empty if build is untouched.
+    """
+    manifest = manifest or read_manifest(build_dir)
+    if manifest is None:
+        return [f"There is no {MANIFEST_FILENAME} in {build_dir}"]
+    problems = []
+    expected = manifest["files"]
+    found = set()
+    for relative, path in iter_build_files(build_dir):
+        found.add(relative)
+        entry = expected.get(relative)
+        if entry is None:
+            problems.append(f"{relative}: not in manifest")
+            continue
+        stat = os.stat(path)
+        if stat.st_size != entry["size"]:
+            problems.append(f"{relative}: size {stat.st_size} != {entry['size']}")
+        elif stat.st_mtime_ns != entry["mtime"] and hash_file(path) != entry["sha256"]:
+            problems.append(f"{relative}: content changed")
+    problems.extend(f"{relative}: missing" for relative in sorted(set(expected) - found))
+    return problems
+
+
+def diff_manifests(local: dict, remote: dict) -> tuple:
+    """
+    Compare two lists of files by sha256.
+    :param local: relative path -> entry with sha256 (files of manifest),
+    :param remote: relative path -> entry with sha256 or sha256 itself,
+    :return: (paths to send - missing or different on remote, paths only on remote), both sorted.
+    """
+    def checksum(entry):
+        return entry["sha256"] if isinstance(entry, dict) else entry
+
+    to_send = sorted(path for path, entry in local.items()
+                     if path not in remote or checksum(remote[path]) != checksum(entry))
+    stale = sorted(set(remote) - set(local))
+    return to_send, stale
+
+
+def package_digests(manifest: dict) -> dict:
+    """
+    Content address of every package (top directory) of build - sha256 of relative paths and checksums of its files,
+    so the same version of package has the same digest in any build.
+    :return: dict package name -> hex digest.
+    """
+    packages = {}
+    for relative, entry in sorted(manifest["files"].items()):
+        name, _, path = relative.partition('/')
+        if path:
+            packages.setdefault(name, hashlib.sha256()).update(f"{path}\0{entry['sha256']}\n".encode('utf-8'))
+    return {name: digest.hexdigest() for name, digest in packages.items()}
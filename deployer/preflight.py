@@ -0,0 +1,98 @@
+"""
+Preflight of deploy - every target host is checked at the same time before anything is sent,
+so deploy does not stop at host 9 of 12 with hosts 1-8 already changed.
+For each host: TCP connection to ssh port, ssh authentication by key (no password prompt),
+then one remote command reports presence of IS directory, is_instance.sh and free space for the build.
+The whole preflight takes about one round trip and ssh handshake of the slowest host.
+Using example:
+results = preflight.check_hosts(hosts, environments, size=build_size)
+"""
+import shlex
+import socket
+import subprocess
+
+from . import config, fleet, remoter, settings
+from .settings import log
+
+
+def check_tcp(host, port, timeout) -> str:
+    """:return: empty string if port accepts connection, reason otherwise."""
+    try:
+        with socket.create_connection((host, int(port)), timeout):
+            return ''
+    except OSError as e:
+        return str(e) or e.__class__.__name__
+
+
+def remote_script(environ, inbound=False) -> str:
+    """Shell script printing key=value lines about host: missing directory, is_instance.sh and free KiB."""
+    if inbound:
+        target = environ.get(settings.INBOUND_DIR_ENV_VAR) or '.'
+        lines = [f"[ -d {shlex.quote(target)} ] || {{ echo missing={shlex.quote(target)}; exit 0; }}",
+                 f"d={shlex.quote(target)}"]
+    else:
+        is_dir = environ[settings.IS_DIR_ENV_VAR]
+        quoted = shlex.quote(is_dir)
+        lines = [f"[ -d {quoted} ] || {{ echo missing={quoted}; exit 0; }}",
+                 "echo is_instance=$([ -x {} ] && echo 1 || echo 0)".format(
+                     shlex.quote(f"{is_dir}/instances/is_instance.sh")),
+                 f"d={shlex.quote(is_dir + '/packages')}; [ -d \"$d\" ] || d={quoted}"]
+    lines.append("echo free=$(df -Pk \"$d\" | awk 'NR == 2 {print $4}')")
+    return '\n'.join(lines)
+
+
+def check_host(host, environ, size=0, inbound=False, timeout=None) -> fleet.HostResult:
+    """
+    Check that host is ready for deploy.
+    :param environ: configuration of host,
+    :param size: bytes to send, free space must be settings.PREFLIGHT_SPACE_FACTOR times more,
+    :param inbound: flag for deploy to inbound directory (no is_instance.sh needed),
+    :param timeout: seconds for connection, default settings.PREFLIGHT_TIMEOUT,
+    :return: fleet.HostResult with step of the failed check, 'preflight' if everything passed.
+    """
+    timeout = timeout or settings.PREFLIGHT_TIMEOUT
+    if not inbound and settings.IS_DIR_ENV_VAR not in environ:
+        return fleet.HostResult(host, False, 'config', message=f"{settings.IS_DIR_ENV_VAR} not set")
+    ssh = remoter.SSHCommand.construct(host, environ)
+    if not ssh:
+        return fleet.HostResult(host, False, 'config', message="lack of ssh configuration")
+    port = config.get_env_var_or_default(settings.SSH_PORT_ENV_VAR, default='22', environ=environ)
+    error = check_tcp(host, port, timeout)
+    if error:
+        return fleet.HostResult(host, False, 'tcp', message=f"port {port}: {error}")
+    ssh.options = [*ssh.options, "-o", "BatchMode=yes", "-o", f"ConnectTimeout={int(timeout)}"]
+    try:
+        process = subprocess.run(ssh.args(remote_script(environ, inbound)), capture_output=True, encoding='utf-8',
+                                 stdin=subprocess.DEVNULL, timeout=timeout * 3)
+    except (OSError, subprocess.SubprocessError) as e:
+        return fleet.HostResult(host, False, 'ssh', message=str(e))
+    if process.returncode != 0:
+        return fleet.HostResult(host, False, 'ssh', message=process.stderr.strip()[-200:]
+                                or f"exit code {process.returncode}")
+    report = dict(line.partition('=')[::2] for line in process.stdout.splitlines() if '=' in line)
+    if 'missing' in report:
+        return fleet.HostResult(host, False, 'directory', message=f"{report['missing']} does not exist")
+    if not inbound and report.get('is_instance') != '1':
+        return fleet.HostResult(host, False, 'is_instance', message="instances/is_instance.sh missing")
+    try:
+        free = int(report.get('free', '')) * 1024
+    except ValueError:
+        return fleet.HostResult(host, False, 'space', message="free space unknown")
+    required = int(size * settings.PREFLIGHT_SPACE_FACTOR)
+    if free < required:
+        return fleet.HostResult(host, False, 'space', message="free {} MiB, required {} MiB".format(
+            free // 1024 ** 2, -(-required // 1024 ** 2)))
+    return fleet.HostResult(host, True, 'preflight', message="free {} MiB".format(free // 1024 ** 2))
+
+
+def check_hosts(hosts, environments, size=0, inbound=False, parallel=None, timeout=None) -> dict:
+    """
+    Check all hosts at the same time, see `check_host`.
+    :param environments: dict host -> configuration,
+    :param parallel: hosts checked at once, default settings.PREFLIGHT_PARALLEL,
+    :return: dict host -> fleet.HostResult.
+    """
+    hosts = sorted(hosts)
+    log.info("Preflight of {} host(s)".format(len(hosts)))
+    return fleet.run_on_hosts(hosts, lambda host: check_host(host, environments[host], size, inbound, timeout),
+                              parallel or settings.PREFLIGHT_PARALLEL, fail_fast=False)
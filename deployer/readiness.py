@@ -0,0 +1,142 @@
+"""
+Waiting for IntegrationServer after start - all hosts are probed at the same time by asyncio,
+every host is reported as soon as it is ready. Between probes host waits with exponential backoff and jitter,
+so checks are frequent right after start and do not flood hosts which start long.
+Probe is TCP connect to port or HTTP GET of IS ping service (the server answers it only when packages are loaded).
+Using example:
+results = readiness.wait_for_hosts(["10.0.0.1", "10.0.0.2"], http=True)
+"""
+import asyncio
+import base64
+import dataclasses
+import random
+import time
+import typing
+
+from . import settings
+from .settings import log
+
+
+@dataclasses.dataclass
+class ProbeResult:
+    host: str
+    ok: bool
+    seconds: float = 0.0  # from the start of waiting until ready or deadline
+    attempts: int = 0
+    error: str = ''  # the last reason of not ready
+
+
+async def probe_tcp(host, port, timeout) -> str:
+    """:return: empty string if port accepts connection, reason otherwise."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+    except asyncio.TimeoutError:
+        return "connect timeout"
+    except OSError as e:
+        return str(e) or e.__class__.__name__
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return ''
+
+
+async def probe_http(host, port, timeout, path=None, auth=None) -> str:
+    """
+    GET path (default ping service of IS) by plain HTTP/1.0.
+    :param auth: (user, password) for basic authentication or None,
+    :return: empty string if server answers 200, reason otherwise.
+    """
+    path = path or settings.READINESS_HTTP_PATH
+    headers = [f"GET {path} HTTP/1.0", f"Host: {host}:{port}", "Connection: close"]
+    if auth:
+        headers.append("Authorization: Basic " + base64.b64encode(':'.join(auth).encode('utf-8')).decode('ascii'))
+
+    async def request():
+        reader, writer = await asyncio.open_connection(host, int(port))
+        try:
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('ascii'))
+            await writer.drain()
+            return await reader.readline()
+        finally:
+            writer.close()
+
+    try:
+        status_line = await asyncio.wait_for(request(), timeout)
+    except asyncio.TimeoutError:
+        return "HTTP timeout"
+    except OSError as e:
+        return str(e) or e.__class__.__name__
+    parts = status_line.decode('latin-1').split()
+    if len(parts) >= 2 and parts[1] == '200':
+        return ''
+    return "HTTP status: " + (status_line.decode('latin-1').strip() or "no response")
+
+
+def backoff_delays(initial=None, maximum=None, factor=2.0, rnd=None) -> typing.Iterator:
+    """Delays between probes - exponential, capped by maximum, each one randomly shortened by up to a half (jitter)."""
+    initial = settings.READINESS_BACKOFF_INITIAL if initial is None else initial
+    maximum = settings.READINESS_BACKOFF_MAX if maximum is None else maximum
+    rnd = rnd or random.Random()
+    delay = initial
+    while True:
+        yield delay * rnd.uniform(0.5, 1.0)
+        delay = min(maximum, delay * factor)
+
+
+async def wait_ready(host, port=None, http=False, timeout=None, probe_timeout=None, auth=None,
+                     initial=None, maximum=None) -> ProbeResult:
+    """
+    Probe host until it is ready or timeout.
+    :param port: port of IS, default settings.READINESS_PORT,
+    :param http: flag for HTTP ping instead of TCP connect,
+    :param timeout: seconds for host to get ready, default settings.READINESS_TIMEOUT,
+    :param probe_timeout: seconds for one probe,
+    :param auth: credentials for HTTP ping,
+    :param initial: the first delay between probes, doubled after each probe up to maximum.
+    """
+    port = port or settings.READINESS_PORT
+    timeout = settings.READINESS_TIMEOUT if timeout is None else timeout
+    probe_timeout = probe_timeout or settings.READINESS_PROBE_TIMEOUT
+    started = time.monotonic()
+    deadline = started + timeout
+    result = ProbeResult(host, False)
+    for delay in backoff_delays(initial, maximum):
+        result.attempts += 1
+        remaining = deadline - time.monotonic()
+        probe_time = max(0.01, min(probe_timeout, remaining))
+        if http:
+            result.error = await probe_http(host, port, probe_time, auth=auth)
+        else:
+            result.error = await probe_tcp(host, port, probe_time)
+        result.seconds = time.monotonic() - started
+        if not result.error:
+            result.ok = True
+            log.info("Host {} ready after {:.1f} s ({} probes)".format(host, result.seconds, result.attempts))
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
+    result.seconds = time.monotonic() - started
+    log.error("Host {} not ready after {:.1f} s: {}".format(host, result.seconds, result.error))
+    return result
+
+
+async def wait_for_hosts_async(hosts, auth=None, **kwargs) -> dict:
+    auth = auth or {}
+    results = await asyncio.gather(*(wait_ready(host, auth=auth.get(host), **kwargs) for host in hosts))
+    return {result.host: result for result in results}
+
+
+def wait_for_hosts(hosts: typing.Iterable, port=None, http=False, timeout=None, auth=None, **kwargs) -> dict:
+    """
+    Probe all hosts at the same time, see `wait_ready`.
+    :param auth: dict host -> (user, password) for HTTP ping of that host,
+    :return: dict host -> ProbeResult.
+    """
+    hosts = list(hosts)
+    if not hosts:
+        return {}
+    return asyncio.run(wait_for_hosts_async(hosts, auth, port=port, http=http, timeout=timeout, **kwargs))
@@ -1,11 +1,13 @@
 import dataclasses
+import json
 import pathlib
+import shlex
+import signal
 import subprocess
 import os
-import socket
-import time
+import threading
 
-from . import errors, settings, config
+from . import errors, settings, config, connections, readiness
 from .settings import log
 
 
@@ -15,15 +17,18 @@ class SSHCommand:
     port: str
     username: str
     private_key_filename: pathlib.Path
+    options: list = dataclasses.field(default_factory=list)  # extra ssh options, i.e. ControlPath
+
+    def args(self, command=None) -> list:
+        """Arguments of ssh process for command (or without command)."""
+        args = ["ssh", *self.options, "-p", str(self.port), "-i", str(self.private_key_filename),
+                f"{self.username}@{self.ip}"]
+        if command is not None:
+            args.append(str(command))
+        return args
 
     def invoke(self, command):
-        cmd_args = "ssh -p {} -i {} {}@{} {}".format(
-            self.port,
-            self.private_key_filename,
-            self.username,
-            self.ip,
-            command
-        ).split(' ')
+        cmd_args = self.args(command)
         try:
             process = subprocess.run(cmd_args, capture_output=True, encoding='utf-8',
                                      timeout=settings.SUBPROCESS_CMD_TIMEOUT, check=True)
@@ -35,17 +40,20 @@ class SSHCommand:
             raise
 
     @staticmethod
-    def construct(host):
+    def construct(host, environ=None):
         """
         Pull out from environment basic parameters for SSHCommand client.
+        :param environ: configuration of host (see `config.get_host_environment`), default os.environ.
         :return: None if cannot construct, SSHCommand object otherwise.
         """
+        environ = os.environ if environ is None else environ
         try:
             ip = host
-            port = config.get_env_var_or_default(settings.SSH_PORT_ENV_VAR, default='22')
-            username = os.environ[settings.IS_NODE_USERNAME_ENV_VAR]
-            private_key_filepath = os.environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
-            return SSHCommand(ip, port, username, pathlib.Path(private_key_filepath))
+            port = config.get_env_var_or_default(settings.SSH_PORT_ENV_VAR, default='22', environ=environ)
+            username = environ[settings.IS_NODE_USERNAME_ENV_VAR]
+            private_key_filepath = environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
+            options = connections.options(ip, port, username, private_key_filepath)
+            return SSHCommand(ip, port, username, pathlib.Path(private_key_filepath), options)
         except KeyError:
             log.error("Lack of configuration. Used variables: {} {} {}".format(
                 settings.SSH_PORT_ENV_VAR, settings.IS_NODE_USERNAME_ENV_VAR, settings.IS_NODE_PRIVKEY_ENV_VAR
@@ -56,15 +64,18 @@ class SSHCommand:
             return None
 
 
-def run_is_instance(host, packages='all') -> bool:
+def run_is_instance(host, packages='all', environ=None) -> bool:
     """
     Invoke command /path/to/is_instance -Dinstance.name={} -Dpackage.list={},{} at remote server
+    :param environ: configuration of host, default os.environ.
     :return:
     """
+    environ = os.environ if environ is None else environ
     invoke = True
     try:
-        instance_name = config.get_env_var_or_default(os.environ[settings.INSTANCE_NAME_ENV_VAR], default='default')
-        is_dir = os.environ[settings.IS_DIR_ENV_VAR]
+        instance_name = config.get_env_var_or_default(settings.INSTANCE_NAME_ENV_VAR, default='default',
+                                                      environ=environ)
+        is_dir = environ[settings.IS_DIR_ENV_VAR]
         script_path = is_dir / pathlib.Path("instances/is_instance.sh")
         # command = f"{script_path} update -Dpackage.list={packages} -Dinstance.name={instance_name}"
         # Without determine package.list, All non-default package will be taken.
@@ -73,7 +84,7 @@ def run_is_instance(host, packages='all') -> bool:
         else:
             packages_str = packages
         command = f"{script_path} update -Dpackage.list={packages_str} -Dinstance.name={instance_name}"
-        ssh = SSHCommand.construct(host)
+        ssh = SSHCommand.construct(host, environ)
         if not ssh:
             log.error("Cannot construct SSH client.")
             return False
@@ -97,14 +108,49 @@ def run_is_instance(host, packages='all') -> bool:
     return invoke
 
 
-def shutdown_server(host) -> bool:
+def remove_services(host, removed: dict, environ=None) -> bool:
+    """
+    Delete services removed from repository in instance packages, is_instance update does not do it.
+    All directories are removed by one command.
+    :param removed: package -> list of service directories relative to package, i.e. ns/tp/oss/...
+    :param environ: configuration of host, default os.environ.
+    :return: True if removed, False otherwise.
+    """
+    environ = os.environ if environ is None else environ
+    try:
+        instance_name = environ[settings.INSTANCE_NAME_ENV_VAR]
+        is_dir = environ[settings.IS_DIR_ENV_VAR]
+        packages_dir = is_dir / pathlib.Path(f"instances/{instance_name}/packages")
+        paths = [str(packages_dir / package / service) for package, services in removed.items()
+                 for service in services if service and '..' not in service.split('/')]
+        if not paths:
+            return True
+        ssh = SSHCommand.construct(host, environ)
+        if not ssh:
+            log.error("Cannot construct SSH client.")
+            return False
+        output = ssh.invoke("rm -rf {}".format(' '.join(paths)))
+        log.info("Removed services: {}; output: {}".format(', '.join(paths), output))
+    except KeyError:
+        log.error("Lack of configuration. Used variables: {} {}".format(
+            settings.IS_DIR_ENV_VAR, settings.INSTANCE_NAME_ENV_VAR
+        ))
+        return False
+    except Exception as e:
+        log.exception(e)
+        return False
+    return True
+
+
+def shutdown_server(host, environ=None) -> bool:
     """Invoke remove script for shutdown server"""
+    environ = os.environ if environ is None else environ
     try:
 
-        instance_name = os.environ[settings.INSTANCE_NAME_ENV_VAR]
-        is_dir = os.environ[settings.IS_DIR_ENV_VAR]
+        instance_name = environ[settings.INSTANCE_NAME_ENV_VAR]
+        is_dir = environ[settings.IS_DIR_ENV_VAR]
         script_path = is_dir / pathlib.Path(f"instances/{instance_name}/bin/shutdown.sh")
-        ssh = SSHCommand.construct(host)
+        ssh = SSHCommand.construct(host, environ)
         # ssh = SSHCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath))
         output = ssh.invoke(script_path)
         if (output and "Stopped" in output) or not output:
@@ -119,15 +165,16 @@ def shutdown_server(host) -> bool:
     return False
 
 
-def start_server(host) -> bool:
+def start_server(host, environ=None) -> bool:
     """Start server"""
+    environ = os.environ if environ is None else environ
     invoke = True
     try:
-        instance_name = os.environ[settings.INSTANCE_NAME_ENV_VAR]
-        is_dir = os.environ[settings.IS_DIR_ENV_VAR]
+        instance_name = environ[settings.INSTANCE_NAME_ENV_VAR]
+        is_dir = environ[settings.IS_DIR_ENV_VAR]
         script_path = is_dir / pathlib.Path(f"instances/{instance_name}/bin/startup.sh")
         try:
-            ssh = SSHCommand.construct(host)
+            ssh = SSHCommand.construct(host, environ)
             ssh.invoke(f"{script_path}")
         except errors.RemoteCommandError as e:  # normal error handling
             log.error(e)
@@ -143,31 +190,188 @@ def start_server(host) -> bool:
     return invoke
 
 
-def check_start_status(host, port=5555) -> bool:
+@dataclasses.dataclass
+class StepResult:
+    step: str
+    ok: bool
+    seconds: float = 0.0
+    code: int = 0  # exit code of step
+    output: str = ''
+
+
+SESSION_MARK = "@@STEP "  # prefix of line with JSON result of step, printed by session script
+
+
+def _get_instance_dirs(environ):
+    """:return: (IS directory, directory of instance) from configuration of host, None if it is missing."""
+    try:
+        instance_name = environ[settings.INSTANCE_NAME_ENV_VAR]
+        is_dir = pathlib.Path(environ[settings.IS_DIR_ENV_VAR])
+    except KeyError:
+        log.error("Lack of configuration. Used variables: {} {}".format(
+            settings.IS_DIR_ENV_VAR, settings.INSTANCE_NAME_ENV_VAR
+        ))
+        return None
+    return is_dir, is_dir / f"instances/{instance_name}"
+
+
+def _shutdown_step(instance_dir):
+    # as shutdown_server - success when script says Stopped or nothing
+    return ("shutdown", 'out=$({} 2>&1); printf "%s\\n" "$out"; case "$out" in ""|*Stopped*) ;; *) exit 1;; esac'
+            .format(shlex.quote(str(instance_dir / "bin/shutdown.sh"))))
+
+
+def _start_step(instance_dir):
+    return ("start", shlex.quote(str(instance_dir / "bin/startup.sh")))
+
+
+def deploy_steps(environ=None, packages='all', removed=None, with_restart=True, waves=None):
+    """
+    Steps of deploy at host as shell snippets for `run_session` - the same as shutdown_server, run_is_instance,
+    remove_services and start_server do one by one.
+    :param environ: configuration of host, default os.environ,
+    :param removed: package -> service directories to remove (see `remove_services`),
+    :param waves: lists of packages activated one after another - is_instance step for each, default one for packages,
+    :return: list of (name, snippet), None if configuration is missing.
+    """
+    environ = os.environ if environ is None else environ
+    dirs = _get_instance_dirs(environ)
+    if dirs is None:
+        return None
+    is_dir, instance_dir = dirs
+    instance_name = instance_dir.name
+    steps = []
+    if with_restart:
+        steps.append(_shutdown_step(instance_dir))
+    for wave in waves or [packages]:
+        packages_str = wave if isinstance(wave, str) else ','.join(wave)
+        steps.append(("is_instance", "{} update -Dpackage.list={} -Dinstance.name={}".format(
+            shlex.quote(str(is_dir / "instances/is_instance.sh")), shlex.quote(packages_str),
+            shlex.quote(instance_name))))
+    paths = [str(instance_dir / "packages" / package / service) for package, services in (removed or {}).items()
+             for service in services if service and '..' not in service.split('/')]
+    if paths:
+        steps.append(("remove services", "rm -rf -- " + ' '.join(map(shlex.quote, paths))))
+    if with_restart:
+        steps.append(_start_step(instance_dir))
+    return steps
+
+
+def operation_steps(operation, environ=None):
+    """
+    Steps of operation on IS at host for `run_session`.
+    :param operation: 'stop' - shutdown of instance, 'start' - startup of instance,
+        'clean' - remove all packages from packages repository (packages installed in instance stay),
+    :param environ: configuration of host, default os.environ,
+    :return: list of (name, snippet), None if configuration is missing.
+    """
+    environ = os.environ if environ is None else environ
+    dirs = _get_instance_dirs(environ)
+    if dirs is None:
+        return None
+    is_dir, instance_dir = dirs
+    if operation == 'stop':
+        return [_shutdown_step(instance_dir)]
+    if operation == 'start':
+        return [_start_step(instance_dir)]
+    if operation == 'clean':
+        # links of package store are removed, its versions stay (see `sender.StoreCommand`)
+        return [("clean", "rm -rf -- {}/*".format(shlex.quote(str(is_dir / "packages"))))]
+    raise ValueError(f"Unknown operation {operation}")
+
+
+def session_script(steps) -> str:
+    """
+    Shell script running steps one after another, the first failed one stops it.
+    After each step a line SESSION_MARK {"step": name, "code": exit code, "seconds": duration} is printed.
+    """
+    lines = []
+    for name, snippet in steps:
+        lines += [
+            "started=$(date +%s)",
+            f"( {snippet}\n) < /dev/null 2>&1",  # stdin of session is the script itself
+            "code=$?",
+            'echo "{}{{\\"step\\": \\"{}\\", \\"code\\": $code, \\"seconds\\": $(( $(date +%s) - started ))}}"'
+            .format(SESSION_MARK, name),
+            '[ "$code" -eq 0 ] || exit "$code"',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def run_session(host, steps, environ=None, timeout=None) -> list:
+    """
+    Send script of steps to host and run it in one ssh session. Output is logged as it comes,
+    results of steps are parsed from lines printed by script.
+    :param steps: list of (name, shell snippet), see `deploy_steps`,
+    :param environ: configuration of host, default os.environ,
+    :param timeout: seconds for whole session, default SUBPROCESS_CMD_TIMEOUT for each step,
+    :return: list of StepResult of steps done - shorter than steps if session stopped.
+    """
+    ssh = SSHCommand.construct(host, environ)
+    if not ssh:
+        log.error("Cannot construct SSH client.")
+        return []
+    timeout = timeout or settings.SUBPROCESS_CMD_TIMEOUT * len(steps)
+    results, output = [], []
+    try:
+        with subprocess.Popen(ssh.args("sh -s"), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, encoding='utf-8', errors='replace',
+                              start_new_session=True) as process:
+            killed = threading.Event()
+
+            def kill():
+                killed.set()
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)  # with everything ssh started
+                except ProcessLookupError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                process.stdin.write(session_script(steps))
+                process.stdin.close()
+                for line in process.stdout:
+                    position = line.find(SESSION_MARK)  # output of step may not end with new line
+                    if position >= 0:
+                        output.append(line[:position])
+                        step = json.loads(line[position + len(SESSION_MARK):])
+                        result = StepResult(step["step"], step["code"] == 0, step["seconds"], step["code"],
+                                            ''.join(output))
+                        results.append(result)
+                        output = []
+                        log.info("[{}] step '{}' {} in {} s".format(
+                            host, result.step, "done" if result.ok else f"failed ({result.code})", result.seconds))
+                    else:
+                        output.append(line)
+                        log.info("[{}] {}".format(host, line.rstrip()))
+                process.wait()
+            finally:
+                timer.cancel()
+            if killed.is_set():
+                log.error(f"Session at {host} killed after {timeout} s")
+    except (OSError, ValueError) as e:
+        log.error(f"Session at {host} failed: {e}")
+    return results
+
+
+def check_start_status(host, port=5555, http=False) -> bool:
     """
     Check status of server after startup - wait timeout determined in settings
     :param host: host to connect
     :param port: port to connect - default as management port of IntegrationServer
+    :param http: flag for checking ping service of IS instead of only connecting, see `readiness`.
     :return: True if started, False otherwise.
     """
-    socket.setdefaulttimeout(settings.CHECK_CONNECTION_TIMEOUT)
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for attempt in range(settings.CHECK_START_STATUS_COUNT):
-        try:
-            log.info(f"Check connection, attempt: {attempt}")
-            s.connect((host, int(port)))
-            s.close()
-            return True
-        except TimeoutError:
-            log.error("Timeout error - server started failed.")
-            return False
-        except ConnectionRefusedError:
-            log.info(f"Connection refused.")
-            time.sleep(settings.CHECK_START_STATUS_TIME)
-        except Exception as e:
-            log.info(f"Another exception {e} will be supress")
-            time.sleep(settings.CHECK_START_STATUS_TIME)
-    return False
+    return readiness.wait_for_hosts([host], port, http)[host].ok
+
+
+def get_http_auth(environ=None):
+    """:return: (user, password) for HTTP readiness check from configuration of host, None if not set."""
+    environ = os.environ if environ is None else environ
+    user = environ.get(settings.IS_HTTP_USERNAME_ENV_VAR)
+    if not user:
+        return None
+    return user, environ.get(settings.IS_HTTP_PASSWORD_ENV_VAR, '')
 
 
 def clean_package_repo(host):
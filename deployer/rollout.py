@@ -0,0 +1,99 @@
+"""
+Rolling deployment of whole environment in one run - canary host(s) first, then zone by zone.
+Hosts of one wave are deployed concurrently (bounded, so rest of zone keeps serving),
+between waves health gate decides whether to continue: failures of wave must be within budget
+and restarted hosts must still answer after bake time.
+"""
+import dataclasses
+import time
+import typing
+
+from . import fleet, readiness, settings
+from .settings import log
+
+
+@dataclasses.dataclass
+class RolloutOptions:
+    canary: int = settings.ROLLOUT_CANARY  # hosts in the first wave
+    wave_parallel: int = None  # hosts of wave deployed at the same time, default as --parallel
+    max_failures: int = 0  # failed hosts of wave which still let rollout continue
+    bake_time: float = settings.ROLLOUT_BAKE_TIME  # seconds between wave and its health check
+    zone_order: list = None  # zones deployed first, see `plan_waves`
+
+
+@dataclasses.dataclass
+class Wave:
+    name: str
+    hosts: list
+
+
+def plan_waves(hosts: typing.Iterable, environments: dict, canary=1, zone_order=None) -> list:
+    """
+    Split hosts into waves.
+    :param hosts: hosts to deploy,
+    :param environments: dict host -> configuration with ZONE,
+    :param canary: how many hosts of the first zone go alone in the first wave, 0 - no canary wave,
+    :param zone_order: zones in order of deploy, the rest of zones after them sorted, hosts without zone last,
+    :return: list of Wave, without empty ones.
+    """
+    zones = {}
+    for host in sorted(hosts):
+        zones.setdefault(environments[host].get(settings.ZONE_ENV_VAR), []).append(host)
+    order = [zone for zone in (zone_order or []) if zone in zones]
+    order += sorted((zone for zone in zones if zone not in order and zone is not None))
+    if None in zones:
+        order.append(None)
+    waves = []
+    if canary and order:
+        waves.append(Wave("canary", zones[order[0]][:canary]))
+        zones[order[0]] = zones[order[0]][canary:]
+    waves += [Wave(f"zone {zone}" if zone else "no zone", zones[zone]) for zone in order]
+    return [wave for wave in waves if wave.hosts]
+
+
+def health_gate(results: dict, max_failures=0, recheck=(), http=False, bake_time=0, auth=None) -> str:
+    """
+    Check wave after deploy.
+    :param results: dict host -> fleet.HostResult of wave,
+    :param max_failures: how many hosts of wave may fail,
+    :param recheck: hosts to probe again after bake time (i.e. restarted ones), they all must be ready,
+    :param bake_time: seconds to wait before recheck, so hosts which crash soon after start are caught,
+    :return: empty string if rollout can continue, reason otherwise.
+    """
+    failed = sorted(host for host, result in results.items() if not result.ok)
+    if len(failed) > max_failures:
+        return "{} host(s) failed: {}".format(len(failed), ', '.join(failed))
+    recheck = [host for host in recheck if results[host].ok]
+    if bake_time:
+        log.info(f"Waiting {bake_time} s before health check of wave")
+        time.sleep(bake_time)
+    if recheck:
+        probes = readiness.wait_for_hosts(recheck, http=http, timeout=settings.READINESS_PROBE_TIMEOUT, auth=auth)
+        not_ready = sorted(host for host, probe in probes.items() if not probe.ok)
+        if not_ready:
+            return "host(s) not ready after bake time: {}".format(', '.join(not_ready))
+    return ''
+
+
+def run_rollout(waves: list, deploy_wave: typing.Callable, gate: typing.Callable) -> dict:
+    """
+    Deploy waves one after another.
+    :param deploy_wave: callable(wave) -> dict host -> fleet.HostResult,
+    :param gate: callable(wave, results of wave) -> reason to stop or empty string,
+    :return: dict host -> fleet.HostResult of all hosts, hosts of waves not started are 'skipped'.
+    """
+    results = {}
+    stopped = ''
+    for number, wave in enumerate(waves, start=1):
+        if stopped:
+            for host in wave.hosts:
+                results[host] = fleet.HostResult(host, False, 'skipped', message=f"rollout stopped: {stopped}")
+            continue
+        log.info("Wave {}/{} ({}): {}".format(number, len(waves), wave.name, ', '.join(wave.hosts)))
+        started = time.monotonic()
+        wave_results = deploy_wave(wave)
+        results.update(wave_results)
+        stopped = gate(wave, wave_results)
+        log.info("Wave {} done in {:.1f} s{}".format(wave.name, time.monotonic() - started,
+                                                    f" - stopping rollout: {stopped}" if stopped else ""))
+    return results
@@ -4,12 +4,21 @@ Packages built as zip archive will be sent to inbound directory.
 Otherwise, packages will be installed by using IntegrationServer/packages repo
 and using is_instance.sh script to copying for specific instance by their name.
 """
+import contextlib
+import hashlib
+import json
 import os
 import pathlib
+import shlex
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+import typing
 import dataclasses as dc
 
-from . import settings, config
+from . import settings, config, connections, errors, manifest, build
 from .settings import log
 
 
@@ -19,17 +28,28 @@ class SCPCommand:
     port: str
     username: str
     private_key_filename: pathlib.Path
+    options: list = dc.field(default_factory=list)  # extra ssh options, i.e. ControlPath
+    limit: int = None  # bandwidth limit in Kbit/s
 
-    def send_files(self, from_dir, to_dir) -> bool:
+    def args(self, sources, to_dir, recursive=False) -> list:
+        """Arguments of scp process sending sources to remote to_dir."""
+        args = ["scp", "-p", *self.options, "-i", str(self.private_key_filename), "-P", str(self.port)]
+        if self.limit:
+            args += ["-l", str(self.limit)]
+        if recursive:
+            args.append("-r")
+        return args + [str(source) for source in sources] + [f"{self.username}@{self.ip}:{to_dir}/"]
+
+    def send_files(self, from_dir, to_dir, suffix='') -> bool:
         """
         Sending files like i.e. *.zip.
         :param from_dir: where the files are located,
-        :param to_dir: absolute path for remote directory or relative from authorized user.
+        :param to_dir: absolute path for remote directory or relative from authorized user,
+        :param suffix: send only files which names end with it, i.e. '.zip'.
         :return: True if all good, False otherwise.
         """
-        str_files = ' '.join([e.path for e in os.scandir(from_dir) if e.is_file()])
-        args = f"scp -p -i {self.private_key_filename} -P {self.port} {str_files} {self.username}@{self.ip}:{to_dir}/"
-        command_args = args.split(' ')
+        files = [e.path for e in os.scandir(from_dir) if e.is_file() and e.name.endswith(suffix)]
+        command_args = self.args(files, to_dir)
         sent = True
         try:
             process_completed = subprocess.run(command_args, timeout=settings.SUBPROCESS_CMD_TIMEOUT)
@@ -54,8 +74,7 @@ class SCPCommand:
         :param to_dir: when that folder should be placed.
         :return: True if sent, False otherwise.
         """
-        args = f"scp -p -i {self.private_key_filename} -P {self.port} -r {name} {self.username}@{self.ip}:{to_dir}/"
-        command_args = args.split(' ')
+        command_args = self.args([name], to_dir, recursive=True)
         sent = True
         try:
             process_completed = subprocess.run(command_args, timeout=settings.SUBPROCESS_CMD_TIMEOUT)
@@ -91,23 +110,607 @@ class SCPCommand:
         return True
 
 
-def send_to_inbound(ref: str, host: str) -> bool:
+@dc.dataclass
+class TarCommand:
+    """
+    Send directories as one tar stream through a single ssh channel, instead of `scp -r` for each of them,
+    which pays a round trip for every small file (node.ndf, flow.xml...).
+    The stream is extracted remotely to a temporary directory next to destination and only when whole
+    stream is extracted, directories are moved in place of the old ones - broken transfer leaves them untouched.
+    """
+    ip: str
+    port: str
+    username: str
+    private_key_filename: pathlib.Path
+    options: list = dc.field(default_factory=list)  # extra ssh options, i.e. ControlPath
+    compress: bool = False  # gzip stream - for slow links, costs CPU on both sides
+    meter: typing.Callable = None  # called with size of every block sent, i.e. `transfers.TransferScheduler.meter`
+    transferred: int = 0  # bytes of stream sent by the last send_dirs
+    seconds: float = 0.0  # duration of the last send_dirs
+    timeout: float = None  # seconds without progress of stream, then both sides are killed, default from settings
+
+    @staticmethod
+    def extract_script(to_dir, compress=False, prepare=()) -> str:
+        """
+        Shell script which reads tar stream from stdin and atomically replaces directories in to_dir.
+        :param prepare: lines of script run after extraction to $tmp, before directories are moved in place.
+        """
+        to_dir = shlex.quote(str(to_dir))
+        return '\n'.join([
+            "set -e",
+            f"mkdir -p {to_dir}",
+            f"tmp=$(mktemp -d {to_dir}/.incoming.XXXXXX)",
+            "trap 'rm -rf \"$tmp\"' EXIT",
+            "tar -C \"$tmp\" -x{}f -".format('z' if compress else ''),
+            *prepare,
+            'for path in "$tmp"/*; do',
+            '  [ -e "$path" ] || continue',
+            '  name=$(basename "$path")',
+            f'  if [ -e {to_dir}/"$name" ]; then mv {to_dir}/"$name" "$tmp/.old.$name"; fi',
+            f'  mv "$path" {to_dir}/"$name"',
+            "done",
+        ])
+
+    def remote_args(self, script) -> list:
+        """Arguments of process which runs script at remote host."""
+        return ["ssh", *self.options, "-p", str(self.port), "-i", str(self.private_key_filename),
+                f"{self.username}@{self.ip}", script]
+
+    def stream(self, tar_args, script) -> bool:
+        """
+        Pipe output of local tar process to script run at remote host.
+        :param tar_args: arguments of tar writing stream to stdout,
+        :param script: shell script reading stream from stdin (see `extract_script`),
+        :return: True if both sides succeeded, False otherwise.
+        """
+        self.transferred, self.seconds = 0, 0.0
+        timeout = self.timeout or settings.SUBPROCESS_CMD_TIMEOUT
+        started = progressed = time.monotonic()
+        stopped, killed = threading.Event(), threading.Event()
+        try:
+            # stderr goes to file, so remote side never blocks on it while stream is written
+            with tempfile.TemporaryFile() as stderr, \
+                    subprocess.Popen(tar_args, stdout=subprocess.PIPE) as tar, \
+                    subprocess.Popen(self.remote_args(script), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                     stderr=stderr, start_new_session=True) as ssh:
+
+                def kill():
+                    tar.kill()
+                    try:
+                        os.killpg(ssh.pid, signal.SIGKILL)  # with everything ssh started
+                    except ProcessLookupError:
+                        pass
+
+                def watchdog():
+                    # remote which stopped reading stream (or never ends) must not hang deploy
+                    while not stopped.wait(min(1.0, timeout)):
+                        if time.monotonic() - progressed > timeout:
+                            killed.set()
+                            kill()
+                            return
+                watcher = threading.Thread(target=watchdog, daemon=True)
+                watcher.start()
+                try:
+                    try:
+                        for block in iter(lambda: tar.stdout.read(settings.TRANSFER_BLOCK), b''):
+                            ssh.stdin.write(block)
+                            progressed = time.monotonic()
+                            self.transferred += len(block)
+                            if self.meter:
+                                self.meter(len(block))
+                        ssh.stdin.close()
+                    except BrokenPipeError:
+                        tar.kill()
+                    ssh.wait()
+                    tar.wait()
+                except BaseException:
+                    kill()  # otherwise leaving `with` waits for them without limit
+                    raise
+                finally:
+                    stopped.set()
+                    watcher.join()
+                stderr.seek(0)
+                err = stderr.read()
+        except OSError as e:
+            log.error(e)
+            return False
+        except subprocess.SubprocessError as e:
+            log.error(e)
+            return False
+        self.seconds = time.monotonic() - started
+        if killed.is_set():
+            log.error(f"Sending tar stream to {self.ip} killed after {timeout} s without progress")
+            return False
+        if tar.returncode != 0 or ssh.returncode != 0:
+            log.error("Sending tar stream to {} failed (tar: {}, ssh: {}): {}".format(
+                self.ip, tar.returncode, ssh.returncode, err.decode('utf-8', 'replace').strip()))
+            return False
+        return True
+
+    def send_dirs(self, from_dir, to_dir) -> bool:
+        """
+        Send all directories from from_dir to to_dir at remote, like `SCPCommand.send_dirs`.
+        Symlinks are followed, as scp does.
+        :return: True if whole stream was sent and extracted, False otherwise.
+        """
+        names = sorted(e.name for e in os.scandir(from_dir) if e.is_dir())
+        self.transferred, self.seconds = 0, 0.0
+        if not names:
+            return True
+        tar_args = ["tar", "-C", str(from_dir), "-c{}hf".format('z' if self.compress else ''), "-", "--", *names]
+        if not self.stream(tar_args, self.extract_script(to_dir, self.compress)):
+            return False
+        log.info("Sent {} directories to {}: {} bytes in {:.1f} s ({:.1f} MiB/s)".format(
+            len(names), self.ip, self.transferred, self.seconds,
+            self.transferred / max(self.seconds, 1e-6) / 1024 ** 2))
+        return True
+
+
+@dc.dataclass
+class DeltaCommand(TarCommand):
+    """
+    Send only files which are missing or different at remote host, compared by sha256 with manifest of build.
+    Remote checksums are listed by one ssh command, changed files go in one tar stream,
+    which is extracted to a temporary directory first and then files are moved (renamed) in place.
+    """
+    delete: bool = False  # remove files of sent packages which are not in build - only for builds of whole packages
+    sent_files: int = 0  # statistics of the last sync
+    saved: int = 0  # bytes of files not sent, because remote has them
+    stale: int = 0  # files removed from remote
+
+    STALE_LIST = ".stale"  # list of files to remove, sent as first entry of stream
+
+    def listing(self, to_dir, names) -> dict:
+        """
+        Checksums of files in directories names of remote to_dir.
+        :return: dict relative path -> sha256, empty if directories do not exist.
+        :raise errors.RemoteCommandError: if listing cannot be made.
+        """
+        script = "cd {} 2>/dev/null || exit 0; find -H {} -type f -exec sha256sum {{}} + 2>/dev/null; exit 0".format(
+            shlex.quote(str(to_dir)), ' '.join(shlex.quote(name) for name in names))
+        try:
+            process = subprocess.run(self.remote_args(script), capture_output=True, encoding='utf-8',
+                                     timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise errors.RemoteCommandError(f"Cannot list files at {self.ip}: {e}")
+        if process.returncode != 0:
+            raise errors.RemoteCommandError(f"Cannot list files at {self.ip}: {process.stderr.strip()}")
+        remote = {}
+        for line in process.stdout.splitlines():
+            checksum, _, path = line.partition('  ')
+            if path and not checksum.startswith('\\'):  # escaped names are sent again
+                remote[path] = checksum
+        return remote
+
+    def apply_script(self, to_dir) -> str:
+        """Shell script which extracts stream, moves files in place and removes files from stale list."""
+        to_dir = shlex.quote(str(to_dir))
+        return '\n'.join([
+            "set -e",
+            f"mkdir -p {to_dir}",
+            f"dest=$(cd {to_dir} && pwd)",
+            'tmp=$(mktemp -d "$dest/.incoming.XXXXXX")',
+            "trap 'rm -rf \"$tmp\"' EXIT",
+            "tar -C \"$tmp\" -x{}f -".format('z' if self.compress else ''),
+            'cd "$tmp"',
+            # versions in package store (see `StoreCommand`) are immutable - linked package is copied first
+            'for name in */; do',
+            '  name=${name%/}',
+            '  if [ -L "$dest/$name" ]; then',
+            '    rm -rf "$dest/.$name.copy"; cp -RL "$dest/$name" "$dest/.$name.copy"',
+            '    rm "$dest/$name"; mv "$dest/.$name.copy" "$dest/$name"',
+            '  fi',
+            'done',
+            f"find . -type f ! -path ./{self.STALE_LIST} | while IFS= read -r file; do",
+            '  mkdir -p "$dest/$(dirname "$file")"',
+            '  mv -f "$file" "$dest/$file" || exit 1',
+            "done",
+            f"if [ -s {self.STALE_LIST} ]; then",
+            f"  tr '\\n' '\\0' < {self.STALE_LIST} | (cd \"$dest\" && xargs -0 rm -f --)",
+            "fi",
+        ])
+
+    def plan(self, from_dir, to_dir, build_manifest=None) -> tuple:
+        """
+        Compare files of packages of from_dir with remote to_dir.
+        :param build_manifest: manifest of from_dir (see `manifest.create_manifest`), default read or created,
+        :return: (relative path -> entry of files of packages, paths to send, stale paths to remove, bytes to send).
+        :raise errors.RemoteCommandError: if remote files cannot be listed.
+        """
+        build_manifest = build_manifest or manifest.read_manifest(from_dir) or manifest.create_manifest(from_dir)
+        files = {path: entry for path, entry in build_manifest["files"].items() if '/' in path}
+        if not files:
+            return files, [], [], 0
+        remote = self.listing(to_dir, sorted({path.split('/')[0] for path in files}))
+        to_send, stale = manifest.diff_manifests(files, remote)
+        return files, to_send, stale if self.delete else [], sum(files[path]["size"] for path in to_send)
+
+    def sync(self, from_dir, to_dir, build_manifest=None, planned=None) -> bool:
+        """
+        Make directories of from_dir at remote to_dir the same as in build.
+        :param build_manifest: manifest of from_dir (see `manifest.create_manifest`), default read or created,
+        :param planned: result of `plan` made already (i.e. to queue transfer by its size), default made now,
+        :return: True if synchronized, False otherwise.
+        """
+        self.sent_files, self.saved, self.stale, self.transferred = 0, 0, 0, 0
+        try:
+            files, to_send, stale, sent_size = planned or self.plan(from_dir, to_dir, build_manifest)
+        except errors.RemoteCommandError as e:
+            log.error(e)
+            return False
+        if not files:
+            return True
+        if to_send or stale:
+            with tempfile.TemporaryDirectory() as tmp:
+                pathlib.Path(tmp, self.STALE_LIST).write_text(''.join(f"{path}\n" for path in stale))
+                file_list = pathlib.Path(tmp, "files")
+                file_list.write_text(''.join(f"{path}\0" for path in to_send))
+                tar_args = ["tar", "-c{}hf".format('z' if self.compress else ''), "-",
+                            "-C", tmp, self.STALE_LIST, "-C", os.path.abspath(from_dir), "--null", "-T", str(file_list)]
+                if not self.stream(tar_args, self.apply_script(to_dir)):
+                    return False
+        self.sent_files, self.stale = len(to_send), len(stale)
+        self.saved = sum(entry["size"] for entry in files.values()) - sent_size
+        log.info("Delta to {}: sent {} of {} files ({} bytes), {} bytes saved, {} stale files removed".format(
+            self.ip, self.sent_files, len(files), sent_size, self.saved, self.stale))
+        return True
+
+
+_upload_state_lock = threading.Lock()
+
+
+def read_upload_state(build_dir) -> dict:
+    """:return: state of resumable uploads of build - host -> relative path -> entry, see `ResumableCommand`."""
+    try:
+        with open(pathlib.Path(build_dir) / build.UPLOAD_STATE_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def update_upload_state(build_dir, host, path, entry) -> None:
+    """
+    Save entry of file uploaded to host, None removes it. Hosts are uploaded concurrently, so file is guarded.
+    :param path: relative path of file, None with entry None removes all files of host.
+    """
+    with _upload_state_lock:
+        state = read_upload_state(build_dir)
+        files = state.setdefault(host, {})
+        if path is None:
+            files.clear()
+        elif entry is None:
+            files.pop(path, None)
+        else:
+            files[path] = entry
+        if not files:
+            del state[host]
+        state_path = pathlib.Path(build_dir) / build.UPLOAD_STATE_FILENAME
+        tmp = state_path.with_name(f".{state_path.name}.tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmp, state_path)
+
+
+@dc.dataclass
+class ResumableCommand(TarCommand):
+    """
+    Send directories like `TarCommand`, but large files (i.e. jars) are uploaded before in chunks,
+    each chunk verified by sha256 at remote side and recorded in upload state file of build.
+    When sending fails (timeout of flaky link), the next try continues from the last verified chunk.
+    Chunks go to to_dir/.partial, they are moved to packages after the rest of stream is extracted
+    and checksums of whole files match.
+    """
+    chunk_size: int = None  # default settings.RESUMABLE_CHUNK_SIZE
+    min_size: int = None  # smaller files go by tar stream, default settings.RESUMABLE_MIN_SIZE
+    retries: int = None  # tries of each chunk, default settings.RESUMABLE_RETRIES
+    resumed: int = 0  # chunks not sent again thanks to the state of the last send_dirs
+
+    LIST = ".resumable.list"  # relative paths of files uploaded in chunks
+    CHECKSUMS = ".resumable.sha256"  # `sha256sum -c` input for them
+
+    def __post_init__(self):
+        self.chunk_size = self.chunk_size or settings.RESUMABLE_CHUNK_SIZE
+        self.min_size = settings.RESUMABLE_MIN_SIZE if self.min_size is None else self.min_size
+        self.retries = self.retries or settings.RESUMABLE_RETRIES
+
+    def run(self, script, data=None) -> subprocess.CompletedProcess:
+        """Run script at remote host with data on stdin."""
+        return subprocess.run(self.remote_args(script), input=data, capture_output=True,
+                              timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+
+    def send_chunk(self, part, index, data) -> bool:
+        """Write chunk at its place in remote part file and check its sha256 read back."""
+        part = shlex.quote(part)
+        script = (f"dd of={part} bs={self.chunk_size} seek={index} conv=notrunc iflag=fullblock status=none && "
+                  f"dd if={part} bs={self.chunk_size} skip={index} count=1 status=none | sha256sum")
+        checksum = hashlib.sha256(data).hexdigest()
+        for attempt in range(1, self.retries + 1):
+            try:
+                process = self.run(script, data)
+                if process.returncode == 0 and process.stdout.decode('utf-8').split()[:1] == [checksum]:
+                    return True
+                log.error("Chunk {} of {} at {} not verified (attempt {}): {}".format(
+                    index, part, self.ip, attempt, process.stderr.decode('utf-8', 'replace').strip()))
+            except (OSError, subprocess.SubprocessError) as e:
+                log.error("Chunk {} of {} at {} failed (attempt {}): {}".format(index, part, self.ip, attempt, e))
+        return False
+
+    def upload_file(self, build_dir, relative, path, to_dir, entry=None) -> dict:
+        """
+        Upload file in chunks to to_dir/.partial/relative, skipping chunks already verified.
+        :param entry: state of file from the last try,
+        :return: state of file, with all chunks done if uploaded.
+        """
+        size = os.path.getsize(path)
+        checksum = manifest.hash_file(path)
+        chunks = max(1, -(-size // self.chunk_size))
+        part = f"{to_dir}/.partial/{relative}"
+        resumable = bool(entry) and entry["sha256"] == checksum and entry["chunk"] == self.chunk_size
+        entry = {"sha256": checksum, "size": size, "chunk": self.chunk_size, "done": entry["done"] if resumable else 0}
+        done = 0
+        try:
+            if resumable:
+                # remote part can be shorter than state says, i.e. cleaned meanwhile
+                process = self.run(f"stat -c %s {shlex.quote(part)} 2>/dev/null || echo 0")
+                remote_size = int(process.stdout.decode('utf-8').strip() or 0) if process.returncode == 0 else 0
+                done = min(entry["done"], remote_size // self.chunk_size)
+            if not done:
+                process = self.run(f"mkdir -p {shlex.quote(os.path.dirname(part))} && : > {shlex.quote(part)}")
+                if process.returncode != 0:
+                    log.error("Cannot create {} at {}: {}".format(
+                        part, self.ip, process.stderr.decode('utf-8', 'replace').strip()))
+                    update_upload_state(build_dir, self.ip, relative, dict(entry, done=0))
+                    return dict(entry, done=0)
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error(f"Preparing upload of {relative} to {self.ip} failed: {e}")
+            update_upload_state(build_dir, self.ip, relative, entry)
+            return dict(entry, done=0)  # chunks done before stay in state for the next try
+        self.resumed += done
+        entry = dict(entry, done=done)
+        with open(path, 'rb') as f:
+            f.seek(done * self.chunk_size)
+            for index in range(done, chunks):
+                data = f.read(self.chunk_size)
+                if not self.send_chunk(part, index, data):
+                    return entry
+                entry = dict(entry, done=index + 1)
+                update_upload_state(build_dir, self.ip, relative, entry)
+                self.transferred += len(data)
+                if self.meter:
+                    self.meter(len(data))
+        return entry
+
+    def send_dirs(self, from_dir, to_dir) -> bool:
+        """
+        Send all directories from from_dir to to_dir at remote, large files resumable.
+        :return: True if everything was sent and moved in place, False otherwise (the next call resumes).
+        """
+        names = sorted(e.name for e in os.scandir(from_dir) if e.is_dir())
+        self.resumed = 0
+        if not names:
+            return True
+        files = [(relative, path) for relative, path in manifest.iter_build_files(from_dir) if '/' in relative]
+        large = [(relative, path) for relative, path in files if os.path.getsize(path) >= self.min_size]
+        state = read_upload_state(from_dir).get(self.ip, {})
+        checksums = []
+        transferred, started = 0, time.monotonic()
+        for relative, path in large:
+            self.transferred = 0
+            entry = self.upload_file(from_dir, relative, path, to_dir, state.get(relative))
+            transferred += self.transferred
+            if entry["done"] < max(1, -(-entry["size"] // self.chunk_size)):
+                log.error(f"Uploading {relative} to {self.ip} interrupted - next try resumes it.")
+                return False
+            checksums.append(f"{entry['sha256']}  {relative}\n")
+        large_paths = {relative for relative, _ in large}
+        quoted_dir = shlex.quote(str(to_dir))
+        prepare = [
+            f'while IFS= read -r file; do',
+            '  mkdir -p "$tmp/$(dirname "$file")"',
+            f'  mv -f {quoted_dir}/.partial/"$file" "$tmp/$file" || exit 1',
+            f'done < "$tmp/{self.LIST}"',
+            f'(cd "$tmp" && sha256sum -c --quiet {self.CHECKSUMS})',
+            f'rm -f "$tmp/{self.LIST}" "$tmp/{self.CHECKSUMS}"',
+            f'rm -rf {quoted_dir}/.partial',
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            pathlib.Path(tmp, self.LIST).write_text(''.join(f"{relative}\n" for relative, _ in large))
+            pathlib.Path(tmp, self.CHECKSUMS).write_text(''.join(checksums))
+            file_list = pathlib.Path(tmp, "files")
+            file_list.write_text(''.join(f"{relative}\0" for relative, _ in files if relative not in large_paths))
+            tar_args = ["tar", "-c{}hf".format('z' if self.compress else ''), "-", "-C", tmp, self.LIST,
+                        self.CHECKSUMS, "-C", os.path.abspath(from_dir), "--null", "-T", str(file_list)]
+            if not self.stream(tar_args, self.extract_script(to_dir, self.compress, prepare)):
+                return False
+        self.transferred += transferred
+        self.seconds = time.monotonic() - started
+        update_upload_state(from_dir, self.ip, None, None)
+        log.info("Sent {} directories to {}: {} bytes in {:.1f} s, {} large files in chunks, {} chunks resumed"
+                 .format(len(names), self.ip, self.transferred, self.seconds, len(large), self.resumed))
+        return True
+
+
+@dc.dataclass
+class StoreCommand(TarCommand):
+    """
+    Keep every version of package once in package store of host, in directory named by digest of its content
+    (see `manifest.package_digests`), and make packages repository a set of symlinks to versions in store.
+    Only versions missing in store are sent (one tar stream), then symlink of each package is switched atomically
+    (rename over the old one), so deploying a version host already had - i.e. rollback - sends nothing.
+    Old versions are removed from store beyond `keep` of each package, the linked one is always kept.
+    """
+    keep: int = None  # versions of each package kept in store, default settings.PACKAGE_STORE_KEEP
+    reused: int = 0  # packages of the last deploy which were in store already
+
+    def __post_init__(self):
+        self.keep = settings.PACKAGE_STORE_KEEP if self.keep is None else self.keep
+
+    def present(self, store_dir) -> set:
+        """
+        Versions in remote store.
+        :return: set of 'package/digest'.
+        :raise errors.RemoteCommandError: if store cannot be listed.
+        """
+        script = ('cd {} 2>/dev/null || exit 0; for version in */*/; do [ -d "$version" ] && echo "${{version%/}}"; '
+                  'done; exit 0').format(shlex.quote(str(store_dir)))
+        try:
+            process = subprocess.run(self.remote_args(script), capture_output=True, encoding='utf-8',
+                                     timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise errors.RemoteCommandError(f"Cannot list package store at {self.ip}: {e}")
+        if process.returncode != 0:
+            raise errors.RemoteCommandError(f"Cannot list package store at {self.ip}: {process.stderr.strip()}")
+        return set(process.stdout.split())
+
+    def switch_script(self, store_dir, repo_dir, digests, missing=()) -> str:
+        """
+        Shell script which moves versions sent as tar stream (if any missing) to store, switches symlinks
+        in repository to versions of digests and collects garbage of store.
+        """
+        lines = [
+            "set -e",
+            "mkdir -p {0} {1}".format(shlex.quote(str(store_dir)), shlex.quote(str(repo_dir))),
+            "store=$(cd {} && pwd)".format(shlex.quote(str(store_dir))),
+            "packages=$(cd {} && pwd)".format(shlex.quote(str(repo_dir))),
+        ]
+        if missing:
+            lines += [
+                'tmp=$(mktemp -d "$store/.incoming.XXXXXX")',
+                "trap 'rm -rf \"$tmp\"' EXIT",
+                "tar -C \"$tmp\" -x{}f -".format('z' if self.compress else ''),
+            ]
+        for name in missing:
+            version = shlex.quote(f"{name}/{digests[name]}")
+            lines += [
+                'mkdir -p "$store"/{}'.format(shlex.quote(name)),
+                # other deploy could store the same version meanwhile
+                'if [ ! -e "$store"/{0} ]; then mv "$tmp"/{1} "$store"/{0}; fi'.format(version, shlex.quote(name)),
+            ]
+        for name, digest in sorted(digests.items()):
+            version, link, old = (shlex.quote(path) for path in (f"{name}/{digest}", f".{name}.link", f".{name}.old"))
+            lines += [
+                'ln -sfn "$store"/{} "$packages"/{}'.format(version, link),
+                # directory of package deployed before store is moved aside, it cannot be replaced by rename
+                'if [ -d "$packages"/{0} ] && [ ! -L "$packages"/{0} ]; then rm -rf "$packages"/{1}; '
+                'mv "$packages"/{0} "$packages"/{1}; fi'.format(shlex.quote(name), old),
+                'mv -Tf "$packages"/{} "$packages"/{}'.format(link, shlex.quote(name)),
+                'rm -rf "$packages"/{}'.format(old),
+                'touch "$store"/{}'.format(version),  # the newest version for garbage collection
+            ]
+        if self.keep:
+            lines += [
+                'for dir in "$store"/*/; do',
+                '  [ -d "$dir" ] || continue',
+                '  name=$(basename "$dir")',
+                '  current=$(readlink "$packages/$name" || true)',
+                f'  ls -1t "$dir" | tail -n +{self.keep + 1} | while IFS= read -r version; do',
+                '    [ "$store/$name/$version" = "$current" ] || rm -rf "$store/$name/$version"',
+                '  done',
+                'done',
+            ]
+        return '\n'.join(lines)
+
+    def plan(self, from_dir, store_dir, build_manifest=None) -> tuple:
+        """
+        Compare versions of packages of from_dir with remote store_dir.
+        :param build_manifest: manifest of from_dir (see `manifest.create_manifest`), default read or created,
+        :return: (package -> digest of version, sorted packages missing in store, bytes to send).
+        :raise errors.RemoteCommandError: if store cannot be listed.
+        """
+        build_manifest = build_manifest or manifest.read_manifest(from_dir) or manifest.create_manifest(from_dir)
+        digests = manifest.package_digests(build_manifest)
+        if not digests:
+            return digests, [], 0
+        present = self.present(store_dir)
+        missing = sorted(name for name, digest in digests.items() if f"{name}/{digest}" not in present)
+        missing_set = set(missing)
+        size = sum(entry["size"] for path, entry in build_manifest["files"].items()
+                   if '/' in path and path.split('/')[0] in missing_set)
+        return digests, missing, size
+
+    def deploy(self, from_dir, repo_dir, store_dir, build_manifest=None, planned=None) -> bool:
+        """
+        Make packages of from_dir the linked versions in remote repo_dir, sending only versions missing in store_dir.
+        :param build_manifest: manifest of from_dir (see `manifest.create_manifest`), default read or created,
+        :param planned: result of `plan` made already (i.e. to queue transfer by its size), default made now,
+        :return: True if all packages are linked, False otherwise.
+        """
+        self.transferred, self.seconds, self.reused = 0, 0.0, 0
+        try:
+            digests, missing, _ = planned or self.plan(from_dir, store_dir, build_manifest)
+        except errors.RemoteCommandError as e:
+            log.error(e)
+            return False
+        if not digests:
+            return True
+        script = self.switch_script(store_dir, repo_dir, digests, missing)
+        if missing:
+            tar_args = ["tar", "-C", str(from_dir), "-c{}hf".format('z' if self.compress else ''), "-", "--",
+                        *missing]
+            if not self.stream(tar_args, script):
+                return False
+        else:
+            try:
+                process = subprocess.run(self.remote_args(script), stdin=subprocess.DEVNULL, capture_output=True,
+                                         encoding='utf-8', timeout=settings.SUBPROCESS_CMD_TIMEOUT)
+            except (OSError, subprocess.SubprocessError) as e:
+                log.error(f"Switching packages at {self.ip} failed: {e}")
+                return False
+            if process.returncode != 0:
+                log.error(f"Switching packages at {self.ip} failed: {process.stderr.strip()}")
+                return False
+        self.reused = len(digests) - len(missing)
+        log.info("Package store at {}: {} package(s) sent ({} bytes), {} already stored, {} linked".format(
+            self.ip, len(missing), self.transferred, self.reused, len(digests)))
+        return True
+
+
+def get_transfer_size(src_dir, suffix=None) -> int:
+    """
+    Bytes to send from build directory - files with suffix or everything described by manifest of build.
+    """
+    if suffix:
+        return sum(e.stat().st_size for e in os.scandir(src_dir) if e.is_file() and e.name.endswith(suffix))
+    build_manifest = manifest.read_manifest(src_dir)
+    if build_manifest:
+        return build_manifest["size"]
+    return sum(path.stat().st_size for _, path in manifest.iter_build_files(src_dir))
+
+
+def scheduled(scheduler, host, environ, size):
+    """Slot of scheduler for transfer to host (see `transfers.TransferScheduler.slot`), no-op without scheduler."""
+    if scheduler is None:
+        return contextlib.nullcontext(None)
+    return scheduler.slot(host, size, environ.get(settings.ZONE_ENV_VAR))
+
+
+def send_to_inbound(ref: str, host: str, environ=None, scheduler=None) -> bool:
     """
     For now this used `scp` command to send ZIP-s.
     :param: ref Commit from which Directory of current build will be named.
+    :param environ: configuration of host (see `config.get_host_environment`), default os.environ.
+    :param scheduler: transfers.TransferScheduler limiting concurrency and bandwidth, None - send at once.
     :return: True if sending process goes well, otherwise, False.
     """
+    environ = os.environ if environ is None else environ
     sent = True
     try:
-        dst_dir = os.environ[settings.INBOUND_DIR_ENV_VAR]
+        dst_dir = environ[settings.INBOUND_DIR_ENV_VAR]
         ssh_host = host
-        ssh_port = os.environ[settings.SSH_PORT_ENV_VAR]
-        is_username = os.environ[settings.IS_NODE_USERNAME_ENV_VAR]
-        is_private_key_filepath = os.environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
-        scp = SCPCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath))
+        ssh_port = environ[settings.SSH_PORT_ENV_VAR]
+        is_username = environ[settings.IS_NODE_USERNAME_ENV_VAR]
+        is_private_key_filepath = environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
+        scp = SCPCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                         connections.options(ssh_host, ssh_port, is_username, is_private_key_filepath))
         src_dir = config.get_build_dir(ref)
-        if not scp.send_files(src_dir, dst_dir):
-            sent = False
+        size = get_transfer_size(src_dir, suffix='.zip') if scheduler else 0
+        with scheduled(scheduler, host, environ, size) as progress:
+            if progress:
+                scp.limit = scheduler.scp_limit(progress.zone)
+            if not scp.send_files(src_dir, dst_dir, suffix='.zip'):
+                sent = False
+            elif progress:
+                progress.sent = size
     except KeyError:
         sent = False
         log.error("Lack of configuration for inbound folder. Used variables: {}, {}, {}, {}."
@@ -118,25 +721,73 @@ def send_to_inbound(ref: str, host: str) -> bool:
     return sent
 
 
-def send_to_packages_repo(ref, host):
+def send_to_packages_repo(ref, host, environ=None, method=None, compress=None, delete=False, scheduler=None):
     """
     Copy files from build_ to remote IS repository - see docs.
     :param ref: build_{ref}
     :param host: when to send
+    :param environ: configuration of host (see `config.get_host_environment`), default os.environ.
+    :param method: 'scp' - scp -r for each package, 'tar' - one tar stream (see `TarCommand`),
+        'delta' - only files which differ (see `DeltaCommand`), 'resumable' - large files in chunks which are
+        not sent again on retry (see `ResumableCommand`), 'store' - versions of packages missing in package store
+        of host, repository links to them (see `StoreCommand`), default from settings,
+    :param compress: flag for gzip of tar stream, default from settings,
+    :param delete: flag for removing files of sent packages which are not in build (only with 'delta'),
+    :param scheduler: transfers.TransferScheduler limiting concurrency and bandwidth, None - send at once.
     :return:
     """
+    method = method or settings.TRANSFER_METHOD
+    compress = settings.TRANSFER_COMPRESS if compress is None else compress
+    environ = os.environ if environ is None else environ
     sent = True
     try:
-        is_dir = pathlib.Path(os.environ[settings.IS_DIR_ENV_VAR])
+        is_dir = pathlib.Path(environ[settings.IS_DIR_ENV_VAR])
         repo_path = is_dir / "packages"
         ssh_host = host
-        ssh_port = os.environ[settings.SSH_PORT_ENV_VAR]
-        is_username = os.environ[settings.IS_NODE_USERNAME_ENV_VAR]
-        is_private_key_filepath = os.environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
-        scp = SCPCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath))
+        ssh_port = environ[settings.SSH_PORT_ENV_VAR]
+        is_username = environ[settings.IS_NODE_USERNAME_ENV_VAR]
+        is_private_key_filepath = environ[settings.IS_NODE_PRIVKEY_ENV_VAR]
+        options = connections.options(ssh_host, ssh_port, is_username, is_private_key_filepath)
         src_dir = config.get_build_dir(ref)
-        if not scp.send_dirs(src_dir, repo_path):
-            sent = False
+        store_dir = is_dir / settings.PACKAGE_STORE_DIR
+        planned = None
+        if method == 'delta':
+            command = DeltaCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                                   options, compress, delete=delete)
+        elif method == 'store':
+            command = StoreCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                                   options, compress)
+        if method in ('delta', 'store') and scheduler:
+            # transfer waits for slot by bytes this host really misses, not by size of whole build
+            try:
+                planned = command.plan(src_dir, repo_path if method == 'delta' else store_dir)
+            except errors.RemoteCommandError as e:
+                log.error(e)
+                return False
+            size = planned[-1]
+        else:
+            size = get_transfer_size(src_dir) if scheduler else 0
+        with scheduled(scheduler, host, environ, size) as progress:
+            meter = scheduler.meter(progress) if progress else None
+            if method == 'delta':
+                command.meter = meter
+                return command.sync(src_dir, repo_path, planned=planned)
+            if method == 'store':
+                command.meter = meter
+                return command.deploy(src_dir, repo_path, store_dir, planned=planned)
+            if method == 'tar':
+                command = TarCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                                     options, compress, meter)
+            elif method == 'resumable':
+                command = ResumableCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                                           options, compress, meter)
+            else:
+                command = SCPCommand(ssh_host, ssh_port, is_username, pathlib.Path(is_private_key_filepath),
+                                     options, scheduler.scp_limit(progress.zone) if progress else None)
+            if not command.send_dirs(src_dir, repo_path):
+                sent = False
+            elif progress and method not in ('tar', 'resumable'):
+                progress.sent = size
     except KeyError:
         log.error("Lack of configuration - check out! Used variables: {}, {}, {}, {}."
                   .format(settings.IS_DIR_ENV_VAR,
@@ -34,13 +34,17 @@ PIPELINE_REFERENCE = "CI_MERGE_REQUEST_IID"
 ZONE_ENV_VAR = "ZONE"  # support for zones.
 BUILD_DIR_ENV_VAR = 'BUILD_DIR'  # repository where archives are created.
 CONFIG_DIR_ENV_VAR = 'CONFIG_DIR'
+BUILD_CACHE_DIR_ENV_VAR = 'BUILD_CACHE_DIR'  # shared cache of archives between builds, not set - no cache.
 # variables to use in configuration of environments
 INBOUND_DIR_ENV_VAR = 'INBOUND_DIR'
 SSH_ADDRESS_ENV_VAR = 'SSH_ADDRESS'
 SSH_PORT_ENV_VAR = 'SSH_PORT'
 IS_NODE_USERNAME_ENV_VAR = 'IS_NODE_USERNAME'
 IS_NODE_PRIVKEY_ENV_VAR = 'IS_NODE_PRIVKEY'
+PEER_PRIVKEY_ENV_VAR = 'PEER_PRIVKEY'  # key at node for copying to other nodes in fan-out, default ssh keys of node.
 INSTANCE_NAME_ENV_VAR = "INSTANCE_NAME"
+IS_HTTP_USERNAME_ENV_VAR = 'IS_HTTP_USERNAME'  # credentials for HTTP readiness check, optional.
+IS_HTTP_PASSWORD_ENV_VAR = 'IS_HTTP_PASSWORD'
 IS_DIR_ENV_VAR = "INTEGRATION_SERVER_DIR"
 NODES_ENV_VAR = "NODES"  # IPv4 separated by comma (,) - hosts where to send files
 # Environment - set below from gitlab pipeline.
@@ -63,6 +67,55 @@ SUBPROCESS_CMD_TIMEOUT = 300  # timeout in seconds.
 CHECK_CONNECTION_TIMEOUT = 90  # in seconds
 CHECK_START_STATUS_TIME = 30  # in seconds, waiting after execute shutdown command.
 CHECK_START_STATUS_COUNT = 60  # how many times check before return False
+READINESS_PORT = 5555  # port of IS probed after start.
+READINESS_TIMEOUT = CHECK_START_STATUS_TIME * CHECK_START_STATUS_COUNT  # in seconds, for host to get ready.
+READINESS_PROBE_TIMEOUT = 5  # in seconds, for one probe.
+READINESS_BACKOFF_INITIAL = 1  # in seconds, the first wait between probes, doubled after each one...
+READINESS_BACKOFF_MAX = 30  # ...up to that.
+READINESS_HTTP = False  # probe ping service of IS by HTTP instead of only TCP connect.
+READINESS_HTTP_PATH = "/invoke/wm.server/ping"
+BUILD_WORKERS = None  # processes for building inbound archives, None means number of CPUs.
+REPRODUCIBLE_ARCHIVES = False  # sorted entries, fixed timestamps and permissions, sha256 next to each ZIP.
+ARCHIVE_COMPRESS_LEVEL = 6  # deflate level for text files in archives - fixed, so output is stable.
+# already compressed formats - stored in archives without compression.
+ARCHIVE_STORED_EXT = ("jar", "zip", "war", "ear", "gz", "tgz", "bz2", "xz", "7z", "png", "jpg", "jpeg", "gif")
+STAGING_MODE = 'copy'  # 'copy' or 'link' - build packages for is_instance from reflinks/hardlinks of sources.
+MANIFEST_HASH_BLOCK = 1024 * 1024  # bytes hashed at once for manifest of build.
+MANIFEST_MMAP_THRESHOLD = 64 * 1024 * 1024  # files bigger than that are memory-mapped for hashing.
+SSH_MULTIPLEX = False  # one master ssh connection per host for all commands and transfers of job.
+SSH_CONTROL_PERSIST = 600  # in seconds, how long master connection waits idle before it closes itself.
+TRANSFER_METHOD = 'scp'  # 'scp' - scp -r per package, 'tar' - one tar stream over ssh, extracted atomically,
+# 'delta' - only files which sha256 differs from files already in packages repository of host,
+# 'resumable' - like 'tar', but large files go before in verified chunks, retry continues from the last one.
+# 'store' - versions of packages kept in package store of host by content, packages repository links to them.
+PACKAGE_STORE_DIR = "package_store"  # relative to IS_DIR, versions of packages for 'store' transfer.
+PACKAGE_STORE_KEEP = 3  # versions of each package kept in package store (linked one included), 0 - keep all.
+TRANSFER_DELETE_STALE = False  # with 'delta' remove files of sent packages which are not in build.
+TRANSFER_COMPRESS = False  # gzip tar stream, worth it only on slow links.
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # bytes of one chunk of resumable upload.
+RESUMABLE_MIN_SIZE = 16 * 1024 * 1024  # files from that size are uploaded in chunks with 'resumable' transfer.
+RESUMABLE_RETRIES = 3  # tries of one chunk before upload is interrupted (and resumed by the next deploy).
+TRANSFER_BLOCK = 1024 * 1024  # bytes read from tar and written to ssh at once.
+TRANSFER_MAX_CONCURRENT = 4  # transfers from runner at the same time when not set by --max-transfers.
+ZONE_BANDWIDTH = {}  # zone -> MiB/s, cap of all transfers from runner to hosts of that zone, i.e. {"dc2": 20}.
+TRANSFER_REPORT_INTERVAL = 10  # in seconds, how often progress of transfers is logged.
+REMOTE_SESSION = False  # shutdown, is_instance and startup by one generated script in one ssh session.
+ROLLOUT_CANARY = 1  # hosts deployed alone before the rest of environment with --rollout.
+ROLLOUT_BAKE_TIME = 0  # in seconds, wait after wave before its health check, with --rollout.
+FANOUT_DEGREE = 2  # in fan-out every node which already has packages copies them to that many peers.
+DEPLOY_PARALLEL = 1  # how many hosts are deployed at the same time by default.
+FLEET_PARALLEL = 8  # hosts at the same time for stop, start, clean, backup, rollback and exec by default.
+EXEC_TIMEOUT = 60  # in seconds, for command of 'exec' action at one host.
+PREFLIGHT = True  # check all hosts (connection, ssh key, IS directory, free space) before deploy sends anything.
+PREFLIGHT_TIMEOUT = 10  # in seconds, for connection to host in preflight.
+PREFLIGHT_PARALLEL = 64  # hosts checked at the same time.
+PREFLIGHT_SPACE_FACTOR = 2  # free space required at host as multiple of build size (repository and instance).
+BACKUP_DIR = "backups"  # relative to IS_DIR, snapshots of packages of instances (in subdirectory named as instance).
+BACKUP_MODE = 'reflink'  # 'reflink' - cp --reflink=auto (copy-on-write or full copy), 'link' - cp -al (hardlinks).
+BACKUP_KEEP = 3  # snapshots kept at each host, the oldest are removed after new one is taken, 0 - keep all.
+BACKUP_BEFORE_DEPLOY = False  # take snapshot of packages of instance before is_instance in every deploy.
+BUILD_CACHE_MAX_SIZE = 20 * 1024 ** 3  # in bytes, the least recently used archives are evicted above it.
+BUILD_CACHE_MAX_AGE = 14 * 24 * 3600  # in seconds, archives not used that long are evicted.
 # WHOLE_TIME = CHECK_STOP_STATUS_TIME * CHECK_STOP_STATUS_COUNT
 
 PACKAGES_TO_EXCLUDE = ["TpOssAdministrativeTools", "TpOssConfig", "TpOssConnectorChannel*"]
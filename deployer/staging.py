@@ -0,0 +1,85 @@
+"""
+Staging of build_{ref} directory without copying content of files.
+Files are reflinked (copy-on-write clone) where filesystem supports it, hardlinked otherwise,
+and copied only when both are impossible, i.e. build directory is on another filesystem than sources.
+Nothing in build directory is modified in place after staging, so sharing data with sources is safe.
+"""
+import dataclasses
+import fcntl
+import functools
+import os
+import shutil
+
+FICLONE = 0x40049409  # ioctl from linux/fs.h - clone whole file
+
+
+@dataclasses.dataclass
+class StagingStats:
+    reflinked: int = 0
+    linked: int = 0
+    copied: int = 0
+    bytes_avoided: int = 0  # bytes which would be copied without staging
+    bytes_copied: int = 0
+
+    def report(self) -> str:
+        return ("Staging avoided copying {} bytes (reflinked {}, hardlinked {}, copied {} files - {} bytes)"
+                .format(self.bytes_avoided, self.reflinked, self.linked, self.copied, self.bytes_copied))
+
+
+def reflink(src, dst) -> bool:
+    """
+    Clone file src as dst sharing its blocks (btrfs, xfs, ...).
+    :return: True if cloned, False if filesystem does not support it.
+    """
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def link_or_copy(src, dst, stats=None, try_reflink=True) -> str:
+    """
+    Place src as dst by reflink, hardlink or copy - the first which works.
+    Existing dst is removed before, so data shared with other file is never overwritten.
+    Signature is compatible with `copy_function` of `shutil.copytree`.
+    :param stats: StagingStats to count in, optional,
+    :param try_reflink: flag whether to try reflink before hardlink.
+    :return: dst.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    size = os.path.getsize(src)
+    if try_reflink and reflink(src, dst):
+        if stats:
+            stats.reflinked += 1
+            stats.bytes_avoided += size
+        return dst
+    try:
+        os.link(src, dst)
+        if stats:
+            stats.linked += 1
+            stats.bytes_avoided += size
+        return dst
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    if stats:
+        stats.copied += 1
+        stats.bytes_copied += size
+    return dst
+
+
+def copytree(src, dst, stats=None, ignore=None, dirs_exist_ok=False):
+    """
+    `shutil.copytree` which places files by `link_or_copy`.
+    :param stats: StagingStats to count in, optional.
+    """
+    return shutil.copytree(src, dst, ignore=ignore, dirs_exist_ok=dirs_exist_ok,
+                           copy_function=functools.partial(link_or_copy, stats=stats))
@@ -0,0 +1,149 @@
+"""
+Scheduler of transfers from runner to hosts, so parallel deploy does not saturate links between datacenters.
+- at most `max_concurrent` transfers at once, waiting ones are started largest first (shortest makespan) -
+  size is what the host really misses with 'delta' and 'store' transfers, whole build with the others,
+- bandwidth of every zone is capped - tar streams are throttled per block by token bucket of zone,
+  scp gets fixed share of cap of zone (cap / max_concurrent) by `-l`,
+- bytes and bytes/s of every host are logged periodically while transfers run.
+Using example:
+with transfers.TransferScheduler(4, {"dc2": 20 * 1024 ** 2}) as scheduler:
+    sender.send_to_packages_repo(ref, host, environ, scheduler=scheduler)
+"""
+import contextlib
+import dataclasses
+import itertools
+import threading
+import time
+
+from . import settings
+from .settings import log
+
+
+class TokenBucket:
+    """Rate limit in bytes per second shared by all transfers of one zone, bursts up to one second of rate."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size) -> None:
+        """Take size bytes, sleep if rate is exceeded."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+@dataclasses.dataclass
+class Progress:
+    host: str
+    size: int  # expected bytes
+    zone: str = None
+    sent: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second."""
+        end = self.finished or time.monotonic()
+        return self.sent / (end - self.started) if self.started and end > self.started else 0.0
+
+
+class TransferScheduler:
+    def __init__(self, max_concurrent=None, zone_bandwidth=None, report_interval=None):
+        """
+        :param max_concurrent: transfers at the same time, default settings.TRANSFER_MAX_CONCURRENT,
+        :param zone_bandwidth: dict zone -> bytes per second, zones out of it are not limited,
+        :param report_interval: seconds between progress logs, 0 - no logs.
+        """
+        self.max_concurrent = max(1, max_concurrent or settings.TRANSFER_MAX_CONCURRENT)
+        self.buckets = {zone: TokenBucket(rate) for zone, rate in (zone_bandwidth or {}).items() if rate}
+        self.report_interval = settings.TRANSFER_REPORT_INTERVAL if report_interval is None else report_interval
+        self.condition = threading.Condition()
+        self.waiting = []  # (-size, order, host) - largest first, then in order of coming
+        self.order = itertools.count()
+        self.running = {}  # host -> Progress
+        self.progress = {}  # host -> Progress of all transfers
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def __enter__(self):
+        if self.report_interval:
+            self.reporter = threading.Thread(target=self._report_loop, daemon=True)
+            self.reporter.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.reporter:
+            self.reporter.join()
+        if self.progress:
+            log.info("Transfers:\n" + self.report())
+        return False
+
+    @contextlib.contextmanager
+    def slot(self, host, size, zone=None):
+        """
+        Wait for free slot and run transfer of host in it.
+        :param size: bytes to send - larger transfers get slots first,
+        :param zone: zone of host for bandwidth cap,
+        :return: Progress of transfer, update it by `meter`.
+        """
+        ticket = (-size, next(self.order), host)
+        with self.condition:
+            self.waiting.append(ticket)
+            self.waiting.sort()
+            self.condition.wait_for(lambda: len(self.running) < self.max_concurrent and self.waiting[0] == ticket)
+            self.waiting.pop(0)
+            progress = Progress(host, size, zone, started=time.monotonic())
+            self.running[host] = self.progress[host] = progress
+            self.condition.notify_all()
+        try:
+            yield progress
+        finally:
+            with self.condition:
+                progress.finished = time.monotonic()
+                del self.running[host]
+                self.condition.notify_all()
+
+    def meter(self, progress):
+        """:return: callable(bytes) for sending process, counting bytes and throttling to cap of zone."""
+        bucket = self.buckets.get(progress.zone)
+
+        def sent(size):
+            if bucket:
+                bucket.consume(size)
+            progress.sent += size
+        return sent
+
+    def scp_limit(self, zone):
+        """
+        :return: limit for `scp -l` in Kbit/s, None if zone has no cap. scp cannot be throttled once it runs,
+        so each transfer gets fixed share of cap for max_concurrent transfers - together they never exceed the cap.
+        """
+        bucket = self.buckets.get(zone)
+        if not bucket:
+            return None
+        return max(1, int(bucket.rate * 8 / 1000 / self.max_concurrent))
+
+    def report(self) -> str:
+        """Bytes and bytes/s of every transfer."""
+        lines = []
+        for progress in self.progress.values():
+            state = "done" if progress.finished else "running"
+            lines.append("{:<20} {:<8} {:>12}/{:<12} {:>8.1f} MiB/s".format(
+                progress.host, state, progress.sent, progress.size, progress.rate / 1024 ** 2))
+        return '\n'.join(lines)
+
+    def _report_loop(self):
+        while not self.stopped.wait(self.report_interval):
+            with self.condition:
+                active = bool(self.running)
+            if active:
+                log.info("Transfers in progress:\n" + self.report())
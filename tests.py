@@ -1,8 +1,22 @@
+import contextlib
+import hashlib
+import http.server
+import itertools
 import os
+import random
 import pathlib
 import unittest
+import unittest.mock
+import shlex
 import shutil
+import socket
 import subprocess
+import tempfile
+import sys
+import threading
+import time
+import zipfile
+import zlib
 
 from deployer import *
 
@@ -83,6 +97,228 @@ class BuildingPackage(unittest.TestCase):
         # self.assertTrue(result)
 
 
+def _make_packages(repo_dir, names, files_count=3):
+    """Create small fake packages tree in repo_dir/packages."""
+    for name in names:
+        svc_dir = pathlib.Path(repo_dir) / "packages" / name / "ns" / "tp" / "oss" / name.lower() / "pub" / "svc"
+        os.makedirs(svc_dir, exist_ok=True)
+        for i in range(files_count):
+            with open(svc_dir / f"file{i}.xml", 'w') as f:
+                f.write(f"<flow name='{name}' index='{i}'/>\n" * (i + 1))
+        with open(pathlib.Path(repo_dir) / "packages" / name / "manifest.v3", 'w') as f:
+            f.write("<Values version='2.0'></Values>\n")
+
+
+class ParallelInboundBuildTC(unittest.TestCase):
+    PACKAGES = ["TpOssFirst", "TpOssSecond", "CaOssThird"]
+
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        _make_packages("./fake_repo", self.PACKAGES)
+        os.environ[settings.CI_PROJECT_DIR] = '.'
+        os.environ[settings.REPO_DIR_ENV_VAR] = './fake_repo'
+        os.environ[settings.BUILD_DIR_ENV_VAR] = './fake_builds'
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_build_many_packages_in_pool(self):
+        self.assertTrue(build.build_packages_for_inbound(self.PACKAGES, 'POOL', workers=2))
+        zips = sorted(e.name for e in os.scandir('./fake_builds/build_POOL'))
+        self.assertListEqual(zips, sorted(f"{p}.zip" for p in self.PACKAGES))
+
+    def test_all_failures_reported(self):
+        result = build.build_packages_for_inbound(self.PACKAGES + ["TpOssMissing", "TpOssMissing2"], 'POOL', workers=2)
+        self.assertFalse(result)
+        zips = [e.name for e in os.scandir('./fake_builds/build_POOL')]
+        self.assertIn("TpOssFirst.zip", zips)
+
+    def test_package_size(self):
+        self.assertGreater(build.get_package_size("TpOssFirst"), 0)
+        self.assertEqual(build.get_package_size("TpOssMissing"), 0)
+
+
+class BuildCacheTC(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        _make_packages("./fake_repo", ["TpOssCached"])
+        os.environ[settings.CI_PROJECT_DIR] = '.'
+        os.environ[settings.REPO_DIR_ENV_VAR] = './fake_repo'
+        os.environ[settings.BUILD_DIR_ENV_VAR] = './fake_builds'
+        os.environ[settings.BUILD_CACHE_DIR_ENV_VAR] = './fake_builds/cache'
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_second_build_is_taken_from_cache(self):
+        self.assertTrue(build.build_package_for_inbound("TpOssCached", "FIRST"))
+        self.assertTrue(build.build_package_for_inbound("TpOssCached", "SECOND"))
+        first = os.stat('./fake_builds/build_FIRST/TpOssCached.zip')
+        second = os.stat('./fake_builds/build_SECOND/TpOssCached.zip')
+        self.assertEqual(first.st_ino, second.st_ino)
+
+    def test_changed_package_is_rebuilt(self):
+        self.assertTrue(build.build_package_for_inbound("TpOssCached", "FIRST"))
+        with open('./fake_repo/packages/TpOssCached/manifest.v3', 'a') as f:
+            f.write("<!-- changed -->\n")
+        self.assertTrue(build.build_package_for_inbound("TpOssCached", "SECOND"))
+        first = os.stat('./fake_builds/build_FIRST/TpOssCached.zip')
+        second = os.stat('./fake_builds/build_SECOND/TpOssCached.zip')
+        self.assertNotEqual(first.st_ino, second.st_ino)
+
+    def test_eviction_by_age_and_size(self):
+        cache_dir = cache.get_cache_dir()
+        for i, age in enumerate([100, 50, 10, 1]):
+            path = cache_dir / f"key{i}-zip.zip"
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (time.time() - age, time.time() - age))
+        freed = cache.evict(max_size=150, max_age=60)
+        self.assertEqual(freed, 300)
+        self.assertListEqual([e.name for e in os.scandir(cache_dir)], ["key3-zip.zip"])
+
+
+class ReproducibleArchiveTC(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        _make_packages("./fake_repo", ["TpOssReproducible"])
+        os.environ[settings.CI_PROJECT_DIR] = '.'
+        os.environ[settings.REPO_DIR_ENV_VAR] = './fake_repo'
+        os.environ[settings.BUILD_DIR_ENV_VAR] = './fake_builds'
+        os.environ.pop(settings.BUILD_CACHE_DIR_ENV_VAR, None)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_the_same_bytes_for_the_same_content(self):
+        self.assertTrue(build.build_package_for_inbound("TpOssReproducible", "FIRST", reproducible=True))
+        for root, _, files in os.walk('./fake_repo/packages/TpOssReproducible'):
+            for f in files:
+                os.utime(os.path.join(root, f), (1, 1))
+        self.assertTrue(build.build_package_for_inbound("TpOssReproducible", "SECOND", reproducible=True))
+        with open('./fake_builds/build_FIRST/TpOssReproducible.zip', 'rb') as first, \
+                open('./fake_builds/build_SECOND/TpOssReproducible.zip', 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_checksum_written_next_to_archive(self):
+        self.assertTrue(build.build_package_for_inbound("TpOssReproducible", "FIRST", reproducible=True))
+        archive = './fake_builds/build_FIRST/TpOssReproducible.zip'
+        process = subprocess.run(['sha256sum', '-c', 'TpOssReproducible.zip.sha256'],
+                                 cwd='./fake_builds/build_FIRST', capture_output=True, encoding='utf-8')
+        self.assertEqual(process.returncode, 0, process.stdout + process.stderr)
+        self.assertEqual(len(build.read_checksum(archive)), 64)
+
+    def test_archive_content(self):
+        self.assertTrue(build.build_package_for_inbound("TpOssReproducible", "FIRST", reproducible=True))
+        with zipfile.ZipFile('./fake_builds/build_FIRST/TpOssReproducible.zip') as zf:
+            names = zf.namelist()
+            self.assertEqual(names, sorted(names))
+            self.assertIn("manifest.v3", names)
+            self.assertIn("ns/", names)
+            self.assertEqual(zf.getinfo("manifest.v3").date_time, (1980, 1, 1, 0, 0, 0))
+
+
+class CompressionPolicyTC(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        _make_packages("./fake_repo", ["TpOssJars"])
+        os.makedirs("./fake_repo/packages/TpOssJars/code/jars", exist_ok=True)
+        with open("./fake_repo/packages/TpOssJars/code/jars/lib.jar", 'wb') as f:
+            f.write(b'a' * 10000)
+        os.environ[settings.CI_PROJECT_DIR] = '.'
+        os.environ[settings.REPO_DIR_ENV_VAR] = './fake_repo'
+        os.environ[settings.BUILD_DIR_ENV_VAR] = './fake_builds'
+        os.environ.pop(settings.BUILD_CACHE_DIR_ENV_VAR, None)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_policy_by_extension(self):
+        policy = build.CompressionPolicy(9, ("jar",))
+        self.assertEqual(policy.for_file("code/jars/lib.JAR"), (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy.for_file("ns/flow.xml"), (zipfile.ZIP_DEFLATED, 9))
+        self.assertEqual(build.CompressionPolicy(0).for_file("flow.xml"), (zipfile.ZIP_STORED, None))
+        self.assertNotEqual(policy.variant(), build.CompressionPolicy(6, ("jar",)).variant())
+
+    def test_jars_are_stored(self):
+        policy = build.CompressionPolicy(9, ("jar",))
+        self.assertTrue(build.build_package_for_inbound("TpOssJars", "POLICY", policy=policy))
+        with zipfile.ZipFile('./fake_builds/build_POLICY/TpOssJars.zip') as zf:
+            self.assertEqual(zf.getinfo("code/jars/lib.jar").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo("manifest.v3").compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_level_of_deflated_files(self):
+        pathlib.Path("./fake_repo/packages/TpOssJars/flow.xml").write_text("<value>flow</value>" * 10000)
+        sizes = {}
+        for level in (1, 9):
+            archive = f"./fake_repo/level{level}.zip"
+            build.make_zip_archive(archive, "./fake_repo/packages/TpOssJars", build.CompressionPolicy(level),
+                                   reproducible=True)
+            with zipfile.ZipFile(archive) as zf:
+                self.assertIsNone(zf.testzip())
+                sizes[level] = zf.getinfo("flow.xml").compress_size
+            data = pathlib.Path("./fake_repo/packages/TpOssJars/flow.xml").read_bytes()
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self.assertEqual(sizes[level], len(compressor.compress(data) + compressor.flush()))
+        self.assertLess(sizes[9], sizes[1])
+
+    def test_benchmark(self):
+        results = build.benchmark_compression(["TpOssJars"], levels=(0, 9))
+        self.assertEqual([r['level'] for r in results], [0, 9])
+        self.assertGreater(results[0]['size'], results[1]['size'])
+
+
+class StagingTC(unittest.TestCase):
+    def setUp(self) -> None:
+        _make_packages("./fake_repo", ["TpOssStaged"])
+
+    def tearDown(self) -> None:
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_staging_does_not_copy_content(self):
+        stats = staging.StagingStats()
+        staging.copytree('./fake_repo/packages/TpOssStaged', './fake_builds/TpOssStaged', stats)
+        self.assertEqual(stats.copied, 0)
+        self.assertEqual(stats.linked + stats.reflinked, 4)
+        size = sum(os.path.getsize(os.path.join(root, f))
+                   for root, _, files in os.walk('./fake_repo/packages/TpOssStaged') for f in files)
+        self.assertEqual(stats.bytes_avoided, size)
+        with open('./fake_builds/TpOssStaged/manifest.v3') as staged, \
+                open('./fake_repo/packages/TpOssStaged/manifest.v3') as source:
+            self.assertEqual(staged.read(), source.read())
+
+    def test_fallback_to_copy(self):
+        stats = staging.StagingStats()
+        with unittest.mock.patch('os.link', side_effect=OSError(18, "Invalid cross-device link")), \
+                unittest.mock.patch.object(staging, 'reflink', return_value=False):
+            staging.copytree('./fake_repo/packages/TpOssStaged', './fake_builds/TpOssStaged', stats)
+        self.assertEqual(stats.copied, 4)
+        self.assertEqual(stats.bytes_avoided, 0)
+        self.assertGreater(stats.bytes_copied, 0)
+
+    def test_existing_file_is_replaced_not_overwritten(self):
+        os.makedirs('./fake_builds', exist_ok=True)
+        with open('./fake_builds/manifest.v3', 'w') as f:
+            f.write("old")
+        os.link('./fake_builds/manifest.v3', './fake_builds/other')
+        staging.link_or_copy('./fake_repo/packages/TpOssStaged/manifest.v3', './fake_builds/manifest.v3')
+        with open('./fake_builds/other') as f:
+            self.assertEqual(f.read(), "old")
+
+
 class ConfigAndBuildTC(unittest.TestCase):
     def setUp(self) -> None:
         os.makedirs('./config.d/testing', exist_ok=True)
@@ -122,6 +358,12 @@ class TestMainRun(unittest.TestCase):
         self.assertTrue(opts.no_changes_only)
         self.assertEqual(opts.action, "inbound")
 
+    def test_deflate_level_validated(self):
+        self.assertEqual(main.build_arguments(["build", "--deflate-level", "9"]).deflate_level, 9)
+        for level in ("10", "-1"):
+            with self.assertRaises(SystemExit), unittest.mock.patch('sys.stderr'):
+                main.build_arguments(["build", "--deflate-level", level])
+
     def test_action_build_linking(self):
         # configure.
         self.skipTest("OSError: [WinError 1314] Klient nie ma wymaganych uprawnień: 'packages\\TpOssAdapterDms' -> './build_LINK'")
@@ -237,6 +479,621 @@ class TestBuild(unittest.TestCase):
         # delete this test folders ;)
 
 
+class TestChangeSet(unittest.TestCase):
+    DIFF = ["packages/TpOssChannelJazz/ns/tp/oss/channel/jazz/order/pub/updateCFService/flow.xml",
+            "packages/TpOssChannelJazz/ns/tp/oss/channel/jazz/order/pub/updateCFService/node.ndf",
+            "packages/TpOssChannelJazz/manifest.v3",
+            "packages/TpOssAdapterDms/ns/tp/oss/adapter/dms/pub/send/flow.xml",
+            "packages/TpOssConnectorChannelJazz/ns/tp/oss/channel/jazz/order/pub/updateCFService/flow.xml",
+            "README.md"]
+
+    def test_index(self):
+        change_set = changes.ChangeSet.from_lines(self.DIFF)
+        self.assertEqual(change_set.packages(), {"TpOssChannelJazz", "TpOssAdapterDms"})
+        self.assertListEqual(change_set.services_of("TpOssChannelJazz"),
+                             ["packages/TpOssChannelJazz/ns/tp/oss/channel/jazz/order/pub/updateCFService"])
+        self.assertEqual(len(change_set.files_of(
+            "TpOssChannelJazz", "packages/TpOssChannelJazz/ns/tp/oss/channel/jazz/order/pub/updateCFService")), 2)
+        self.assertEqual(change_set.services_of("TpOssMissing"), [])
+
+    def test_views_are_the_same_as_helpers(self):
+        change_set = changes.ChangeSet.from_lines(self.DIFF)
+        self.assertEqual(build.get_packages_from_changes(change_set), build.get_packages_from_changes(self.DIFF))
+        self.assertEqual(build.get_services_from_changes(change_set), build.get_services_from_changes(self.DIFF))
+        self.assertEqual(len(build.get_services_from_changes(self.DIFF)), 3)
+
+    def test_group_services_by_package(self):
+        services = build.get_services_from_changes(self.DIFF)
+        grouped = changes.group_services_by_package(services, ["TpOssChannelJazz", "TpOssAdapterDms", "TpOssNone"])
+        self.assertEqual(len(grouped["TpOssChannelJazz"]), 1)
+        self.assertEqual(grouped["TpOssAdapterDms"], ["packages/TpOssAdapterDms/ns/tp/oss/adapter/dms/pub/send"])
+        self.assertEqual(grouped["TpOssNone"], [])
+
+
+class TestGitDiffStream(unittest.TestCase):
+    OUTPUT = ("M\0packages/TpOssA/ns/tp/oss/a/pub/svc/flow.xml\0"
+              "D\0packages/TpOssA/ns/tp/oss/a/pub/old/flow.xml\0"
+              "R087\0packages/TpOssA/ns/tp/oss/a/pub/before/node.ndf\0packages/TpOssA/ns/tp/oss/a/pub/after/node.ndf\0"
+              "A\0packages/TpOssB/manifest.v3\0")
+
+    def test_parse_in_any_chunks(self):
+        expected = [
+            git.Change(git.ChangeType.MODIFIED, "packages/TpOssA/ns/tp/oss/a/pub/svc/flow.xml"),
+            git.Change(git.ChangeType.DELETED, "packages/TpOssA/ns/tp/oss/a/pub/old/flow.xml"),
+            git.Change(git.ChangeType.RENAMED, "packages/TpOssA/ns/tp/oss/a/pub/after/node.ndf",
+                       "packages/TpOssA/ns/tp/oss/a/pub/before/node.ndf"),
+            git.Change(git.ChangeType.ADDED, "packages/TpOssB/manifest.v3"),
+        ]
+        for size in (1, 3, 7, len(self.OUTPUT)):
+            chunks = [self.OUTPUT[i:i + size] for i in range(0, len(self.OUTPUT), size)]
+            self.assertListEqual(list(git.parse_name_status(chunks)), expected)
+
+    def test_failed_diff_raises_after_large_stderr(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # git which fills stderr pipe before it writes records and then fails
+            fake_git = pathlib.Path(tmp, "git")
+            fake_git.write_text("#!/bin/sh\nhead -c 1000000 /dev/zero | tr '\\0' e >&2\n"
+                                "printf 'M\\0packages/TpOssA/manifest.v3\\0'\nexit 128\n")
+            fake_git.chmod(0o755)
+            with unittest.mock.patch.dict(os.environ, {"PATH": tmp + os.pathsep + os.environ["PATH"]}):
+                records = git.GitOperation.iter_diff_to_target_branch("master")
+                self.assertEqual(next(records).path, "packages/TpOssA/manifest.v3")
+                with self.assertRaises(errors.GitOperationError):
+                    next(records)
+
+    def test_change_set_from_records(self):
+        change_set = changes.ChangeSet.from_changes(git.parse_name_status([self.OUTPUT]))
+        self.assertEqual(change_set.packages(), {"TpOssA", "TpOssB"})
+        self.assertEqual(change_set.services(), {"packages/TpOssA/ns/tp/oss/a/pub/svc",
+                                                 "packages/TpOssA/ns/tp/oss/a/pub/after"})
+        self.assertEqual(change_set.removed_services(), {"TpOssA": ["packages/TpOssA/ns/tp/oss/a/pub/before",
+                                                                    "packages/TpOssA/ns/tp/oss/a/pub/old"]})
+
+    def test_removed_services_file(self):
+        os.makedirs("build_REMOVED", exist_ok=True)
+        build.write_removed_services("build_REMOVED", {"TpOssA": ["packages/TpOssA/ns/tp/oss/a/pub/old"]})
+        self.assertEqual(build.read_removed_services("build_REMOVED"), {"TpOssA": ["ns/tp/oss/a/pub/old"]})
+        shutil.rmtree("build_REMOVED")
+        self.assertEqual(build.read_removed_services("build_REMOVED"), {})
+
+
+def _write_manifest(repo_dir, package, requires):
+    values = ''.join(f'<value name="{r}">*.*</value>' for r in requires)
+    os.makedirs(pathlib.Path(repo_dir) / "packages" / package, exist_ok=True)
+    with open(pathlib.Path(repo_dir) / "packages" / package / "manifest.v3", 'w') as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<Values version="2.0">'
+                f'<value name="enabled">yes</value>'
+                f'<record name="requires" javaclass="com.wm.util.Values">{values}</record></Values>\n')
+
+
+class TestDependencies(unittest.TestCase):
+    def setUp(self) -> None:
+        _write_manifest("./fake_repo", "TpOssCommon", ["WmPublic"])
+        _write_manifest("./fake_repo", "TpOssAdapter", ["TpOssCommon"])
+        _write_manifest("./fake_repo", "TpOssChannel", ["TpOssCommon", "TpOssAdapter"])
+        _write_manifest("./fake_repo", "CaOssMock", [])
+
+    def tearDown(self) -> None:
+        shutil.rmtree('./fake_repo', ignore_errors=True)
+
+    def test_read_requires(self):
+        self.assertEqual(dependencies.read_requires("TpOssChannel", "./fake_repo/packages"),
+                         {"TpOssCommon", "TpOssAdapter"})
+        self.assertEqual(dependencies.read_requires("TpOssMissing", "./fake_repo/packages"), set())
+
+    def test_waves_and_critical_path(self):
+        graph = dependencies.build_graph(["TpOssCommon", "TpOssAdapter", "TpOssChannel", "CaOssMock"],
+                                         "./fake_repo/packages")
+        self.assertEqual(graph["TpOssCommon"], set())
+        self.assertListEqual(dependencies.topological_waves(graph),
+                             [["CaOssMock", "TpOssCommon"], ["TpOssAdapter"], ["TpOssChannel"]])
+        self.assertEqual(dependencies.critical_path(graph), (3, ["TpOssCommon", "TpOssAdapter", "TpOssChannel"]))
+        self.assertIn("waves: 3", dependencies.format_plan(graph))
+
+    def test_cycle(self):
+        with pytest.raises(errors.DependencyCycleError):
+            dependencies.topological_waves({"A": {"B"}, "B": {"A"}, "C": set()})
+
+    def test_deploy_activates_wave_by_wave(self):
+        environ = dict(os.environ)
+        os.environ[settings.BUILD_DIR_ENV_VAR] = "fake_builds"
+        try:
+            build_dir = config.get_build_dir("WAVES")
+            for package in ("TpOssCommon", "TpOssChannel"):
+                os.makedirs(pathlib.Path(build_dir, package))
+            graph = dependencies.build_graph(["TpOssCommon", "TpOssAdapter", "TpOssChannel", "CaOssMock"],
+                                             "./fake_repo/packages")
+            build.write_waves(build_dir, dependencies.topological_waves(graph))
+            self.assertEqual(build.read_waves(build_dir), [["TpOssCommon"], ["TpOssChannel"]])
+            activated = []
+            with unittest.mock.patch.object(main, 'send_packages', return_value=True), \
+                    unittest.mock.patch.object(remoter, 'run_is_instance',
+                                               side_effect=lambda host, packages, environ: activated.append(packages)
+                                               or packages != ["TpOssChannel"]):
+                result = main.deploy_host("10.0.0.1", "WAVES", {})
+            self.assertEqual(activated, [["TpOssCommon"], ["TpOssChannel"]])
+            self.assertEqual((result.ok, result.step, result.message), (False, 'is_instance', "wave 2/2"))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree("fake_builds", ignore_errors=True)
+
+    def test_one_wave_activates_all(self):
+        os.makedirs("./build_ONE_WAVE/TpOssCommon")
+        try:
+            build.write_waves("./build_ONE_WAVE", [["TpOssCommon", "TpOssMissing"]])
+            self.assertEqual(build.read_waves("./build_ONE_WAVE"), [["TpOssCommon"]])
+            self.assertEqual(main.get_activation_waves("./build_ONE_WAVE"), ['all'])
+        finally:
+            shutil.rmtree("./build_ONE_WAVE", ignore_errors=True)
+
+
+class TestBuildManifest(unittest.TestCase):
+    def setUp(self) -> None:
+        _make_packages("./build_MANIFEST", ["TpOssFirst", "TpOssSecond"])
+        with open("./build_MANIFEST/cicd_version.json", 'w') as f:
+            f.write("{}")
+
+    def tearDown(self) -> None:
+        shutil.rmtree('./build_MANIFEST', ignore_errors=True)
+
+    def test_write_and_read(self):
+        written = manifest.write_manifest("./build_MANIFEST")
+        self.assertEqual(written, manifest.read_manifest("./build_MANIFEST"))
+        self.assertEqual(len(written["files"]), 8)
+        self.assertNotIn("cicd_version.json", written["files"])
+        entry = written["files"]["packages/TpOssFirst/manifest.v3"]
+        self.assertEqual(entry["sha256"], manifest.hash_file("./build_MANIFEST/packages/TpOssFirst/manifest.v3"))
+
+    def test_verify(self):
+        manifest.write_manifest("./build_MANIFEST")
+        self.assertListEqual(manifest.verify_manifest("./build_MANIFEST"), [])
+        os.utime("./build_MANIFEST/packages/TpOssFirst/manifest.v3", (1, 1))  # touched only
+        self.assertListEqual(manifest.verify_manifest("./build_MANIFEST"), [])
+        with open("./build_MANIFEST/packages/TpOssFirst/manifest.v3", 'a') as f:
+            f.write("changed")
+        os.remove("./build_MANIFEST/packages/TpOssSecond/manifest.v3")
+        problems = manifest.verify_manifest("./build_MANIFEST")
+        self.assertEqual(len(problems), 2)
+
+    def test_big_file_hashed_by_mmap(self):
+        with open("./build_MANIFEST/big.jar", 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 7))
+        with unittest.mock.patch.object(settings, 'MANIFEST_MMAP_THRESHOLD', 1024 * 1024):
+            mapped = manifest.hash_file("./build_MANIFEST/big.jar")
+        with open("./build_MANIFEST/big.jar", 'rb') as f:
+            self.assertEqual(mapped, hashlib.sha256(f.read()).hexdigest())
+
+    def test_diff(self):
+        local = {"a": {"sha256": "1"}, "b": {"sha256": "2"}, "c": {"sha256": "3"}}
+        remote = {"a": "1", "b": "x", "d": "4"}
+        self.assertEqual(manifest.diff_manifests(local, remote), (["b", "c"], ["d"]))
+
+
+def _make_fleet_config(env):
+    os.makedirs(f'./config.d/{env}', exist_ok=True)
+    with open(f'./config.d/{env}/init.cfg', 'w') as cfg:
+        cfg.write("IS_NODE_USERNAME=admin\nIS_NODE_PRIVKEY=./key\nSSH_PORT=22\nINSTANCE_NAME=default\n"
+                  "INTEGRATION_SERVER_DIR=/opt/is\nNODES=10.0.0.3,10.0.0.1\n")
+    with open(f'./config.d/{env}/node1.cfg', 'w') as cfg:
+        cfg.write("SSH_ADDRESS=10.0.0.1\nINTEGRATION_SERVER_DIR=/opt/one\nZONE=east\n")
+    with open(f'./config.d/{env}/node2.cfg', 'w') as cfg:
+        cfg.write("SSH_ADDRESS=10.0.0.2\nINTEGRATION_SERVER_DIR=/opt/two\nZONE=west\n")
+
+
+class TestFleet(unittest.TestCase):
+    ENV = 'fleet'
+
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        _make_fleet_config(self.ENV)
+        os.environ['CONFIG_DIR'] = 'config.d'
+        os.environ[settings.CI_ENVIRONMENT_NAME] = self.ENV
+        os.environ[settings.PIPELINE_REFERENCE] = 'FLEET'
+        os.environ[settings.BUILD_DIR_ENV_VAR] = './fake_builds'
+        os.environ.pop(settings.ZONE_ENV_VAR, None)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree('./config.d', ignore_errors=True)
+        shutil.rmtree('./fake_builds', ignore_errors=True)
+
+    def test_inventory(self):
+        self.assertEqual(fleet.get_inventory(self.ENV), {"10.0.0.1": "node1", "10.0.0.2": "node2", "10.0.0.3": None})
+        self.assertEqual(fleet.get_inventory(self.ENV, zone="west"), {"10.0.0.2": "node2"})
+
+    def test_run_on_hosts_fail_fast_and_continue(self):
+        def operation(host):
+            time.sleep(0.01)
+            return fleet.HostResult(host, host != "b", 'step')
+        results = fleet.run_on_hosts(["a", "b", "c", "d"], operation, parallel=1, fail_fast=True)
+        self.assertEqual([r.ok for r in results.values()], [True, False, False, False])
+        self.assertEqual(results["d"].step, 'skipped')
+        results = fleet.run_on_hosts(["a", "b", "c", "d"], operation, parallel=4, fail_fast=False)
+        self.assertEqual([r.ok for r in results.values()], [True, False, True, True])
+        self.assertIn("FAILED", fleet.format_results(results))
+
+    def test_concurrent_deploy_isolates_configuration(self):
+        sent = {}
+        lock = threading.Lock()
+
+        def send(ref, host, environ=None, *args):
+            time.sleep(0.05)
+            with lock:
+                sent[host] = environ[settings.IS_DIR_ENV_VAR]
+            return True
+
+        with unittest.mock.patch.object(sender, 'send_to_packages_repo', side_effect=send), \
+                unittest.mock.patch.object(remoter, 'run_is_instance', return_value=True), \
+                unittest.mock.patch.object(preflight, 'check_hosts', return_value={}):
+            self.assertTrue(main.action_deploy(parallel=3))
+        self.assertEqual(sent, {"10.0.0.1": "/opt/one", "10.0.0.2": "/opt/two", "10.0.0.3": "/opt/is"})
+        self.assertNotIn(settings.SSH_ADDRESS_ENV_VAR, os.environ)
+
+
+class TestFanout(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environments = {f"10.0.{zone}.{i}": {settings.ZONE_ENV_VAR: f"dc{zone}",
+                                                  settings.IS_DIR_ENV_VAR: "/opt/is",
+                                                  settings.IS_NODE_USERNAME_ENV_VAR: "admin",
+                                                  settings.IS_NODE_PRIVKEY_ENV_VAR: "./key"}
+                             for zone in (1, 2) for i in range(1, 8)}
+        self.uploads, self.copies = [], []
+        self.lock = threading.Lock()
+
+    def upload(self, host, fail=()):
+        with self.lock:
+            self.uploads.append(host)
+        return host not in fail
+
+    def copy(self, parent, child, fail=()):
+        with self.lock:
+            self.copies.append((parent, child))
+        return child not in fail
+
+    def test_plan_tree(self):
+        tree = fanout.plan_tree(["a", "b", "c", "d", "e", "f"], 2)
+        self.assertEqual(tree, {"a": None, "b": "a", "c": "a", "d": "b", "e": "b", "f": "c"})
+
+    def test_one_upload_per_zone(self):
+        results = fanout.distribute(self.environments, self.environments, self.upload, self.copy, degree=2, parallel=2)
+        self.assertTrue(all(result.ok for result in results.values()))
+        self.assertEqual(sorted(self.uploads), ["10.0.1.1", "10.0.2.1"])
+        self.assertEqual(len(self.copies), 12)
+        self.assertTrue(all(parent.split('.')[2] == child.split('.')[2] for parent, child in self.copies))
+        self.assertEqual(results["10.0.1.4"].message, "from 10.0.1.2")
+
+    def test_fallback_to_runner(self):
+        results = fanout.distribute(self.environments, self.environments,
+                                    lambda host: self.upload(host, fail=["10.0.1.1"]),
+                                    lambda parent, child: self.copy(parent, child, fail=["10.0.2.2"]), degree=2)
+        self.assertFalse(results["10.0.1.1"].ok)
+        # failed seed - its peers get packages from runner and copy them further
+        self.assertEqual(results["10.0.1.2"].message, "from runner")
+        self.assertEqual(results["10.0.1.3"].message, "from runner")
+        self.assertEqual(results["10.0.1.4"].message, "from 10.0.1.2")
+        self.assertTrue(all(results[f"10.0.1.{i}"].ok for i in range(2, 8)))
+        # failed copy - only that host from runner, it still copies to its peers
+        self.assertEqual(results["10.0.2.2"].message, "from runner")
+        self.assertEqual(results["10.0.2.4"].message, "from 10.0.2.2")
+
+    def test_relay_command(self):
+        parent, child = self.environments["10.0.1.1"], dict(self.environments["10.0.1.2"], SSH_PORT="2222")
+        parent = dict(parent, **{settings.PEER_PRIVKEY_ENV_VAR: "/home/admin/.ssh/peer"})
+        completed = subprocess.CompletedProcess([], 0, '', '')
+        with unittest.mock.patch('subprocess.run', return_value=completed) as run:
+            self.assertTrue(fanout.relay("10.0.1.1", "10.0.1.2", ["TpOssA", "TpOssB"], parent, child))
+        args = run.call_args.args[0]
+        self.assertIn("admin@10.0.1.1", args)
+        self.assertEqual(shlex.split(args[-1])[:4], ["bash", "-o", "pipefail", "-c"])
+        command = shlex.split(args[-1])[4]
+        self.assertTrue(command.startswith("tar -C /opt/is/packages -chf - -- TpOssA TpOssB | ssh"))
+        self.assertIn("-p 2222 -i /home/admin/.ssh/peer admin@10.0.1.2", command)
+
+    def test_relay_fails_when_tar_fails(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # ssh to child which takes whole stream and succeeds, even if the stream is broken
+            fake_ssh = pathlib.Path(tmp, "ssh")
+            fake_ssh.write_text("#!/bin/sh\ncat > /dev/null\n")
+            fake_ssh.chmod(0o755)
+            pathlib.Path(tmp, "packages/TpOssA").mkdir(parents=True)
+            parent = dict(self.environments["10.0.1.1"], **{settings.IS_DIR_ENV_VAR: tmp})
+            child = self.environments["10.0.1.2"]
+            with unittest.mock.patch.object(remoter.SSHCommand, 'construct',
+                                            return_value=LocalSSHCommand("localhost", "22", "admin",
+                                                                         pathlib.Path("key"))), \
+                    unittest.mock.patch.dict(os.environ, {"PATH": tmp + os.pathsep + os.environ["PATH"]}):
+                self.assertTrue(fanout.relay("10.0.1.1", "10.0.1.2", ["TpOssA"], parent, child))
+                self.assertFalse(fanout.relay("10.0.1.1", "10.0.1.2", ["TpOssA", "TpOssMissing"], parent, child))
+
+
+class LocalResumableCommand(sender.ResumableCommand):
+    def remote_args(self, script) -> list:
+        return ["sh", "-c", script]
+
+
+class TestResumableTransfer(unittest.TestCase):
+    def setUp(self) -> None:
+        pathlib.Path("fake_builds/TpOssA/code/jars").mkdir(parents=True)
+        pathlib.Path("fake_builds/TpOssA/code/jars/big.jar").write_bytes(os.urandom(10 * 1024 + 100))
+        pathlib.Path("fake_builds/TpOssA/manifest.v3").write_text("small")
+        pathlib.Path("fake_repo/TpOssA").mkdir(parents=True)
+        pathlib.Path("fake_repo/TpOssA/old.txt").write_text("old")
+
+    def tearDown(self) -> None:
+        shutil.rmtree("fake_builds", ignore_errors=True)
+        shutil.rmtree("fake_repo", ignore_errors=True)
+
+    def command(self):
+        return LocalResumableCommand("localhost", "22", "admin", pathlib.Path("key"), chunk_size=1024, min_size=4096,
+                                     retries=1)
+
+    def test_resume_after_interrupted_upload(self):
+        command = self.command()
+        original = command.send_chunk
+
+        def fail_from_fifth(part, index, data):
+            return index < 4 and original(part, index, data)
+
+        with unittest.mock.patch.object(command, 'send_chunk', side_effect=fail_from_fifth):
+            self.assertFalse(command.send_dirs("fake_builds", "fake_repo"))
+        state = sender.read_upload_state("fake_builds")["localhost"]["TpOssA/code/jars/big.jar"]
+        self.assertEqual(state["done"], 4)
+        self.assertTrue(pathlib.Path("fake_repo/TpOssA/old.txt").exists())  # nothing replaced yet
+
+        command = self.command()
+        with unittest.mock.patch.object(command, 'send_chunk', wraps=command.send_chunk) as send_chunk:
+            self.assertTrue(command.send_dirs("fake_builds", "fake_repo"))
+        self.assertEqual(command.resumed, 4)
+        self.assertEqual(send_chunk.call_count, 7)  # 11 chunks, 4 were verified before
+        self.assertEqual(pathlib.Path("fake_repo/TpOssA/code/jars/big.jar").read_bytes(),
+                         pathlib.Path("fake_builds/TpOssA/code/jars/big.jar").read_bytes())
+        self.assertEqual(pathlib.Path("fake_repo/TpOssA/manifest.v3").read_text(), "small")
+        self.assertFalse(pathlib.Path("fake_repo/TpOssA/old.txt").exists())
+        self.assertFalse(pathlib.Path("fake_repo/.partial").exists())
+        self.assertEqual(sender.read_upload_state("fake_builds"), {})
+
+    def test_failed_preparation_is_interruption(self):
+        command = self.command()
+        pathlib.Path("fake_repo/.partial").write_text("not a directory")
+        self.assertFalse(command.send_dirs("fake_builds", "fake_repo"))
+        state = sender.read_upload_state("fake_builds")["localhost"]["TpOssA/code/jars/big.jar"]
+        self.assertEqual(state["done"], 0)
+
+        pathlib.Path("fake_repo/.partial").unlink()
+        sender.update_upload_state("fake_builds", "localhost", "TpOssA/code/jars/big.jar", dict(state, done=3))
+        with unittest.mock.patch.object(command, 'run', side_effect=subprocess.TimeoutExpired("ssh", 1)):
+            self.assertFalse(command.send_dirs("fake_builds", "fake_repo"))
+        state = sender.read_upload_state("fake_builds")["localhost"]["TpOssA/code/jars/big.jar"]
+        self.assertEqual(state["done"], 3)  # kept for the next try
+        self.assertTrue(command.send_dirs("fake_builds", "fake_repo"))
+        self.assertEqual(pathlib.Path("fake_repo/TpOssA/code/jars/big.jar").read_bytes(),
+                         pathlib.Path("fake_builds/TpOssA/code/jars/big.jar").read_bytes())
+
+    def test_changed_file_is_uploaded_from_start(self):
+        sender.update_upload_state("fake_builds", "localhost", "TpOssA/code/jars/big.jar",
+                                   {"sha256": "other", "size": 1, "chunk": 1024, "done": 5})
+        command = self.command()
+        self.assertTrue(command.send_dirs("fake_builds", "fake_repo"))
+        self.assertEqual(command.resumed, 0)
+        self.assertEqual(pathlib.Path("fake_repo/TpOssA/code/jars/big.jar").read_bytes(),
+                         pathlib.Path("fake_builds/TpOssA/code/jars/big.jar").read_bytes())
+
+
+class TestTransferScheduler(unittest.TestCase):
+    def test_largest_first_within_limit(self):
+        scheduler = transfers.TransferScheduler(max_concurrent=1, report_interval=0)
+        started, release = [], threading.Event()
+
+        def transfer(host, size):
+            with scheduler.slot(host, size):
+                started.append(host)
+                release.wait(5)
+
+        first = threading.Thread(target=transfer, args=("first", 1))
+        first.start()
+        while not started:
+            time.sleep(0.01)
+        threads = [threading.Thread(target=transfer, args=(host, size))
+                   for host, size in (("small", 10), ("large", 1000), ("medium", 100))]
+        for thread in threads:
+            thread.start()
+        while len(scheduler.waiting) < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in [first, *threads]:
+            thread.join()
+        self.assertEqual(started, ["first", "large", "medium", "small"])
+        self.assertFalse(scheduler.running)
+
+    def test_zone_bandwidth(self):
+        scheduler = transfers.TransferScheduler(2, {"dc2": 1000}, report_interval=0)
+        with scheduler.slot("10.0.0.1", 1500, "dc2") as progress:
+            meter = scheduler.meter(progress)
+            started = time.monotonic()
+            meter(1000)  # burst of one second
+            meter(500)
+            self.assertGreaterEqual(time.monotonic() - started, 0.4)
+            self.assertEqual(progress.sent, 1500)
+            self.assertEqual(scheduler.scp_limit("dc2"), 4)  # half of cap for each of 2 transfers
+        self.assertIsNone(scheduler.scp_limit("dc1"))
+        self.assertIn("10.0.0.1", scheduler.report())
+
+    def test_scp_transfers_of_zone_stay_within_cap(self):
+        scheduler = transfers.TransferScheduler(4, {"dc2": 1000}, report_interval=0)  # 8 Kbit/s
+        limits = []
+        with contextlib.ExitStack() as stack:
+            for host in range(4):
+                stack.enter_context(scheduler.slot(f"10.0.0.{host}", 10, "dc2"))
+                limits.append(scheduler.scp_limit("dc2"))  # limit is given to scp when it starts
+        self.assertLessEqual(sum(limits), 8)
+        self.assertEqual(limits, [2, 2, 2, 2])
+
+    def test_tar_stream_metered(self):
+        pathlib.Path("fake_builds/TpOssA").mkdir(parents=True)
+        pathlib.Path("fake_builds/TpOssA/manifest.v3").write_text("x" * 10000)
+        try:
+            blocks = []
+            tar = LocalTarCommand("localhost", "22", "admin", pathlib.Path("key"), meter=blocks.append)
+            self.assertTrue(tar.send_dirs("fake_builds", "fake_repo"))
+            self.assertEqual(sum(blocks), tar.transferred)
+        finally:
+            shutil.rmtree("fake_builds", ignore_errors=True)
+            shutil.rmtree("fake_repo", ignore_errors=True)
+
+
+class TestRollout(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        os.environ[settings.BUILD_DIR_ENV_VAR] = "fake_builds"
+        self.environments = {"10.0.1.1": {settings.ZONE_ENV_VAR: "dc1"}, "10.0.1.2": {settings.ZONE_ENV_VAR: "dc1"},
+                             "10.0.1.3": {settings.ZONE_ENV_VAR: "dc1"}, "10.0.2.1": {settings.ZONE_ENV_VAR: "dc2"},
+                             "10.0.2.2": {settings.ZONE_ENV_VAR: "dc2"}, "10.0.9.9": {}}
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree("fake_builds", ignore_errors=True)
+
+    def test_plan_waves(self):
+        waves = rollout.plan_waves(self.environments, self.environments, canary=1)
+        self.assertEqual([(wave.name, wave.hosts) for wave in waves],
+                         [("canary", ["10.0.1.1"]), ("zone dc1", ["10.0.1.2", "10.0.1.3"]),
+                          ("zone dc2", ["10.0.2.1", "10.0.2.2"]), ("no zone", ["10.0.9.9"])])
+        waves = rollout.plan_waves(self.environments, self.environments, canary=0, zone_order=["dc2"])
+        self.assertEqual([wave.name for wave in waves], ["zone dc2", "zone dc1", "no zone"])
+
+    def test_health_gate(self):
+        results = {"a": fleet.HostResult("a", True), "b": fleet.HostResult("b", False)}
+        self.assertIn("b", rollout.health_gate(results, max_failures=0))
+        self.assertEqual(rollout.health_gate(results, max_failures=1), '')
+
+    def test_rollout_stops_at_failed_wave(self):
+        deployed = []
+
+        def deploy_host(host, *args, **kwargs):
+            deployed.append(host)
+            return fleet.HostResult(host, host != "10.0.1.3", 'is_instance')
+
+        with unittest.mock.patch.object(main, 'deploy_host', side_effect=deploy_host):
+            results = main.deploy_rollout("ROLLOUT", dict.fromkeys(self.environments), self.environments,
+                                          main.DeployOptions(), rollout.RolloutOptions(canary=1, wave_parallel=2))
+        self.assertEqual(deployed[0], "10.0.1.1")
+        self.assertEqual(sorted(deployed), ["10.0.1.1", "10.0.1.2", "10.0.1.3"])
+        self.assertEqual(results["10.0.2.1"].step, 'skipped')
+        self.assertFalse(results["10.0.9.9"].ok)
+        self.assertTrue(results["10.0.1.2"].ok)
+
+    def test_rollout_continues_within_failure_budget(self):
+        with unittest.mock.patch.object(main, 'deploy_host',
+                                        side_effect=lambda host, *a, **k: fleet.HostResult(host, host != "10.0.1.3")):
+            results = main.deploy_rollout("ROLLOUT", dict.fromkeys(self.environments), self.environments,
+                                          main.DeployOptions(), rollout.RolloutOptions(canary=1, max_failures=1))
+        self.assertEqual(sorted(host for host, result in results.items() if not result.ok), ["10.0.1.3"])
+
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ = dict(os.environ)
+        os.environ[settings.BUILD_DIR_ENV_VAR] = "fake_builds"
+        self.build_dir = config.get_build_dir("JOURNAL")
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree("fake_builds", ignore_errors=True)
+
+    def test_append_and_done(self):
+        deploy_journal = journal.Journal(self.build_dir, legacy_hosts=["10.0.0.9"])
+        deploy_journal.append("10.0.0.1", 'send', 'ok', 1.5, 100)
+        self.assertFalse(deploy_journal.is_done("10.0.0.1"))
+        deploy_journal.append("10.0.0.1", 'is_instance', 'ok', 2.0, done=True)
+        self.assertEqual(deploy_journal.done_hosts(), {"10.0.0.1", "10.0.0.9"})
+        deploy_journal.append("10.0.0.1", 'deploy', 'started')
+        self.assertFalse(deploy_journal.is_done("10.0.0.1"))
+        records = deploy_journal.records()
+        self.assertEqual([record["step"] for record in records], ['send', 'is_instance', 'deploy'])
+        self.assertEqual(records[0]["bytes"], 100)
+
+    def test_other_instance_sees_appended_records(self):
+        first = journal.Journal(self.build_dir)
+        second = journal.Journal(self.build_dir)
+        first.append("10.0.0.1", 'is_instance', 'ok', done=True)
+        self.assertTrue(second.is_done("10.0.0.1"))
+        second.append("10.0.0.2", 'is_instance', 'ok', done=True)
+        self.assertEqual(first.done_hosts(), {"10.0.0.1", "10.0.0.2"})
+
+    def test_concurrent_appends_are_not_lost(self):
+        deploy_journal = journal.Journal(self.build_dir)
+
+        def append(number):
+            for step in range(20):
+                deploy_journal.append(f"10.0.1.{number}", f"step {step}", 'ok', done=step == 19)
+
+        threads = [threading.Thread(target=append, args=(number,)) for number in range(8)]
+        script = ("from deployer import journal\n"
+                  "j = journal.Journal({!r})\n"
+                  "for step in range(20): j.append('10.0.2.1', 'step', 'ok', done=step == 19)\n"
+                  ).format(self.build_dir)
+        processes = [subprocess.Popen([sys.executable, "-c", script]) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for process in processes:
+            self.assertEqual(process.wait(), 0)
+        self.assertEqual(len(deploy_journal.records()), 8 * 20 + 2 * 20)
+        self.assertEqual(len(deploy_journal.done_hosts()), 9)
+
+    def test_deploy_skips_done_hosts(self):
+        environments = {"10.0.0.1": {}, "10.0.0.2": {}}
+        deployed = []
+
+        def deploy_host(host, *args, **kwargs):
+            deployed.append(host)
+            return fleet.HostResult(host, host == "10.0.0.1", 'is_instance')
+
+        with unittest.mock.patch.object(main, 'deploy_host', side_effect=deploy_host):
+            options = main.DeployOptions(inbound=True)
+            main.deploy_hosts("JOURNAL", environments, environments, options, fail_fast=False)
+            results = main.deploy_hosts("JOURNAL", environments, environments, options, fail_fast=False)
+            self.assertEqual(results["10.0.0.1"].step, 'skipped')
+            self.assertEqual(deployed, ["10.0.0.1", "10.0.0.2", "10.0.0.2"])
+            main.deploy_hosts("JOURNAL", environments, environments, main.DeployOptions(inbound=True, redeploy=True),
+                              fail_fast=False)
+        self.assertEqual(deployed.count("10.0.0.1"), 2)
+        statuses = [(record["host"], record["status"]) for record in journal.Journal(self.build_dir).records()]
+        self.assertIn(("10.0.0.2", 'failed'), statuses)
+
+    def test_repository_deploy_does_not_skip(self):
+        environments = {"10.0.0.1": {}}
+        with unittest.mock.patch.object(main, 'deploy_host',
+                                        return_value=fleet.HostResult("10.0.0.1", True, 'is_instance')) as deploy_host:
+            for _ in range(2):
+                main.deploy_hosts("JOURNAL", environments, environments, main.DeployOptions())
+        self.assertEqual(deploy_host.call_count, 2)
+
+    def test_rebuild_is_deployed_again(self):
+        environments = {"10.0.0.1": {}}
+        options = main.DeployOptions(inbound=True)
+        package = pathlib.Path(self.build_dir, "TpOssA.zip")
+        with unittest.mock.patch.object(main, 'deploy_host',
+                                        return_value=fleet.HostResult("10.0.0.1", True, 'is_instance')) as deploy_host:
+            package.write_bytes(b"first")
+            manifest.write_manifest(self.build_dir)
+            main.deploy_hosts("JOURNAL", environments, environments, options)
+            results = main.deploy_hosts("JOURNAL", environments, environments, options)
+            self.assertEqual(results["10.0.0.1"].step, 'skipped')
+            # next push to the same merge request - build directory reused
+            package.write_bytes(b"second")
+            manifest.write_manifest(self.build_dir)
+            results = main.deploy_hosts("JOURNAL", environments, environments, options)
+        self.assertEqual(results["10.0.0.1"].step, 'is_instance')
+        self.assertEqual(deploy_host.call_count, 2)
+
+
 class TestSender(unittest.TestCase):
     def setUp(self) -> None:
         os.environ[settings.SSH_PORT_ENV_VAR] = '22'
@@ -262,6 +1119,219 @@ class TestSender(unittest.TestCase):
         self.assertTrue(sender.send_to_inbound("TEST", "192.168.56.109"))
 
 
+class LocalTarCommand(sender.TarCommand):
+    """Runs 'remote' side of stream locally."""
+    def remote_args(self, script) -> list:
+        return ["sh", "-c", script]
+
+
+class TestTarTransfer(unittest.TestCase):
+    def setUp(self) -> None:
+        for name, files in (("TpOssA", ["ns/a/flow.xml", "ns/a/node.ndf"]), ("TpOssB", ["manifest.v3"])):
+            for file in files:
+                path = pathlib.Path("fake_builds", name, file)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(f"{name} {file}")
+        pathlib.Path("fake_builds", "build_manifest.json").write_text("{}")
+        stale = pathlib.Path("fake_repo", "TpOssA", "ns", "old", "node.ndf")
+        stale.parent.mkdir(parents=True)
+        stale.write_text("old")
+        pathlib.Path("fake_repo", "TpOssOther").mkdir()
+
+    def tearDown(self) -> None:
+        shutil.rmtree("fake_builds", ignore_errors=True)
+        shutil.rmtree("fake_repo", ignore_errors=True)
+
+    def test_send_dirs_replaces_packages(self):
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                tar = LocalTarCommand("localhost", "22", "admin", pathlib.Path("key"), compress=compress)
+                self.assertTrue(tar.send_dirs("fake_builds", "fake_repo"))
+                self.assertGreater(tar.transferred, 0)
+                self.assertEqual(pathlib.Path("fake_repo/TpOssA/ns/a/flow.xml").read_text(), "TpOssA ns/a/flow.xml")
+                self.assertTrue(pathlib.Path("fake_repo/TpOssB/manifest.v3").exists())
+                self.assertFalse(pathlib.Path("fake_repo/TpOssA/ns/old").exists())  # package replaced as a whole
+                self.assertTrue(pathlib.Path("fake_repo/TpOssOther").exists())  # not sent - untouched
+                self.assertFalse(pathlib.Path("fake_repo/build_manifest.json").exists())
+                self.assertEqual([p for p in os.listdir("fake_repo") if p.startswith('.')], [])
+
+    def test_broken_stream_leaves_old_packages(self):
+        class Broken(LocalTarCommand):
+            @staticmethod
+            def extract_script(to_dir, compress=False) -> str:
+                return sender.TarCommand.extract_script(to_dir, compress=True)  # plain stream is not gzip
+
+        self.assertFalse(Broken("localhost", "22", "admin", pathlib.Path("key")).send_dirs("fake_builds", "fake_repo"))
+        self.assertTrue(pathlib.Path("fake_repo/TpOssA/ns/old/node.ndf").exists())
+        self.assertFalse(pathlib.Path("fake_repo/TpOssB").exists())
+        self.assertEqual([p for p in os.listdir("fake_repo") if p.startswith('.')], [])
+
+    def test_stuck_remote_is_killed(self):
+        # more than pipe buffer, so writing blocks when remote does not read
+        pathlib.Path("fake_builds/TpOssA/code.jar").write_bytes(os.urandom(4 * 1024 ** 2))
+        tar = LocalTarCommand("localhost", "22", "admin", pathlib.Path("key"), timeout=1)
+        started = time.monotonic()
+        self.assertFalse(tar.stream(["tar", "-C", "fake_builds", "-cf", "-", "TpOssA"], "sleep 60"))
+        self.assertLess(time.monotonic() - started, 10)
+        # remote which reads everything, but never ends
+        started = time.monotonic()
+        self.assertFalse(tar.stream(["tar", "-C", "fake_builds", "-cf", "-", "TpOssB"], "cat > /dev/null; sleep 60"))
+        self.assertLess(time.monotonic() - started, 10)
+
+
+class LocalDeltaCommand(sender.DeltaCommand):
+    def remote_args(self, script) -> list:
+        return ["sh", "-c", script]
+
+
+class TestDeltaTransfer(unittest.TestCase):
+    def setUp(self) -> None:
+        for name, files in (("TpOssA", ["ns/a/flow.xml", "ns/a/node.ndf", "ns/b/node.ndf"]), ("TpOssB", ["code.jar"])):
+            for file in files:
+                path = pathlib.Path("fake_builds", name, file)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(f"{name} {file}" * 100)
+        manifest.write_manifest("fake_builds")
+        shutil.copytree("fake_builds/TpOssA", "fake_repo/TpOssA")
+        pathlib.Path("fake_repo/TpOssA/ns/b/node.ndf").write_text("changed at host")
+        pathlib.Path("fake_repo/TpOssA/ns/old").mkdir()
+        pathlib.Path("fake_repo/TpOssA/ns/old/node.ndf").write_text("removed from repository")
+        pathlib.Path("fake_repo/TpOssOther").mkdir()
+        pathlib.Path("fake_repo/TpOssOther/manifest.v3").write_text("not in build")
+
+    def tearDown(self) -> None:
+        shutil.rmtree("fake_builds", ignore_errors=True)
+        shutil.rmtree("fake_repo", ignore_errors=True)
+
+    def test_sends_only_differences(self):
+        delta = LocalDeltaCommand("localhost", "22", "admin", pathlib.Path("key"))
+        remote = delta.listing("fake_repo", ["TpOssA", "TpOssB"])
+        self.assertEqual(len(remote), 4)
+        self.assertNotIn("TpOssOther/manifest.v3", remote)
+        self.assertTrue(delta.sync("fake_builds", "fake_repo"))
+        self.assertEqual(delta.sent_files, 2)  # changed node.ndf and missing package
+        self.assertEqual(delta.saved, os.path.getsize("fake_builds/TpOssA/ns/a/flow.xml")
+                         + os.path.getsize("fake_builds/TpOssA/ns/a/node.ndf"))
+        self.assertEqual(pathlib.Path("fake_repo/TpOssA/ns/b/node.ndf").read_text(),
+                         pathlib.Path("fake_builds/TpOssA/ns/b/node.ndf").read_text())
+        self.assertTrue(pathlib.Path("fake_repo/TpOssB/code.jar").exists())
+        self.assertTrue(pathlib.Path("fake_repo/TpOssA/ns/old/node.ndf").exists())  # no delete by default
+        self.assertFalse(pathlib.Path("fake_repo/build_manifest.json").exists())
+        self.assertTrue(delta.sync("fake_builds", "fake_repo"))
+        self.assertEqual((delta.sent_files, delta.transferred), (0, 0))  # nothing to send second time
+
+    def test_delete_stale_only_in_sent_packages(self):
+        delta = LocalDeltaCommand("localhost", "22", "admin", pathlib.Path("key"), delete=True)
+        self.assertTrue(delta.sync("fake_builds", "fake_repo"))
+        self.assertEqual(delta.stale, 1)
+        self.assertFalse(pathlib.Path("fake_repo/TpOssA/ns/old/node.ndf").exists())
+        self.assertTrue(pathlib.Path("fake_repo/TpOssOther/manifest.v3").exists())
+        self.assertEqual([p for p in os.listdir("fake_repo") if p.startswith('.')], [])
+
+    def test_plan_size_is_what_host_misses(self):
+        delta = LocalDeltaCommand("localhost", "22", "admin", pathlib.Path("key"))
+        files, to_send, stale, size = delta.plan("fake_builds", "fake_repo")
+        self.assertEqual(sorted(to_send), ["TpOssA/ns/b/node.ndf", "TpOssB/code.jar"])
+        self.assertEqual(size, os.path.getsize("fake_builds/TpOssA/ns/b/node.ndf")
+                         + os.path.getsize("fake_builds/TpOssB/code.jar"))
+        self.assertTrue(delta.sync("fake_builds", "fake_repo", planned=(files, to_send, stale, size)))
+        self.assertEqual(delta.plan("fake_builds", "fake_repo")[-1], 0)
+
+    def test_transfer_queued_by_planned_size(self):
+        environ = {settings.IS_DIR_ENV_VAR: "/opt/is", settings.SSH_PORT_ENV_VAR: "22",
+                   settings.IS_NODE_USERNAME_ENV_VAR: "admin", settings.IS_NODE_PRIVKEY_ENV_VAR: "./key"}
+        scheduler = transfers.TransferScheduler(1, report_interval=0)
+        with unittest.mock.patch.object(config, 'get_build_dir', return_value=pathlib.Path("fake_builds")), \
+                unittest.mock.patch.object(sender.DeltaCommand, 'plan', return_value=({}, [], [], 123)), \
+                unittest.mock.patch.object(sender.DeltaCommand, 'sync', return_value=True) as sync:
+            self.assertTrue(sender.send_to_packages_repo("DELTA", "10.0.0.1", environ, 'delta', scheduler=scheduler))
+        self.assertEqual(scheduler.progress["10.0.0.1"].size, 123)
+        self.assertEqual(sync.call_args.kwargs["planned"], ({}, [], [], 123))
+
+
+
+class LocalStoreCommand(sender.StoreCommand):
+    def remote_args(self, script) -> list:
+        return ["sh", "-c", script]
+
+
+class TestPackageStore(unittest.TestCase):
+    def setUp(self) -> None:
+        for name in ("TpOssA", "TpOssB"):
+            path = pathlib.Path("fake_builds", name, "ns/node.ndf")
+            path.parent.mkdir(parents=True)
+            path.write_text(f"{name} version 1")
+        pathlib.Path("fake_repo/packages/TpOssA").mkdir(parents=True)  # deployed before store
+        pathlib.Path("fake_repo/packages/TpOssA/old.txt").write_text("old")
+
+    def tearDown(self) -> None:
+        shutil.rmtree("fake_builds", ignore_errors=True)
+        shutil.rmtree("fake_repo", ignore_errors=True)
+
+    def deploy(self, keep=3):
+        command = LocalStoreCommand("localhost", "22", "admin", pathlib.Path("key"), keep=keep)
+        self.assertTrue(command.deploy("fake_builds", "fake_repo/packages", "fake_repo/package_store",
+                                       manifest.create_manifest("fake_builds")))
+        return command
+
+    def linked(self, name):
+        return pathlib.Path(os.readlink(f"fake_repo/packages/{name}")).name
+
+    def test_digest_depends_on_content_only(self):
+        first = manifest.package_digests(manifest.create_manifest("fake_builds"))
+        os.utime("fake_builds/TpOssA/ns/node.ndf", (0, 0))
+        self.assertEqual(manifest.package_digests(manifest.create_manifest("fake_builds")), first)
+        pathlib.Path("fake_builds/TpOssA/ns/node.ndf").write_text("TpOssA version 2")
+        second = manifest.package_digests(manifest.create_manifest("fake_builds"))
+        self.assertNotEqual(second["TpOssA"], first["TpOssA"])
+        self.assertEqual(second["TpOssB"], first["TpOssB"])
+
+    def test_redeploy_and_rollback_send_nothing(self):
+        command = self.deploy()
+        self.assertEqual(command.reused, 0)
+        first = self.linked("TpOssA")
+        self.assertEqual(pathlib.Path("fake_repo/packages/TpOssA/ns/node.ndf").read_text(), "TpOssA version 1")
+        self.assertFalse(pathlib.Path("fake_repo/packages/TpOssA/old.txt").exists())
+
+        pathlib.Path("fake_builds/TpOssA/ns/node.ndf").write_text("TpOssA version 2")
+        command = self.deploy()
+        self.assertEqual(command.reused, 1)  # only TpOssA sent
+        self.assertEqual(pathlib.Path("fake_repo/packages/TpOssA/ns/node.ndf").read_text(), "TpOssA version 2")
+
+        pathlib.Path("fake_builds/TpOssA/ns/node.ndf").write_text("TpOssA version 1")
+        command = self.deploy()
+        self.assertEqual((command.reused, command.transferred), (2, 0))
+        self.assertEqual(self.linked("TpOssA"), first)
+        self.assertEqual(pathlib.Path("fake_repo/packages/TpOssA/ns/node.ndf").read_text(), "TpOssA version 1")
+        self.assertEqual([name for name in os.listdir("fake_repo/packages") if name.startswith('.')], [])
+
+    def test_plan_size_of_missing_versions(self):
+        command = LocalStoreCommand("localhost", "22", "admin", pathlib.Path("key"))
+        self.assertEqual(command.plan("fake_builds", "fake_repo/package_store")[-1],
+                         len("TpOssA version 1") + len("TpOssB version 1"))
+        self.deploy()
+        self.assertEqual(command.plan("fake_builds", "fake_repo/package_store")[1:], ([], 0))
+
+    def test_garbage_collection_keeps_linked_version(self):
+        for version in range(1, 4):
+            pathlib.Path("fake_builds/TpOssA/ns/node.ndf").write_text(f"TpOssA version {version}")
+            self.deploy(keep=2)
+        self.assertEqual(len(os.listdir("fake_repo/package_store/TpOssA")), 2)
+        self.assertIn(self.linked("TpOssA"), os.listdir("fake_repo/package_store/TpOssA"))
+        self.assertEqual(len(os.listdir("fake_repo/package_store/TpOssB")), 1)
+
+    def test_delta_does_not_change_stored_version(self):
+        self.deploy()
+        stored = os.readlink("fake_repo/packages/TpOssA")
+        pathlib.Path("fake_builds/TpOssA/ns/node.ndf").write_text("TpOssA version 2")
+        delta = LocalDeltaCommand("localhost", "22", "admin", pathlib.Path("key"))
+        self.assertTrue(delta.sync("fake_builds", "fake_repo/packages", manifest.create_manifest("fake_builds")))
+        self.assertEqual(delta.sent_files, 1)
+        self.assertFalse(os.path.islink("fake_repo/packages/TpOssA"))
+        self.assertEqual(pathlib.Path("fake_repo/packages/TpOssA/ns/node.ndf").read_text(), "TpOssA version 2")
+        self.assertEqual(pathlib.Path(stored, "ns/node.ndf").read_text(), "TpOssA version 1")
+
+
 class TestRemoteCommand(unittest.TestCase):
     def test_simple_ls(self):
         self.skipTest("Loooong for do simple command")
@@ -283,6 +1353,338 @@ class TestRemoteCommand(unittest.TestCase):
         remoter.check_stop_status('192.168.56.109')
 
 
+class LocalSSHCommand(remoter.SSHCommand):
+    def args(self, command=None) -> list:
+        return ["sh", "-c", command]
+
+
+class TestRemoteSession(unittest.TestCase):
+    def run_steps(self, steps, timeout=None):
+        with unittest.mock.patch.object(remoter.SSHCommand, 'construct',
+                                        return_value=LocalSSHCommand("localhost", "22", "admin", pathlib.Path("key"))):
+            return remoter.run_session("localhost", steps, {}, timeout)
+
+    def test_steps_in_one_session(self):
+        results = self.run_steps([("one", "echo hello"), ("two", "printf partial; exit 3"), ("three", "echo never")])
+        self.assertEqual([(r.step, r.ok, r.code) for r in results], [("one", True, 0), ("two", False, 3)])
+        self.assertEqual(results[0].output, "hello\n")
+        self.assertEqual(results[1].output, "partial")
+
+    def test_session_timeout(self):
+        results = self.run_steps([("one", "true"), ("slow", "sleep 5")], timeout=0.5)
+        self.assertEqual([r.step for r in results], ["one"])
+
+    def test_deploy_steps(self):
+        environ = {settings.INSTANCE_NAME_ENV_VAR: "default", settings.IS_DIR_ENV_VAR: "/opt/is"}
+        steps = remoter.deploy_steps(environ, removed={"TpOssA": ["ns/tp/old", "../etc"]}, with_restart=True)
+        self.assertEqual([name for name, _ in steps], ["shutdown", "is_instance", "remove services", "start"])
+        self.assertEqual(steps[1][1],
+                         "/opt/is/instances/is_instance.sh update -Dpackage.list=all -Dinstance.name=default")
+        self.assertEqual(steps[2][1], "rm -rf -- /opt/is/instances/default/packages/TpOssA/ns/tp/old")
+        self.assertEqual([name for name, _ in remoter.deploy_steps(environ, with_restart=False)], ["is_instance"])
+        steps = remoter.deploy_steps(environ, with_restart=False, waves=[["TpOssCommon"], ["TpOssA", "TpOssB"]])
+        self.assertEqual([snippet.split()[2] for _, snippet in steps],
+                         ["-Dpackage.list=TpOssCommon", "-Dpackage.list=TpOssA,TpOssB"])
+        self.assertIsNone(remoter.deploy_steps({}))
+
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self) -> None:
+        self.is_dir = pathlib.Path("fake_is").absolute()
+        self.packages = self.is_dir / "instances/default/packages"
+        (self.packages / "TpOssA").mkdir(parents=True)
+        (self.packages / "TpOssA/node.ndf").write_text("version 1")
+        # is_instance.sh of test only rewrites file of package
+        script = self.is_dir / "instances/is_instance.sh"
+        script.write_text(f"#!/bin/sh\nrm {self.packages}/TpOssA/node.ndf\n"
+                          f"echo 'version 2' > {self.packages}/TpOssA/node.ndf\n")
+        script.chmod(0o755)
+        self.environ = {settings.IS_DIR_ENV_VAR: str(self.is_dir), settings.INSTANCE_NAME_ENV_VAR: "default"}
+        self.construct = unittest.mock.patch.object(remoter.SSHCommand, 'construct', return_value=LocalSSHCommand(
+            "localhost", "22", "admin", pathlib.Path("key")))
+        self.construct.start()
+
+    def tearDown(self) -> None:
+        self.construct.stop()
+        shutil.rmtree("fake_is", ignore_errors=True)
+
+    def snapshots(self):
+        return sorted(os.listdir(self.is_dir / settings.BACKUP_DIR / "default"))
+
+    def test_deploy_session_snapshot_and_rollback(self):
+        result = main.run_deploy_session("localhost", self.environ, snapshot="20240101-000000-1")
+        self.assertTrue(result.ok, result.message)
+        self.assertEqual((self.packages / "TpOssA/node.ndf").read_text(), "version 2\n")
+        self.assertEqual(self.snapshots(), ["20240101-000000-1"])
+        result = backup.rollback("localhost", self.environ)
+        self.assertTrue(result.ok, result.message)
+        self.assertEqual(result.step, 'rollback')
+        self.assertEqual((self.packages / "TpOssA/node.ndf").read_text(), "version 1")
+        self.assertEqual(self.snapshots(), [])
+        self.assertFalse(backup.rollback("localhost", self.environ).ok)  # nothing to restore
+
+    def test_bounded_snapshots(self):
+        for name in ("20240101-000000-1", "20240102-000000-2", "20240103-000000-3"):
+            self.assertTrue(backup.snapshot("localhost", self.environ, name, mode='link', keep=2).ok)
+        self.assertEqual(self.snapshots(), ["20240102-000000-2", "20240103-000000-3"])
+        stored = self.is_dir / settings.BACKUP_DIR / "default/20240103-000000-3/TpOssA/node.ndf"
+        self.assertTrue(os.path.samefile(stored, self.packages / "TpOssA/node.ndf"))  # hardlink
+        result = backup.rollback("localhost", self.environ, "20240102-000000-2")
+        self.assertTrue(result.ok, result.message)
+        self.assertEqual(self.snapshots(), ["20240103-000000-3"])
+
+    def test_snapshot_without_packages_fails(self):
+        shutil.rmtree(self.packages)
+        result = backup.snapshot("localhost", self.environ, "20240101-000000-1")
+        self.assertFalse(result.ok)
+        self.assertIn("No packages directory", result.message)
+        self.assertFalse(backup.snapshot("localhost", {}, "20240101-000000-1").ok)
+
+
+class TestFleetOperations(unittest.TestCase):
+    HOSTS = ("127.0.0.1", "127.0.0.2", "127.0.0.3")
+
+    def setUp(self) -> None:
+        self.environments = {}
+        for host in self.HOSTS:
+            is_dir = pathlib.Path("fake_is", host).absolute()
+            (is_dir / "instances/default/bin").mkdir(parents=True)
+            for script, output in (("shutdown.sh", "Stopped"), ("startup.sh", "Started")):
+                path = is_dir / "instances/default/bin" / script
+                path.write_text(f"#!/bin/sh\nsleep 0.5\necho {output}\n")
+                path.chmod(0o755)
+            (is_dir / "packages/TpOssA").mkdir(parents=True)
+            self.environments[host] = {settings.IS_DIR_ENV_VAR: str(is_dir), settings.INSTANCE_NAME_ENV_VAR: "default"}
+        self.patches = [
+            unittest.mock.patch.object(main, 'load_fleet',
+                                       return_value=(dict.fromkeys(self.environments), self.environments)),
+            unittest.mock.patch.object(remoter.SSHCommand, 'construct',
+                                       return_value=LocalSSHCommand("localhost", "22", "admin", pathlib.Path("key"))),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self) -> None:
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree("fake_is", ignore_errors=True)
+
+    def test_stop_hosts_at_once(self):
+        started = time.monotonic()
+        self.assertTrue(main.action_fleet('stop', parallel=3))
+        self.assertLess(time.monotonic() - started, 1.4)  # not 3 * 0.5 s
+
+    def test_clean_reports_each_host(self):
+        del self.environments["127.0.0.2"][settings.IS_DIR_ENV_VAR]
+        with unittest.mock.patch.object(fleet, 'format_results', wraps=fleet.format_results) as format_results:
+            self.assertFalse(main.action_fleet('clean'))
+        results = format_results.call_args[0][0]
+        self.assertEqual([host for host, result in results.items() if not result.ok], ["127.0.0.2"])
+        self.assertEqual(os.listdir("fake_is/127.0.0.1/packages"), [])
+        self.assertEqual(os.listdir("fake_is/127.0.0.2/packages"), ["TpOssA"])
+
+    def test_start_waits_for_readiness(self):
+        server = socket.socket()
+        server.bind(("", 0))
+        server.listen()
+        try:
+            with unittest.mock.patch.object(settings, 'READINESS_PORT', server.getsockname()[1]):
+                self.assertTrue(main.action_fleet('start'))
+        finally:
+            server.close()
+
+
+class TestExec(unittest.TestCase):
+    HOSTS = ("10.0.0.1", "10.0.0.2", "10.0.0.3")
+
+    def setUp(self) -> None:
+        self.environments = {host: {} for host in self.HOSTS}
+        self.patches = [
+            unittest.mock.patch.object(main, 'load_fleet',
+                                       return_value=(dict.fromkeys(self.environments), self.environments)),
+            unittest.mock.patch.object(remoter.SSHCommand, 'construct',
+                                       return_value=LocalSSHCommand("localhost", "22", "admin", pathlib.Path("key"))),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self) -> None:
+        for patch in self.patches:
+            patch.stop()
+
+    def test_output_prefixed_and_exit_codes(self):
+        with self.assertLogs(settings.log, level='INFO') as logs:
+            self.assertFalse(main.action_exec("cat; echo checked; exit 3", parallel=3))
+        output = '\n'.join(logs.output)
+        for host in self.HOSTS:
+            self.assertIn(f"[{host}] checked", output)
+        self.assertIn("exit code 3 - 3 host(s): 10.0.0.1, 10.0.0.2, 10.0.0.3", output)
+        self.assertTrue(main.action_exec("true"))
+
+    def test_timeout_per_host(self):
+        started = time.monotonic()
+        result = fleet.run_command("10.0.0.1", "sleep 5", {}, timeout=0.5)
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertFalse(result.ok)
+        self.assertIn("timeout", result.message)
+        self.assertFalse(main.action_exec(None))
+
+
+class TestPreflight(unittest.TestCase):
+    def setUp(self) -> None:
+        self.environ_backup = dict(os.environ)
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.is_dir = pathlib.Path("fake_is").absolute()
+        (self.is_dir / "instances").mkdir(parents=True)
+        script = self.is_dir / "instances/is_instance.sh"
+        script.write_text("#!/bin/sh\n")
+        script.chmod(0o755)
+        self.environ = {settings.IS_DIR_ENV_VAR: str(self.is_dir),
+                        settings.SSH_PORT_ENV_VAR: str(self.server.getsockname()[1]),
+                        settings.IS_NODE_USERNAME_ENV_VAR: "admin", settings.IS_NODE_PRIVKEY_ENV_VAR: "./key"}
+        self.construct = unittest.mock.patch.object(
+            remoter.SSHCommand, 'construct',
+            return_value=LocalSSHCommand("127.0.0.1", "22", "admin", pathlib.Path("key")))
+        self.construct.start()
+
+    def tearDown(self) -> None:
+        self.construct.stop()
+        self.server.close()
+        shutil.rmtree("fake_is", ignore_errors=True)
+        shutil.rmtree("fake_builds", ignore_errors=True)
+        os.environ.clear()
+        os.environ.update(self.environ_backup)
+
+    def check(self, size=0, **changes):
+        environ = dict(self.environ, **changes)
+        return preflight.check_host("127.0.0.1", {k: v for k, v in environ.items() if v is not None}, size, timeout=2)
+
+    def test_ready_host(self):
+        result = self.check(size=1024)
+        self.assertTrue(result.ok, result.message)
+        self.assertIn("free", result.message)
+
+    def test_failed_checks(self):
+        self.assertEqual(self.check(size=1024 ** 5).step, 'space')
+        self.assertEqual(self.check(**{settings.IS_DIR_ENV_VAR: str(self.is_dir / "other")}).step, 'directory')
+        self.assertEqual(self.check(**{settings.IS_DIR_ENV_VAR: None}).step, 'config')
+        (self.is_dir / "instances/is_instance.sh").unlink()
+        self.assertEqual(self.check().step, 'is_instance')
+        self.server.close()
+        self.assertEqual(self.check().step, 'tcp')
+
+    def test_deploy_stops_before_sending(self):
+        os.environ[settings.PIPELINE_REFERENCE] = "PREFLIGHT"
+        os.environ[settings.BUILD_DIR_ENV_VAR] = "fake_builds"
+        environments = {"127.0.0.1": self.environ,
+                        "127.0.0.2": dict(self.environ, **{settings.IS_DIR_ENV_VAR: "/nope"})}
+        with unittest.mock.patch.object(main, 'load_fleet', return_value=(dict.fromkeys(environments), environments)), \
+                unittest.mock.patch.object(sender, 'send_to_packages_repo') as send:
+            self.assertFalse(main.action_deploy(parallel=2))
+        send.assert_not_called()
+
+
+class StubIntegrationServer(http.server.BaseHTTPRequestHandler):
+    """Answers ping of IS with 503 until server.ready is set."""
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Authorization")))
+        ready = self.server.ready.is_set() and self.path == settings.READINESS_HTTP_PATH
+        self.send_response(200 if ready else 503)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestReadiness(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubIntegrationServer)
+        self.server.ready, self.server.requests = threading.Event(), []
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_http_ready_soon_after_start(self):
+        threading.Timer(0.5, self.server.ready.set).start()
+        results = readiness.wait_for_hosts(["127.0.0.1"], self.port, http=True, timeout=5, initial=0.05, maximum=0.2,
+                                           auth={"127.0.0.1": ("Administrator", "manage")})
+        result = results["127.0.0.1"]
+        self.assertTrue(result.ok)
+        self.assertGreater(result.attempts, 1)
+        self.assertLess(result.seconds, 1.5)
+        self.assertTrue(self.server.requests[0][1].startswith("Basic "))
+
+    def test_hosts_probed_at_once(self):
+        threading.Timer(0.5, self.server.ready.set).start()
+        started = time.monotonic()
+        results = readiness.wait_for_hosts(["127.0.0.1", "localhost"], self.port, http=True, timeout=5, initial=0.1,
+                                           maximum=0.2)
+        self.assertTrue(all(result.ok for result in results.values()))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_not_ready(self):
+        results = readiness.wait_for_hosts(["127.0.0.1"], self.port, http=True, timeout=0.5, initial=0.1)
+        self.assertFalse(results["127.0.0.1"].ok)
+        self.assertIn("503", results["127.0.0.1"].error)
+        self.assertTrue(readiness.wait_for_hosts(["127.0.0.1"], self.port, timeout=0.5)["127.0.0.1"].ok)  # TCP only
+
+    def test_closed_port(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            closed_port = s.getsockname()[1]
+        result = readiness.wait_for_hosts(["127.0.0.1"], closed_port, timeout=0.3, initial=0.1)["127.0.0.1"]
+        self.assertFalse(result.ok)
+        self.assertGreater(result.attempts, 1)
+
+    def test_backoff_delays(self):
+        delays = list(itertools.islice(readiness.backoff_delays(1, 8, rnd=random.Random(1)), 6))
+        for delay, base in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertTrue(base / 2 <= delay <= base)
+
+
+class TestConnections(unittest.TestCase):
+    def test_master_opened_once_and_reused(self):
+        manager = connections.ConnectionManager(persist=5)
+        self.assertEqual(manager.options("10.0.0.1", "22", "admin", "./key"), [])  # disabled
+        manager.enable()
+        completed = subprocess.CompletedProcess([], 0, '', '')
+        with unittest.mock.patch('subprocess.run', return_value=completed) as run:
+            first = manager.options("10.0.0.1", "22", "admin", "./key")
+            second = manager.options("10.0.0.1", "22", "admin", "./key")
+            self.assertEqual(first, second)
+            self.assertEqual(run.call_count, 1)
+            self.assertIn("ControlMaster=yes", run.call_args.args[0])
+            self.assertIn("1 command(s) reused", manager.report())
+            manager.close_all()
+            self.assertIn("-O", run.call_args.args[0])
+        self.assertFalse(manager.masters)
+
+    def test_fallback_when_master_fails(self):
+        manager = connections.ConnectionManager()
+        manager.enable()
+        failed = subprocess.CompletedProcess([], 255, '', 'Permission denied')
+        with unittest.mock.patch('subprocess.run', return_value=failed) as run:
+            self.assertEqual(manager.options("10.0.0.1", "22", "admin", "./key"), [])
+            self.assertEqual(manager.options("10.0.0.1", "22", "admin", "./key"), [])
+            self.assertEqual(run.call_count, 1)  # not retried for every command
+            manager.close_all()
+
+    def test_commands_use_options(self):
+        ssh = remoter.SSHCommand("10.0.0.1", "22", "admin", pathlib.Path("key"), ["-o", "ControlPath=/tmp/x"])
+        self.assertEqual(ssh.args("ls -l /tmp"),
+                         ["ssh", "-o", "ControlPath=/tmp/x", "-p", "22", "-i", "key", "admin@10.0.0.1", "ls -l /tmp"])
+        scp = sender.SCPCommand("10.0.0.1", "22", "admin", pathlib.Path("key"), ["-o", "ControlPath=/tmp/x"])
+        self.assertEqual(scp.args(["a", "b"], "/opt", recursive=True),
+                         ["scp", "-p", "-o", "ControlPath=/tmp/x", "-i", "key", "-P", "22", "-r", "a", "b",
+                          "admin@10.0.0.1:/opt/"])
+
+
 class TestSigner(unittest.TestCase):
     HOST = '192.168.56.203'
 